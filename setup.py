@@ -88,6 +88,8 @@ setup(
     tests_require=tests_require,
     extras_require={
         'testing': tests_require,
+        # faster parsing and canonicalization, see saml2.xmlbackend
+        'lxml': ['lxml'],
     },
     install_requires=install_requires,
     zip_safe=False,
@@ -18,8 +18,13 @@
 """
 
 
+import keyword
 import logging
+import os
+import re
+import sys
 from saml2.validate import valid_instance
+from saml2.validate import _valid_instance
 
 try:
     from xml.etree import cElementTree as ElementTree
@@ -34,6 +39,12 @@ except ImportError:
     except ImportError:
         from elementtree import ElementTree
 
+# Parsing doesn't need register_namespace so it's left to xmlbackend, which
+# uses lxml or the C implementation of ElementTree
+from saml2 import xmlbackend
+
+xml_fromstring = xmlbackend.fromstring
+
 root_logger = logging.getLogger(__name__)
 root_logger.level = logging.NOTSET
 
@@ -68,7 +79,7 @@ def class_name(instance):
     return "%s:%s" % (instance.c_namespace, instance.c_tag)
 
 
-def create_class_from_xml_string(target_class, xml_string):
+def create_class_from_xml_string(target_class, xml_string, lazy=False):
     """Creates an instance of the target class from a string.
     
     :param target_class: The class which will be instantiated and populated
@@ -77,17 +88,18 @@ def create_class_from_xml_string(target_class, xml_string):
     :param xml_string: A string which contains valid XML. The root element
         of the XML string should match the tag and namespace of the desired
         class.
+    :param lazy: If True the children are kept as XML until they are used
 
     :return: An instance of the target class with members assigned according to
         the contents of the XML - or None if the root XML tag and namespace did 
         not match those of the target class.
     """
-    tree = ElementTree.fromstring(xml_string)
-    return create_class_from_element_tree(target_class, tree)
+    tree = xml_fromstring(xml_string)
+    return create_class_from_element_tree(target_class, tree, lazy=lazy)
 
 
 def create_class_from_element_tree(target_class, tree, namespace=None,
-                                   tag=None):
+                                   tag=None, lazy=False):
     """Instantiates the class and populates members according to the tree.
 
     Note: Only use this function with classes that have c_namespace and c_tag
@@ -103,17 +115,26 @@ def create_class_from_element_tree(target_class, tree, namespace=None,
     :param tag: The tag which the XML tree's root node must match. If
         omitted, the tag defaults to the c_tag class member of the target 
         class.
+    :param lazy: If True the children of the instance are kept as XML and
+        only converted when they are accessed.
 
     :return: An instance of the target class - or None if the tag and namespace
         of the XML tree's root node did not match the desired namespace and tag.
     """
-    if namespace is None:
-        namespace = target_class.c_namespace
-    if tag is None:
-        tag = target_class.c_tag
-    if tree.tag == '{%s}%s' % (namespace, tag):
+    if namespace is None and tag is None:
+        qname = qualified_tag(target_class)
+    else:
+        if namespace is None:
+            namespace = target_class.c_namespace
+        if tag is None:
+            tag = target_class.c_tag
+        qname = '{%s}%s' % (namespace, tag)
+    if tree.tag == qname:
         target = target_class()
-        target.harvest_element_tree(tree)
+        if lazy:
+            target.harvest_lazily(tree)
+        else:
+            target.harvest_element_tree(tree)
         return target
     else:
         return None
@@ -260,7 +281,7 @@ class ExtensionElement(object):
         
 
 def extension_element_from_string(xml_string):
-    element_tree = ElementTree.fromstring(xml_string)
+    element_tree = xml_fromstring(xml_string)
     return _extension_element_from_element_tree(element_tree)
 
 
@@ -281,8 +302,58 @@ def _extension_element_from_element_tree(element_tree):
     return extension
 
 
+# In compact mode instances of the SAML classes keep their members in
+# __slots__ instead of a __dict__ and the extension element and attribute
+# containers are only allocated when something is put into them.
+# Since the slots are created together with the classes this has to be
+# turned on, by setting PYSAML2_COMPACT, before the schemas are imported.
+COMPACT = os.environ.get("PYSAML2_COMPACT", "") not in ["", "0"]
+
+
+def _declared_members(namespace):
+    """ The names of the members a class body declares through c_attributes,
+    c_children, c_child_order and c_cardinality, and the instance
+    attributes it lists in c_extra_members """
+    names = set(namespace.get("c_extra_members", []))
+    for val in namespace.get("c_attributes", {}).values():
+        names.add(val[0])
+    for val in namespace.get("c_children", {}).values():
+        names.add(val[0])
+    names.update(namespace.get("c_child_order", []))
+    names.update(namespace.get("c_cardinality", {}).keys())
+    return names
+
+
+class CompactClass(type):
+    """ Metaclass that gives every class __slots__ for the members it
+    declares, see _declared_members(), unless the class defines its own.
+    Members that are added to c_children after a class has been created
+    are already in its c_child_order and c_cardinality.
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        if "__slots__" not in namespace:
+            namespace["__slots__"] = tuple(sorted([
+                n for n in _declared_members(namespace)
+                if n not in namespace and
+                not [b for b in bases if hasattr(b, n)]]))
+
+        cls = type.__new__(mcs, name, bases, namespace)
+        members = []
+        for klass in cls.__mro__:
+            for slot in klass.__dict__.get("__slots__", []):
+                if slot not in members:
+                    members.append(slot)
+        cls._slot_names = members
+        return cls
+
+
 class ExtensionContainer(object):
-    
+    if COMPACT:
+        __metaclass__ = CompactClass
+        __slots__ = ["text", "_extension_elements", "_extension_attributes",
+                     "_extra"]
+
     c_tag = ""
     c_namespace = ""
     
@@ -292,6 +363,75 @@ class ExtensionContainer(object):
         self.text = text
         self.extension_elements = extension_elements or []
         self.extension_attributes = extension_attributes or {}
+
+    if COMPACT:
+        def _get_extension_elements(self):
+            if self._extension_elements is None:
+                self._extension_elements = []
+            return self._extension_elements
+
+        def _set_extension_elements(self, value):
+            self._extension_elements = value or None
+
+        def _get_extension_attributes(self):
+            if self._extension_attributes is None:
+                self._extension_attributes = {}
+            return self._extension_attributes
+
+        def _set_extension_attributes(self, value):
+            self._extension_attributes = value or None
+
+        extension_elements = property(_get_extension_elements,
+                                      _set_extension_elements)
+        extension_attributes = property(_get_extension_attributes,
+                                        _set_extension_attributes)
+
+        def _member_items(self):
+            res = []
+            for name in self._slot_names:
+                try:
+                    val = object.__getattribute__(self, name)
+                except AttributeError:
+                    continue
+                if name == "_extra":
+                    res.extend(val.items())
+                    continue
+                if name.startswith("_extension_"):
+                    name = name[1:]
+                res.append((name, val))
+            return res
+
+        def __getstate__(self):
+            return dict(self._member_items())
+
+        # A read-only snapshot, for code that looks at the members this way
+        __dict__ = property(__getstate__)
+
+        def __setstate__(self, state):
+            # Like the restoring of __dict__, past any __setattr__
+            for key, val in state.items():
+                try:
+                    object.__setattr__(self, key, val)
+                except AttributeError:
+                    self.set_extra(key, val)
+
+        def set_extra(self, name, value):
+            """ Set an attribute that isn't one of the members of the class.
+            Compact instances keep these in a dictionary of their own,
+            which SamlBase.__getattr__ looks in. """
+            try:
+                extra = object.__getattribute__(self, "_extra")
+            except AttributeError:
+                extra = self._extra = {}
+            extra[name] = value
+    else:
+        def _member_items(self):
+            return self.__dict__.items()
+
+        def set_extra(self, name, value):
+            """ Set an attribute that isn't one of the members of the
+            class """
+            setattr(self, name, value)
  
     # Three methods to create an object from an ElementTree
     def harvest_element_tree(self, tree):
@@ -430,6 +570,213 @@ def make_instance(klass, spec, base64encode=False):
     return klass().loadd(spec, base64encode)
 
 
+# ----------------------------------------------------------------------------
+# Specialised parse and serialize functions. The first time a class is used
+# the code for picking up and writing out its attributes and children is
+# generated from c_children, c_attributes and c_child_order, with the
+# qualified tags and member names as constants.
+
+QNAMES = {}
+PARSERS = {}
+SERIALIZERS = {}
+
+IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def qualified_tag(cls):
+    """ The {namespace}tag of the elements the class represents """
+    try:
+        return QNAMES[cls]
+    except KeyError:
+        QNAMES[cls] = '{%s}%s' % (cls.c_namespace, cls.c_tag)
+        return QNAMES[cls]
+
+
+def _member_names_ok(names):
+    for name in names:
+        if not IDENTIFIER.match(name) or keyword.iskeyword(name):
+            return False
+    return True
+
+
+def _overrides(cls, method):
+    return getattr(cls, method).im_func is not \
+        getattr(SamlBase, method).im_func
+
+
+def _make_member(target_class, qname, tree):
+    if tree.tag == qname:
+        target = target_class()
+        target.harvest_element_tree(tree)
+        return target
+    return None
+
+
+def _compile(source, name, env):
+    code = compile(source, "<%s>" % name, "exec")
+    exec code in env
+    return env[name]
+
+
+def compile_parser(cls):
+    """ Generate a function that does what harvest_element_tree does for
+    instances of the class.
+
+    :param cls: A SamlBase subclass
+    :return: A function or None if the generic harvest_element_tree has to
+        be used.
+    """
+    if _overrides(cls, "_convert_element_tree_to_member") or _overrides(
+            cls, "_convert_element_attribute_to_member"):
+        return None
+
+    members = [m for m, _ in cls.c_children.values()]
+    members.extend([m for m, _, _ in cls.c_attributes.values()])
+    if not _member_names_ok(members):
+        return None
+
+    env = {"make": _make_member, "create": create_class_from_element_tree,
+           "ext": _extension_element_from_element_tree}
+    lines = ["def harvest(self, tree):", "    for child in tree:",
+             "        tag = child.tag"]
+    cond = "if"
+    for i, (tag, (member, member_class)) in enumerate(
+            cls.c_children.items()):
+        lines.append("        %s tag == %r:" % (cond, tag))
+        cond = "elif"
+        if isinstance(member_class, list):
+            member_class = member_class[0]
+            append = True
+        else:
+            append = False
+        env["C%d" % i] = member_class
+        try:
+            env["Q%d" % i] = qualified_tag(member_class)
+        except AttributeError:  # Not a class, leave it to create
+            _make = "create(C%d, child)" % i
+        else:
+            _make = "make(C%d, Q%d, child)" % (i, i)
+
+        if append:
+            lines.extend([
+                "            if self.%s is None:" % member,
+                "                self.%s = []" % member,
+                "            self.%s.append(%s)" % (member, _make)])
+        else:
+            lines.append("            self.%s = %s" % (member, _make))
+    if cls.c_children:
+        lines.append("        else:")
+        lines.append("            self.extension_elements.append(ext(child))")
+    else:
+        lines.append("        self.extension_elements.append(ext(child))")
+
+    lines.append("    for attribute, value in tree.attrib.iteritems():")
+    cond = "if"
+    for attribute, (member, _, _) in cls.c_attributes.items():
+        lines.append("        %s attribute == %r:" % (cond, attribute))
+        lines.append("            self.%s = value" % member)
+        cond = "elif"
+    if cls.c_attributes:
+        lines.append("        else:")
+        lines.append("            self.extension_attributes[attribute] = value")
+    else:
+        lines.append("        self.extension_attributes[attribute] = value")
+    lines.append("    self.text = tree.text")
+
+    return _compile("\n".join(lines) + "\n", "harvest", env)
+
+
+def compile_serializer(cls):
+    """ Generate a function that does what _add_members_to_element_tree
+    does for instances of the class.
+
+    :param cls: A SamlBase subclass
+    :return: A function or None if the generic way of adding the members
+        has to be used.
+    """
+    if cls.c_child_order:
+        children = cls.c_child_order[:]
+    else:
+        children = [m for m, _ in cls.c_children.values()]
+    attributes = [(a, m) for a, (m, _, _) in cls.c_attributes.items()]
+    if not _member_names_ok(children + [m for _, m in attributes]):
+        return None
+
+    lines = ["def add_members(self, tree):"]
+    for member in children:
+        lines.extend([
+            "    member = self.%s" % member,
+            "    if member is None:",
+            "        pass",
+            "    elif isinstance(member, list):",
+            "        for instance in member:",
+            "            instance.become_child_element_of(tree)",
+            "    else:",
+            "        member.become_child_element_of(tree)"])
+    if attributes:
+        lines.append("    attrib = tree.attrib")
+    for attribute, member in attributes:
+        lines.extend([
+            "    if self.%s is not None:" % member,
+            "        attrib[%r] = self.%s" % (attribute, member)])
+    if COMPACT:  # Don't allocate extension containers just to look at them
+        lines.extend([
+            "    for child in self._extension_elements or []:",
+            "        child.become_child_element_of(tree)",
+            "    if self._extension_attributes:",
+            "        for attribute, value in "
+            "self._extension_attributes.iteritems():",
+            "            tree.attrib[attribute] = value"])
+    else:
+        lines.extend([
+            "    for child in self.extension_elements:",
+            "        child.become_child_element_of(tree)",
+            "    for attribute, value in "
+            "self.extension_attributes.iteritems():",
+            "        tree.attrib[attribute] = value"])
+    lines.append("    tree.text = self.text")
+
+    return _compile("\n".join(lines) + "\n", "add_members", {})
+
+
+# ----------------------------------------------------------------------------
+# Lazily parsed instances keep the ElementTree nodes of their children in
+# _lazy, {member name: (member class, [nodes])}, and not the member itself.
+# When a member is asked for, SamlBase.__getattr__ converts the nodes.
+
+
+class _Pending(dict):
+    """ What _lazy holds. checked is set when valid_instance has been through
+    the instance, the members that were left out then are validated as they
+    are built. """
+    checked = False
+
+
+if COMPACT:
+    def _pending(inst):
+        try:
+            return object.__getattribute__(inst, "_lazy")
+        except AttributeError:
+            return None
+
+    def _unset(inst, name):
+        try:
+            object.__getattribute__(inst, name)
+        except AttributeError:
+            return True
+        return False
+else:
+    def _pending(inst):
+        return inst.__dict__.get("_lazy")
+
+    def _unset(inst, name):
+        return name not in inst.__dict__
+
+
+def _lazy_member(target_class, tree):
+    return create_class_from_element_tree(target_class, tree, lazy=True)
+
+
 class SamlBase(ExtensionContainer):
     """A foundation class on which SAML classes are built. It 
     handles the parsing of attributes and children which are common to all
@@ -447,6 +794,10 @@ class SamlBase(ExtensionContainer):
     c_any = None
     c_any_attribute = None
     c_value_type = None
+    # Instance attributes, other than the members described above, that
+    # the methods of the class set. Only needed for the __slots__ of
+    # compact instances.
+    c_extra_members = ["_lazy"]
     
     def _get_all_c_children_with_order(self):
         if len(self.c_child_order) > 0:
@@ -456,6 +807,117 @@ class SamlBase(ExtensionContainer):
             for _, values in self.__class__.c_children.iteritems():
                 yield values[0]
         
+    def harvest_lazily(self, tree):
+        """ Like harvest_element_tree but the children are left as they are
+        until they are needed """
+        cls = self.__class__
+        if cls.harvest_element_tree.im_func is not \
+                SamlBase.harvest_element_tree.im_func or \
+                _overrides(cls, "_convert_element_tree_to_member"):
+            return self.harvest_element_tree(tree)
+
+        pending = _Pending()
+        for child in tree:
+            try:
+                member, member_class = cls.c_children[child.tag]
+            except KeyError:
+                self.extension_elements.append(
+                    _extension_element_from_element_tree(child))
+            else:
+                try:
+                    pending[member][1].append(child)
+                except KeyError:
+                    pending[member] = (member_class, [child])
+        for attribute, value in tree.attrib.iteritems():
+            self._convert_element_attribute_to_member(attribute, value)
+        self.text = tree.text
+
+        if pending:
+            for member in pending:
+                try:
+                    delattr(self, member)
+                except AttributeError:
+                    pass
+            self._lazy = pending
+
+    def _pop_pending(self, name):
+        pending = _pending(self)
+        member_class, nodes = pending.pop(name)
+        if not pending:
+            del self._lazy
+        return member_class, nodes
+
+    def __getattr__(self, name):
+        # Only called when an attribute isn't found, which is what happens
+        # when a child of a lazily parsed instance is used the first time.
+        pending = _pending(self)
+        if not pending or name not in pending:
+            if COMPACT:
+                try:
+                    return object.__getattribute__(self, "_extra")[name]
+                except (AttributeError, KeyError):
+                    pass
+            raise AttributeError("'%s' object has no attribute '%s'" % (
+                self.__class__.__name__, name))
+
+        member_class, nodes = pending[name]
+        if isinstance(member_class, list):
+            value = [_lazy_member(member_class[0], n) for n in nodes]
+            if pending.checked:
+                for item in value:
+                    _valid_instance(self, item)
+        else:
+            value = _lazy_member(member_class, nodes[-1])
+            if pending.checked and value is not None:
+                _valid_instance(self, value)
+        self._pop_pending(name)
+        setattr(self, name, value)
+        return value
+
+    def _unbuilt(self):
+        """ The children that are still XML, for valid_instance. Those are
+        validated when they are built from now on.
+
+        :return: {member name: (member class, [nodes])} or None
+        """
+        pending = _pending(self)
+        if not pending:
+            return None
+        pending.checked = True
+        return dict([(name, val) for name, val in pending.items()
+                     if _unset(self, name)])
+
+    def _materialize(self):
+        """ Convert all the children that are still XML """
+        pending = _pending(self)
+        while pending:
+            name = pending.keys()[0]
+            if _unset(self, name):
+                getattr(self, name)
+            else:  # Has been given a new value
+                self._pop_pending(name)
+            pending = _pending(self)
+
+    def _member_items(self):
+        self._materialize()
+        return ExtensionContainer._member_items(self)
+
+    if not COMPACT:
+        def __getstate__(self):
+            self._materialize()
+            return self.__dict__
+
+    def harvest_element_tree(self, tree):
+        try:
+            parser = PARSERS[self.__class__]
+        except KeyError:
+            parser = PARSERS[self.__class__] = compile_parser(self.__class__)
+
+        if parser is None:
+            ExtensionContainer.harvest_element_tree(self, tree)
+        else:
+            parser(self, tree)
+
     def _convert_element_tree_to_member(self, child_tree):
         # Find the element's tag in this class's list of child members
         if child_tree.tag in self.__class__.c_children:
@@ -490,6 +952,19 @@ class SamlBase(ExtensionContainer):
 
     # Three methods to create an ElementTree from an object
     def _add_members_to_element_tree(self, tree):
+        try:
+            serializer = SERIALIZERS[self.__class__]
+        except KeyError:
+            serializer = SERIALIZERS[self.__class__] = compile_serializer(
+                self.__class__)
+
+        self._materialize()
+        if serializer is None:
+            self._generic_add_members_to_element_tree(tree)
+        else:
+            serializer(self, tree)
+
+    def _generic_add_members_to_element_tree(self, tree):
         # Convert the members of this class which are XML child nodes. 
         # This uses the class's c_children dictionary to find the members which
         # should become XML child nodes.
@@ -533,8 +1008,7 @@ class SamlBase(ExtensionContainer):
         should not be called on in this class.
 
         """
-        new_tree = ElementTree.Element('{%s}%s' % (self.__class__.c_namespace,
-                                                   self.__class__.c_tag))
+        new_tree = ElementTree.Element(qualified_tag(self.__class__))
         self._add_members_to_element_tree(new_tree)
         return new_tree
 
@@ -545,6 +1019,9 @@ class SamlBase(ExtensionContainer):
             constructing the text representation.
         :return: String representation of the object
         """
+        if DIRECT_WRITE:
+            return _write(self, nspair)
+
         if nspair:
             for prefix, uri in nspair.items():
                 try:
@@ -563,7 +1040,7 @@ class SamlBase(ExtensionContainer):
         
         :return: list of keys
         """
-        return [key for key, val in self.__dict__.items() if val]
+        return [key for key, val in self._member_items() if val]
 
     def keys(self):
         """ Return all the keys that represent possible attributes and 
@@ -690,8 +1167,8 @@ class SamlBase(ExtensionContainer):
         for key in self.keyswv():
             if key in ["_extatt"]:
                 continue
-            svals = self.__dict__[key]
-            ovals = other.__dict__[key]
+            svals = getattr(self, key)
+            ovals = getattr(other, key)
             if isinstance(svals, basestring):
                 if svals != ovals:
                     return False
@@ -751,6 +1228,343 @@ class SamlBase(ExtensionContainer):
     def verify(self):
         return valid_instance(self)
 
+
+# ----------------------------------------------------------------------------
+# Writing XML straight from the instances. The result is what
+# ElementTree.tostring(instance._to_element_tree(), encoding="UTF-8") gives,
+# prefixes and all, but no tree is built and no second pass over it is
+# needed to find the namespaces.
+
+try:
+    from xml.etree.ElementTree import _escape_attrib
+    from xml.etree.ElementTree import _escape_cdata
+    from xml.etree.ElementTree import _namespace_map
+except ImportError:
+    _namespace_map = None
+
+ENCODING = "UTF-8"
+# The pure python ElementTree is the one whose output is copied
+DIRECT_WRITE = _namespace_map is not None and \
+    getattr(ElementTree, "_namespace_map", None) is _namespace_map
+
+# Extension elements can have any names, so there is a limit to how many
+# are remembered
+MAX_CACHED_NAMES = 4096
+# {namespace}tag -> (namespace, tag)
+QNAME_PARTS = {}
+# (prefix, tag) -> prefix:tag
+PREFIXED = {}
+# class -> (child members, [(xml attribute, member)]) or None
+LAYOUTS = {}
+# The same for the classes whose instances are written like the ElementTree
+# node they are made from, None for the other classes
+NODE_LAYOUTS = {}
+
+
+def _layout(cls):
+    for method in ["_add_members_to_element_tree", "_to_element_tree",
+                   "become_child_element_of"]:
+        if _overrides(cls, method):
+            return None
+
+    if cls.c_child_order:
+        children = cls.c_child_order[:]
+    else:
+        children = [m for m, _ in cls.c_children.values()]
+    attributes = [(a, m) for a, (m, _, _) in cls.c_attributes.items()]
+    return children, attributes
+
+
+def _node_layout(cls):
+    """ The layout of a class if the ElementTree node that a lazily parsed
+    instance keeps for a member of the class can be written instead of the
+    member """
+    layout = _layout(cls)
+    if layout is None or \
+            cls.harvest_element_tree.im_func is not \
+            SamlBase.harvest_element_tree.im_func or \
+            _overrides(cls, "_convert_element_tree_to_member") or \
+            _overrides(cls, "_convert_element_attribute_to_member") or \
+            cls.__setattr__ != SamlBase.__setattr__:
+        return None
+
+    # Nothing that isn't in the node may be set by the constructor
+    inst = cls()
+    children, attributes = layout
+    if inst.text or inst.extension_elements or inst.extension_attributes:
+        return None
+    for member in children + [m for _, m in attributes]:
+        if getattr(inst, member) not in [None, []]:
+            return None
+    return layout
+
+
+class XMLWriter(object):
+    """ Writes SAML class instances, extension elements and ElementTree
+    elements as XML """
+
+    def __init__(self, nspair=None):
+        self.out = ["<?xml version='1.0' encoding='%s'?>\n" % ENCODING]
+        # namespace -> prefix, for the namespaces used in the document
+        self.namespaces = {}
+        # {namespace}tag -> prefix:tag
+        self.qnames = {}
+        self.root = None
+        if nspair:
+            # Like register_namespace but only for this document
+            self.namespace_map = dict(
+                [(u, p) for u, p in _namespace_map.items()
+                 if p not in nspair and u not in nspair.values()])
+            for prefix, uri in nspair.items():
+                self.namespace_map[uri] = prefix
+        else:
+            self.namespace_map = _namespace_map
+
+    def qname(self, tag):
+        try:
+            return self.qnames[tag]
+        except KeyError:
+            pass
+
+        try:
+            uri, local = QNAME_PARTS[tag]
+        except KeyError:
+            if tag[:1] == "{":
+                uri, local = tag[1:].rsplit("}", 1)
+            else:
+                uri, local = None, tag
+            if len(QNAME_PARTS) < MAX_CACHED_NAMES:
+                QNAME_PARTS[tag] = (uri, local)
+
+        if uri is None:
+            prefix = ""
+        else:
+            prefix = self.namespaces.get(uri)
+            if prefix is None:
+                prefix = self.namespace_map.get(uri)
+                if prefix is None:
+                    prefix = "ns%d" % len(self.namespaces)
+                if prefix != "xml":
+                    self.namespaces[uri] = prefix
+
+        try:
+            name = PREFIXED[(prefix, local)]
+        except KeyError:
+            if prefix:
+                name = ("%s:%s" % (prefix, local)).encode(ENCODING)
+            else:
+                name = local.encode(ENCODING)
+            if len(PREFIXED) < MAX_CACHED_NAMES:
+                PREFIXED[(prefix, local)] = name
+        self.qnames[tag] = name
+        return name
+
+    def _start(self, tag, attrib):
+        out = self.out
+        qnames = self.qnames
+        name = qnames.get(tag) or self.qname(tag)
+        out.append("<" + name)
+        if self.root is None:
+            # The namespace declarations go here when all are known
+            self.root = len(out)
+            out.append("")
+        if attrib:
+            # New prefixes are handed out in the order ElementTree does it
+            for key in attrib:
+                if key not in qnames:
+                    self.qname(key)
+            for key, value in sorted(attrib.items()):
+                out.append(' %s="%s"' % (qnames[key],
+                                         _escape_attrib(value, ENCODING)))
+        out.append(None)
+        return name, len(out)
+
+    def _end(self, name, mark):
+        out = self.out
+        if len(out) == mark:
+            out[mark - 1] = " />"
+        else:
+            out[mark - 1] = ">"
+            out.append("</%s>" % name)
+
+    def element(self, elem):
+        """ An ElementTree element and everything below it """
+        name, mark = self._start(elem.tag, elem.attrib)
+        if elem.text:
+            self.out.append(_escape_cdata(elem.text, ENCODING))
+        for child in elem:
+            self.element(child)
+        self._end(name, mark)
+        if elem.tail:
+            self.out.append(_escape_cdata(elem.tail, ENCODING))
+
+    def nodes(self, member_class, nodes):
+        """ A member of a lazily parsed instance that is still XML, written
+        without building it """
+        if isinstance(member_class, list):
+            for node in nodes:
+                self.node(member_class[0], node)
+        else:
+            self.node(member_class, nodes[-1])
+
+    def node(self, cls, elem):
+        """ What instance() writes for the instance that would be made of
+        the ElementTree node """
+        try:
+            layout = NODE_LAYOUTS[cls]
+        except KeyError:
+            layout = NODE_LAYOUTS[cls] = _node_layout(cls)
+        if layout is None:
+            inst = _lazy_member(cls, elem)
+            if inst is not None:
+                self.child(inst)
+            return
+        tag = elem.tag
+        if tag != qualified_tag(cls):
+            # No instance would be made of it
+            return
+
+        children, attributes = layout
+        attrib = elem.attrib
+        if attrib:
+            # Collected in the same order as instance() does it
+            attrib = {}
+            for attribute, _ in attributes:
+                value = elem.get(attribute)
+                if value is not None:
+                    attrib[attribute] = value
+            for attribute, value in elem.attrib.iteritems():
+                if attribute not in attrib:
+                    attrib[attribute] = value
+
+        name, mark = self._start(tag, attrib)
+        if elem.text:
+            self.out.append(_escape_cdata(elem.text, ENCODING))
+        if len(elem):
+            members = {}
+            extension_elements = []
+            c_children = cls.c_children
+            for child in elem:
+                try:
+                    member, member_class = c_children[child.tag]
+                except KeyError:
+                    extension_elements.append(child)
+                else:
+                    try:
+                        members[member][1].append(child)
+                    except KeyError:
+                        members[member] = (member_class, [child])
+
+            for member in children:
+                try:
+                    member_class, nodes = members[member]
+                except KeyError:
+                    continue
+                self.nodes(member_class, nodes)
+            for child in extension_elements:
+                self.extension_element(
+                    _extension_element_from_element_tree(child))
+        self._end(name, mark)
+
+    def _become_child(self, item):
+        holder = ElementTree.Element("")
+        item.become_child_element_of(holder)
+        for elem in holder:
+            self.element(elem)
+
+    def child(self, item):
+        if isinstance(item, SamlBase):
+            self.instance(item)
+        elif item.__class__ is ExtensionElement and item.tag is not None:
+            self.extension_element(item)
+        else:
+            self._become_child(item)
+
+    def extension_element(self, item):
+        if item.namespace is not None:
+            tag = '{%s}%s' % (item.namespace, item.tag)
+        else:
+            tag = item.tag
+        attrib = {}
+        for key, value in item.attributes.iteritems():
+            attrib[key] = value
+        name, mark = self._start(tag, attrib)
+        if item.text:
+            self.out.append(_escape_cdata(item.text, ENCODING))
+        for child in item.children:
+            self.child(child)
+        self._end(name, mark)
+
+    def instance(self, inst):
+        """ A SAML class instance and everything below it """
+        cls = inst.__class__
+        try:
+            layout = LAYOUTS[cls]
+        except KeyError:
+            layout = LAYOUTS[cls] = _layout(cls)
+        if layout is None:
+            return self._become_child(inst)
+
+        children, attributes = layout
+        values = [getattr(inst, member) for _, member in attributes]
+        attrib = {}
+        for (attribute, _), value in zip(attributes, values):
+            if value is not None:
+                attrib[attribute] = value
+        if COMPACT:
+            extension_attributes = inst._extension_attributes
+            extension_elements = inst._extension_elements
+        else:
+            extension_attributes = inst.extension_attributes
+            extension_elements = inst.extension_elements
+        if extension_attributes:
+            for attribute, value in extension_attributes.iteritems():
+                attrib[attribute] = value
+        text = inst.text
+        pending = _pending(inst)
+        if pending:
+            # Children that are still XML are written from their nodes,
+            # (member class, [nodes]) takes the place of the member
+            members = [pending[member] if member in pending and
+                       _unset(inst, member) else getattr(inst, member)
+                       for member in children]
+        else:
+            members = [getattr(inst, member) for member in children]
+
+        name, mark = self._start(qualified_tag(cls), attrib)
+        if text:
+            self.out.append(_escape_cdata(text, ENCODING))
+        for value in members:
+            if value is None:
+                continue
+            elif isinstance(value, list):
+                for item in value:
+                    self.child(item)
+            elif value.__class__ is tuple:
+                self.nodes(*value)
+            else:
+                self.child(value)
+        if extension_elements:
+            for item in extension_elements:
+                self.child(item)
+        self._end(name, mark)
+
+    def getvalue(self):
+        if self.root is not None:
+            self.out[self.root] = "".join([
+                ' xmlns%s="%s"' % (prefix and ":" + prefix,
+                                   _escape_attrib(uri, ENCODING))
+                for uri, prefix in sorted(self.namespaces.items(),
+                                          key=lambda x: x[1])])
+        return "".join(self.out)
+
+
+def _write(inst, nspair=None):
+    writer = XMLWriter(nspair)
+    writer.instance(inst)
+    return writer.getvalue()
+
+
 # ----------------------------------------------------------------------------
 
 
@@ -780,6 +1594,25 @@ def element_to_extension_element(element):
     return exel
     
 
+def _translation_class(function, namespace, tag):
+    """ Find the class a string-to-element translation function
+    instantiates by looking in the schema module it was defined in.
+
+    :return: A class or None if it can't be determined
+    """
+    try:
+        cls = sys.modules[function.__module__].ELEMENT_BY_TAG[tag]
+    except (AttributeError, KeyError):
+        return None
+
+    try:
+        if cls.c_namespace == namespace and cls.c_tag == tag:
+            return cls
+    except AttributeError:
+        pass
+    return None
+
+
 def extension_element_to_element(extension_element, translation_functions,
                                  namespace=None):
     """ Convert an extension element to a normal element.
@@ -800,10 +1633,20 @@ def extension_element_to_element(extension_element, translation_functions,
     if element_namespace == namespace:
         try:
             try:
-                ets = translation_functions[extension_element.tag]
+                tag = extension_element.tag
             except AttributeError:
-                ets = translation_functions[extension_element.c_tag]
-            return ets(extension_element.to_string())
+                tag = extension_element.c_tag
+            ets = translation_functions[tag]
+            # If the class is known the element can be built from a tree,
+            # no need to serialize and then parse the XML again
+            cls = _translation_class(ets, element_namespace, tag)
+            if cls is None:
+                return ets(extension_element.to_string())
+            elif isinstance(extension_element, ExtensionElement):
+                tree = extension_element.transfer_to_element_tree()
+            else:
+                tree = extension_element._to_element_tree()
+            return create_class_from_element_tree(cls, tree)
         except KeyError:
             pass
             
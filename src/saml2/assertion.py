@@ -644,7 +644,8 @@ class Assertion(dict):
 
         if encrypt == "attributes":
             for attr in attr_statement.attribute:
-                enc = sec_context.encrypt(text="%s" % attr)
+                enc = sec_context.encrypt(text="%s" % attr,
+                                          entity_id=sp_entity_id)
 
                 encd = xmlenc.encrypted_data_from_string(enc)
                 encattr = saml.EncryptedAttribute(encrypted_data=encd)
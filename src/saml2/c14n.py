@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+XML canonicalization (Canonical XML 1.0 and Exclusive XML Canonicalization
+1.0) as used by XML Signature.
+
+ElementTree throws away the namespace prefixes and namespace declarations
+of the parsed document, both of which are needed to reproduce the exact
+octet stream a signature was computed over. This module therefore comes
+with its own minimal tree, built directly on top of expat, that keeps
+that information around.
+"""
+
+from xml.parsers import expat
+
+XML_NAMESPACE = "http://www.w3.org/XML/1998/namespace"
+
+
+class ParseError(Exception):
+    pass
+
+
+class Comment(object):
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+
+class ProcessingInstruction(object):
+    __slots__ = ("target", "data")
+
+    def __init__(self, target, data):
+        self.target = target
+        self.data = data
+
+
+class Element(object):
+    """ An XML element that remembers how it was written.
+
+    :ivar qname: The tag as it appeared in the document ('ns0:Response')
+    :ivar tag: The tag in Clark notation ('{urn:...:protocol}Response')
+    :ivar attrib: Attribute values keyed by Clark notation name
+    :ivar qnames: Attribute names as they appeared in the document, keyed
+        by Clark notation name
+    :ivar nsdecl: Namespace declarations made on this element, prefix to uri
+        with '' representing the default namespace
+    :ivar nsmap: All namespaces in scope for this element
+    :ivar children: Child elements, text (unicode), comments and processing
+        instructions in document order
+    """
+
+    __slots__ = ("qname", "tag", "attrib", "qnames", "nsdecl", "nsmap",
+                 "children", "parent")
+
+    def __init__(self, qname, tag, attrib, qnames, nsdecl, nsmap,
+                 parent=None):
+        self.qname = qname
+        self.tag = tag
+        self.attrib = attrib
+        self.qnames = qnames
+        self.nsdecl = nsdecl
+        self.nsmap = nsmap
+        self.children = []
+        self.parent = parent
+
+    def __repr__(self):
+        return "<Element %s at 0x%x>" % (self.tag, id(self))
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+    def elements(self):
+        return [c for c in self.children if isinstance(c, Element)]
+
+    def find(self, tag):
+        for child in self.children:
+            if isinstance(child, Element) and child.tag == tag:
+                return child
+        return None
+
+    def findall(self, tag):
+        return [c for c in self.children
+                if isinstance(c, Element) and c.tag == tag]
+
+    def iter(self, tag=None):
+        """ Depth first, document order, iteration over this element and
+        all its descendants. """
+        stack = [self]
+        while stack:
+            elem = stack.pop()
+            if tag is None or elem.tag == tag:
+                yield elem
+            stack.extend([c for c in reversed(elem.children)
+                          if isinstance(c, Element)])
+
+    @property
+    def text(self):
+        return u"".join([c for c in self.children if isinstance(c, unicode)])
+
+
+class _TreeBuilder(object):
+    def __init__(self):
+        self.root = None
+        self.stack = []
+
+    def start(self, qname, attrs):
+        if self.stack:
+            parent = self.stack[-1]
+            nsmap = parent.nsmap
+        else:
+            parent = None
+            nsmap = {"xml": XML_NAMESPACE}
+
+        nsdecl = {}
+        plain = []
+        for i in range(0, len(attrs), 2):
+            name = attrs[i]
+            if name == "xmlns":
+                nsdecl[""] = attrs[i + 1]
+            elif name.startswith("xmlns:"):
+                nsdecl[name[6:]] = attrs[i + 1]
+            else:
+                plain.append((name, attrs[i + 1]))
+
+        if nsdecl:
+            nsmap = nsmap.copy()
+            nsmap.update(nsdecl)
+
+        attrib = {}
+        qnames = {}
+        for name, value in plain:
+            if ":" in name:
+                key = _clark(name, nsmap)
+            else:
+                key = name
+            attrib[key] = value
+            qnames[key] = name
+
+        elem = Element(qname, _clark(qname, nsmap, True), attrib, qnames,
+                       nsdecl, nsmap, parent)
+        if parent is None:
+            self.root = elem
+        else:
+            parent.children.append(elem)
+        self.stack.append(elem)
+
+    def end(self, _qname):
+        self.stack.pop()
+
+    def data(self, text):
+        if self.stack:
+            self.stack[-1].children.append(text)
+
+    def comment(self, text):
+        if self.stack:
+            self.stack[-1].children.append(Comment(text))
+
+    def pi(self, target, data):
+        if self.stack:
+            self.stack[-1].children.append(ProcessingInstruction(target, data))
+
+    def doctype(self, *_args):
+        raise ParseError("Document type declarations are not allowed")
+
+
+def _clark(qname, nsmap, use_default=False):
+    try:
+        prefix, local = qname.split(":", 1)
+    except ValueError:
+        if use_default and nsmap.get(""):
+            return "{%s}%s" % (nsmap[""], qname)
+        return qname
+
+    try:
+        return "{%s}%s" % (nsmap[prefix], local)
+    except KeyError:
+        raise ParseError("Unbound namespace prefix '%s'" % prefix)
+
+
+def parse(xmlstr):
+    """ Parse a XML document into a tree of Element instances.
+
+    :param xmlstr: The XML document as a string
+    :return: The root Element
+    """
+    builder = _TreeBuilder()
+    parser = expat.ParserCreate()
+    parser.ordered_attributes = True
+    parser.buffer_text = True
+    parser.StartElementHandler = builder.start
+    parser.EndElementHandler = builder.end
+    parser.CharacterDataHandler = builder.data
+    parser.CommentHandler = builder.comment
+    parser.ProcessingInstructionHandler = builder.pi
+    parser.StartDoctypeDeclHandler = builder.doctype
+    try:
+        if isinstance(xmlstr, unicode):
+            xmlstr = xmlstr.encode("utf-8")
+        parser.Parse(xmlstr, True)
+    except expat.ExpatError, err:
+        raise ParseError("%s" % err)
+
+    if builder.root is None:
+        raise ParseError("No root element")
+    return builder.root
+
+
+def parse_fragment(xmlstr, nsmap=None):
+    """ Parse a piece of XML, which may consist of any number of elements
+    and text, as if it appeared in a context where the namespaces in nsmap
+    are declared.
+
+    :param xmlstr: The XML fragment as a string
+    :param nsmap: Namespaces in scope, prefix to uri
+    :return: The list of parsed Elements and text
+    """
+    if not isinstance(xmlstr, unicode):
+        xmlstr = xmlstr.decode("utf-8")
+    if xmlstr.startswith(u"<?xml"):
+        xmlstr = xmlstr[xmlstr.index(u"?>") + 2:]
+
+    decl = []
+    for prefix, uri in (nsmap or {}).items():
+        if prefix == "xml":
+            continue
+        elif prefix:
+            decl.append(u' xmlns:%s="%s"' % (prefix, _escape_attr(uri)))
+        else:
+            decl.append(u' xmlns="%s"' % _escape_attr(uri))
+
+    wrapper = parse(u"<fragment%s>%s</fragment>" % (u"".join(decl), xmlstr))
+    for child in wrapper.children:
+        if isinstance(child, Element):
+            child.parent = None
+    return wrapper.children
+
+# ---------------------------------------------------------------------------
+
+
+def _escape_text(text):
+    return text.replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(
+        u">", u"&gt;").replace(u"\r", u"&#xD;")
+
+
+def _escape_attr(text):
+    return text.replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(
+        u'"', u"&quot;").replace(u"\t", u"&#x9;").replace(
+        u"\n", u"&#xA;").replace(u"\r", u"&#xD;")
+
+
+def _attr_sort_key(key):
+    if key.startswith("{"):
+        uri, local = key[1:].split("}", 1)
+        return uri, local
+    return "", key
+
+
+def _prefix(qname):
+    if ":" in qname:
+        return qname.split(":", 1)[0]
+    return ""
+
+
+class _Canonicalizer(object):
+    def __init__(self, exclusive, with_comments, inclusive_prefixes,
+                 exclude):
+        self.exclusive = exclusive
+        self.with_comments = with_comments
+        self.exclude = exclude or ()
+        if inclusive_prefixes:
+            self.inclusive_prefixes = set(
+                ["" if p == "#default" else p for p in inclusive_prefixes])
+        else:
+            self.inclusive_prefixes = set()
+        self.out = []
+
+    def _namespaces(self, elem, rendered):
+        """ Figure out which namespace declarations to output for this
+        element, updates rendered in place. """
+        nsmap = elem.nsmap
+        if self.exclusive:
+            prefixes = set([_prefix(elem.qname)])
+            for qname in elem.qnames.values():
+                if ":" in qname:
+                    prefixes.add(_prefix(qname))
+            prefixes.discard("xml")
+            for prefix in self.inclusive_prefixes:
+                if prefix == "" or prefix in nsmap:
+                    prefixes.add(prefix)
+        else:
+            prefixes = set(nsmap.keys())
+            prefixes.discard("xml")
+            prefixes.add("")
+
+        res = []
+        for prefix in prefixes:
+            uri = nsmap.get(prefix, "")
+            if rendered.get(prefix, "") != uri:
+                res.append((prefix, uri))
+                rendered[prefix] = uri
+        res.sort()
+        return res
+
+    def _attributes(self, elem, apex):
+        attrs = [(_attr_sort_key(k), elem.qnames[k], v) for k, v in
+                 elem.attrib.items()]
+        if apex and not self.exclusive:
+            # C14N 1.0, attributes in the xml namespace are inherited by
+            # the apex of a document subset
+            _parent = elem.parent
+            present = set(elem.attrib.keys())
+            while _parent is not None:
+                for key, val in _parent.attrib.items():
+                    if key.startswith("{%s}" % XML_NAMESPACE) and \
+                            key not in present:
+                        present.add(key)
+                        attrs.append((_attr_sort_key(key),
+                                      _parent.qnames[key], val))
+                _parent = _parent.parent
+        attrs.sort()
+        return attrs
+
+    def element(self, elem, rendered, apex=False):
+        out = self.out
+        rendered = rendered.copy()
+        out.append(u"<")
+        out.append(elem.qname)
+        for prefix, uri in self._namespaces(elem, rendered):
+            if prefix:
+                out.append(u' xmlns:%s="%s"' % (prefix, _escape_attr(uri)))
+            else:
+                out.append(u' xmlns="%s"' % _escape_attr(uri))
+        for _, qname, value in self._attributes(elem, apex):
+            out.append(u' %s="%s"' % (qname, _escape_attr(value)))
+        out.append(u">")
+
+        for child in elem.children:
+            if isinstance(child, unicode):
+                out.append(_escape_text(child))
+            elif isinstance(child, Element):
+                if child not in self.exclude:
+                    self.element(child, rendered)
+            elif isinstance(child, Comment):
+                if self.with_comments:
+                    out.append(u"<!--%s-->" % child.text)
+            else:
+                if child.data:
+                    out.append(u"<?%s %s?>" % (child.target, child.data))
+                else:
+                    out.append(u"<?%s?>" % child.target)
+
+        out.append(u"</%s>" % elem.qname)
+
+
+def canonicalize(elem, exclusive=True, with_comments=False,
+                 inclusive_prefixes=None, exclude=None):
+    """ Canonicalize the document subset rooted at elem.
+
+    :param elem: The apex Element of the document subset
+    :param exclusive: Exclusive XML Canonicalization if True otherwise
+        Canonical XML 1.0
+    :param with_comments: Whether comments should be kept
+    :param inclusive_prefixes: Exclusive canonicalization only, prefixes
+        that should be treated according to inclusive canonicalization rules
+    :param exclude: Elements that should be left out of the output together
+        with all their descendants (e.g. an enveloped signature)
+    :return: The canonical form as a UTF-8 encoded string
+    """
+    canon = _Canonicalizer(exclusive, with_comments, inclusive_prefixes,
+                           exclude)
+    canon.element(elem, {"": ""}, apex=True)
+    return u"".join(canon.out).encode("utf-8")
+
+# ---------------------------------------------------------------------------
+
+
+def _serialize(elem, out):
+    out.append(u"<")
+    out.append(elem.qname)
+    for prefix, uri in sorted(elem.nsdecl.items()):
+        if prefix:
+            out.append(u' xmlns:%s="%s"' % (prefix, _escape_attr(uri)))
+        else:
+            out.append(u' xmlns="%s"' % _escape_attr(uri))
+    for _, qname, value in sorted([(_attr_sort_key(k), elem.qnames[k], v)
+                                   for k, v in elem.attrib.items()]):
+        out.append(u' %s="%s"' % (qname, _escape_attr(value)))
+
+    if not elem.children:
+        out.append(u"/>")
+        return
+
+    out.append(u">")
+    for child in elem.children:
+        if isinstance(child, unicode):
+            out.append(_escape_text(child))
+        elif isinstance(child, Element):
+            _serialize(child, out)
+        elif isinstance(child, Comment):
+            out.append(u"<!--%s-->" % child.text)
+        elif child.data:
+            out.append(u"<?%s %s?>" % (child.target, child.data))
+        else:
+            out.append(u"<?%s?>" % child.target)
+    out.append(u"</%s>" % elem.qname)
+
+
+def tostring(elem, xml_declaration=True):
+    """ Serialize a tree, unlike canonicalize() the namespace declarations
+    are written where they appeared in the parsed document.
+
+    :param elem: The Element to start from
+    :param xml_declaration: Whether to start with a XML declaration
+    :return: The document as a UTF-8 encoded string
+    """
+    out = []
+    if xml_declaration:
+        out.append(u"<?xml version='1.0' encoding='UTF-8'?>\n")
+    _serialize(elem, out)
+    return u"".join(out).encode("utf-8")
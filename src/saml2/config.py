@@ -29,15 +29,23 @@ from saml2.extension import mdui
 from saml2.extension import idpdisc
 from saml2.extension import dri
 from saml2.extension import mdattr
+from saml2.extension import mdrpi
 from saml2.extension import ui
 import xmldsig
 import xmlenc
 
 
+# The largest messages, and HTTP-Redirect or HTTP-POST payloads, that are
+# accepted unless the configuration says something else. A payload that is a
+# base64 encoded message of the largest size fits in MAX_COMPRESSED_SIZE.
+MAX_MESSAGE_SIZE = 200000
+MAX_COMPRESSED_SIZE = 300000
+
 ONTS = {
     saml.NAMESPACE: saml,
     mdui.NAMESPACE: mdui,
     mdattr.NAMESPACE: mdattr,
+    mdrpi.NAMESPACE: mdrpi,
     dri.NAMESPACE: dri,
     ui.NAMESPACE: ui,
     idpdisc.NAMESPACE: idpdisc,
@@ -60,7 +68,13 @@ COMMON_ARGS = [
     "disable_ssl_certificate_validation",
     "referred_binding",
     "session_storage",
-    "entity_category"
+    "entity_category",
+    "crypto_backend",
+    "signing_daemon",
+    "encrypt_key_type",
+    "max_message_size",
+    "max_compressed_size",
+    "metadata_snapshot"
 ]
 
 SP_ARGS = [
@@ -191,6 +205,11 @@ class Config(object):
         self.name_qualifier = ""
         self.entity_category = ""
         self.crypto_backend = 'xmlsec1'
+        self.signing_daemon = None
+        self.encrypt_key_type = "des-192"
+        self.max_message_size = MAX_MESSAGE_SIZE
+        self.max_compressed_size = MAX_COMPRESSED_SIZE
+        self.metadata_snapshot = None
         self.scope = ""
 
     def setattr(self, context, attr, val):
@@ -341,7 +360,14 @@ class Config(object):
             ONTS.values(), acs, self, ca_certs,
             disable_ssl_certificate_validation=disable_validation)
 
+        if self.metadata_snapshot:
+            mds.load_snapshot(self.metadata_snapshot)
         mds.imp(metadata_conf)
+        if self.metadata_snapshot and mds.snapshot_stale():
+            try:
+                mds.dump_snapshot(self.metadata_snapshot)
+            except (IOError, OSError), exc:
+                logger.warning("Couldn't write metadata snapshot: %s", exc)
 
         return mds
 
@@ -29,6 +29,7 @@ from saml2.s_utils import error_status_factory
 from saml2.s_utils import rndstr
 from saml2.s_utils import success_status_factory
 from saml2.s_utils import decode_base64_and_inflate
+from saml2.s_utils import MessageTooLarge
 from saml2.s_utils import UnsupportedBinding
 from saml2.samlp import AuthnRequest, AuthzDecisionQuery, AuthnQuery
 from saml2.samlp import AssertionIDRequest
@@ -40,7 +41,6 @@ from saml2.samlp import ArtifactResponse
 from saml2.samlp import Artifact
 from saml2.samlp import LogoutRequest
 from saml2.samlp import AttributeQuery
-from saml2.mdstore import destinations
 from saml2 import BINDING_HTTP_POST
 from saml2 import BINDING_HTTP_REDIRECT
 from saml2 import BINDING_SOAP
@@ -59,6 +59,9 @@ __author__ = 'rolandh'
 
 ARTIFACT_TYPECODE = '\x00\x04'
 
+# Why unravel() turns down a HTTP-Redirect or HTTP-POST payload
+DECODE_REJECTIONS = ["compressed_size", "decompressed_size", "malformed"]
+
 SERVICE2MESSAGE = {
     "single_sign_on_service": AuthnRequest,
     "attribute_service": AttributeQuery,
@@ -136,6 +139,12 @@ class Entity(HTTPBase):
         else:
             self.sourceid = {}
 
+        # reason -> number of payloads turned down by unravel()
+        self.decode_rejections = dict([(r, 0) for r in DECODE_REJECTIONS])
+        # The number of HTTP-Redirect and HTTP-POST payloads decoded and
+        # their total and largest size in bytes once decoded
+        self.decoded = {"messages": 0, "bytes": 0, "largest": 0}
+
     def _issuer(self, entityid=None):
         """ Return an Issuer instance """
         if entityid:
@@ -213,7 +222,7 @@ class Entity(HTTPBase):
             try:
                 srvs = sfunc(entity_id, binding, descr_type)
                 if srvs:
-                    return binding, destinations(srvs)[0]
+                    return binding, srvs[0]["location"]
             except UnsupportedBinding:
                 pass
 
@@ -287,18 +296,55 @@ class Entity(HTTPBase):
 
         return info
 
+    def _reject_payload(self, reason, exc):
+        self.decode_rejections[reason] += 1
+        logger.info("Payload turned down: %s" % exc)
+        raise exc
+
+    def _decode(self, txt, binding):
+        """ base64 decodes a HTTP-Redirect or HTTP-POST payload, and
+        inflates it if it's HTTP-Redirect. Payloads larger than
+        max_compressed_size, or that would become larger than
+        max_message_size, are turned down.
+        """
+        max_compressed_size = getattr(self.config, "max_compressed_size",
+                                      None)
+        max_size = getattr(self.config, "max_message_size", None)
+
+        if max_compressed_size and len(txt) > max_compressed_size:
+            self._reject_payload("compressed_size", MessageTooLarge(
+                "Payload larger than %d bytes" % max_compressed_size))
+
+        try:
+            if binding == BINDING_HTTP_REDIRECT:
+                xmlstr = decode_base64_and_inflate(txt, max_size or None)
+            else:
+                xmlstr = base64.b64decode(txt)
+        except MessageTooLarge, exc:
+            self._reject_payload("decompressed_size", exc)
+        except Exception, exc:
+            self._reject_payload("malformed", UnravelError("%s" % exc))
+
+        if max_size and len(xmlstr) > max_size:
+            self._reject_payload("decompressed_size", MessageTooLarge(
+                "Decodes to more than %d bytes" % max_size))
+
+        self.decoded["messages"] += 1
+        self.decoded["bytes"] += len(xmlstr)
+        if len(xmlstr) > self.decoded["largest"]:
+            self.decoded["largest"] = len(xmlstr)
+        return xmlstr
+
     def unravel(self, txt, binding, msgtype="response"):
         #logger.debug("unravel '%s'" % txt)
         if binding not in [BINDING_HTTP_REDIRECT, BINDING_HTTP_POST,
                            BINDING_SOAP, BINDING_URI, None]:
             raise ValueError("Don't know how to handle '%s'" % binding)
+        elif binding in [BINDING_HTTP_REDIRECT, BINDING_HTTP_POST]:
+            xmlstr = self._decode(txt, binding)
         else:
             try:
-                if binding == BINDING_HTTP_REDIRECT:
-                    xmlstr = decode_base64_and_inflate(txt)
-                elif binding == BINDING_HTTP_POST:
-                    xmlstr = base64.b64decode(txt)
-                elif binding == BINDING_SOAP:
+                if binding == BINDING_SOAP:
                     func = getattr(soap, "parse_soap_enveloped_saml_%s" % msgtype)
                     xmlstr = func(txt)
                 else:
@@ -339,7 +385,7 @@ class Entity(HTTPBase):
             mid = msg.id
 
         try:
-            to_sign.append([(class_name(msg), mid)])
+            to_sign.append((class_name(msg), mid))
         except AttributeError:
             to_sign = [(class_name(msg), mid)]
 
@@ -450,7 +496,7 @@ class Entity(HTTPBase):
         self._add_info(response, **kwargs)
 
         if sign:
-            self.sign(response, to_sign=to_sign)
+            return self.sign(response, to_sign=to_sign)
         elif to_sign:
             return signed_instance_factory(response, self.sec, to_sign)
         else:
@@ -790,7 +836,7 @@ class Entity(HTTPBase):
             if not xmlstr:  # Not a valid reponse
                 return None
 
-            logger.debug("XMLSTR: %s" % xmlstr)
+            logger.debug("XMLSTR: %s", xmlstr)
 
             try:
                 response = response.loads(xmlstr, False)
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
+from saml2 import create_class_from_element_tree
 from saml2 import element_to_extension_element
 from saml2 import extension_elements_to_elements
+from saml2 import ExtensionContainer
 from saml2 import SamlBase
 from saml2 import md
 
@@ -85,6 +87,126 @@ def to_dict(_dict, onts, mdb_safe=False):
     return res
 
 
+# From an ElementTree node directly to Python dictionary
+
+def _harvest_override(cls):
+    """ Classes that have their own way of picking up the XML can not be
+    converted directly """
+    return cls.harvest_element_tree.im_func is not \
+        ExtensionContainer.harvest_element_tree.im_func
+
+
+def _extension_class(tag, onts):
+    """
+    Find the class an extension element should be converted into, the same
+    way extension_elements_to_elements does it.
+
+    :param tag: The tag of the element, {namespace}tag format
+    :param onts: Schemas to be used in the conversion
+    :return: A class or None if no schema knows about this element
+    """
+    if not tag.startswith("{"):
+        return None
+    namespace, tag = tag[1:].split("}", 1)
+    for schema in onts:
+        if schema.NAMESPACE != namespace:
+            continue
+        if tag in schema.ELEMENT_FROM_STRING:
+            cls = schema.ELEMENT_BY_TAG[tag]
+            if cls.c_namespace == namespace and cls.c_tag == tag:
+                return cls
+    return None
+
+
+DEFAULTS = {}
+
+
+def _defaults(cls, mdb_safe):
+    """ The values a class instance gets from its constructor """
+    try:
+        return DEFAULTS[(cls, mdb_safe)]
+    except KeyError:
+        _dict = to_dict(cls(), [], mdb_safe)
+        del _dict["__class__"]
+        DEFAULTS[(cls, mdb_safe)] = _dict
+        return _dict
+
+
+def _tree_child(tree, cls, onts, mdb_safe):
+    if tree.tag != "{%s}%s" % (cls.c_namespace, cls.c_tag):
+        return None
+    return tree_to_dict(tree, cls, onts, mdb_safe)
+
+
+def tree_to_dict(tree, cls, onts, mdb_safe=False):
+    """
+    Convert an ElementTree node into the same basic dictionary format as
+    to_dict does, without first building pysaml2 class instances. Extension
+    elements are converted directly from the tree instead of being
+    serialized and parsed once more.
+
+    :param tree: The ElementTree node
+    :param cls: The pysaml2 class that describes the node
+    :param onts: List of schemas to use for the conversion
+    :return: The converted information
+    """
+    if _harvest_override(cls):
+        return to_dict(create_class_from_element_tree(cls, tree), onts,
+                       mdb_safe)
+
+    res = {}
+    for key, val in _defaults(cls, mdb_safe).items():
+        if isinstance(val, list):
+            res[key] = val[:]
+        else:
+            res[key] = val
+    _ext_elem = []
+    _ext_attr = {}
+    for child in tree:
+        try:
+            member, member_class = cls.c_children[child.tag]
+        except KeyError:
+            _cls = _extension_class(child.tag, onts)
+            if _cls:
+                _ext_elem.append(tree_to_dict(child, _cls, onts, mdb_safe))
+            continue
+
+        if isinstance(member_class, list):
+            try:
+                res[member].append(_tree_child(child, member_class[0], onts,
+                                               mdb_safe))
+            except KeyError:
+                res[member] = [_tree_child(child, member_class[0], onts,
+                                           mdb_safe)]
+        else:
+            res[member] = _tree_child(child, member_class, onts, mdb_safe)
+
+    for attribute, value in tree.attrib.iteritems():
+        try:
+            member = cls.c_attributes[attribute][0]
+        except KeyError:
+            _ext_attr[attribute] = value
+        else:
+            res[member] = value.strip()
+
+    if tree.text:
+        res["text"] = tree.text.strip()
+    if _ext_elem:
+        res["extension_elements"] = _ext_elem
+    if _ext_attr:
+        if mdb_safe:
+            _ext_attr = dict([(k.replace(".", "__"), v) for k, v in
+                              _ext_attr.items()])
+        res["extension_attributes"] = _ext_attr
+
+    if mdb_safe:
+        res = dict([(k.replace(".", "__"), v) for k, v in res.items() if v])
+    else:
+        res = dict([(k, v) for k, v in res.items() if v])
+    res["__class__"] = "%s&%s" % (cls.c_namespace, cls.c_tag)
+    return res
+
+
 # From Python dictionary to pysaml2 SAML2 metadata format
 
 def _kwa(val, onts, mdb_safe=False):
@@ -1,24 +1,38 @@
 import logging
+import marshal
+import mmap
+import os
+import struct
 import sys
 import json
 
 from hashlib import sha1
+from StringIO import StringIO
+from tempfile import NamedTemporaryFile
 from saml2.httpbase import HTTPBase
 from saml2.extension.idpdisc import BINDING_DISCO
 from saml2.extension.idpdisc import DiscoveryResponse
+from saml2.extension.mdrpi import RegistrationInfo
 
 from saml2.mdie import to_dict
+from saml2.mdie import tree_to_dict
 
 from saml2 import md, samlp
+from saml2 import xmlbackend
 from saml2 import BINDING_HTTP_REDIRECT
 from saml2 import BINDING_HTTP_POST
 from saml2 import BINDING_SOAP
 from saml2.s_utils import UnsupportedBinding, UnknownPrincipal
+from saml2.sigver import cert_fingerprint
+from saml2.sigver import cert_validity
 from saml2.sigver import split_len
+from saml2.validate import valid_element
 from saml2.validate import valid_instance
+from saml2.time_util import utc_now
 from saml2.time_util import valid
 from saml2.validate import NotValid
 from saml2.sigver import security_context
+from saml2.sigver import CERT_CACHE
 
 __author__ = 'rolandh'
 
@@ -48,6 +62,30 @@ REQ2SRV = {
 
 
 ENTITYATTRIBUTES = "urn:oasis:names:tc:SAML:metadata:attribute&EntityAttributes"
+ENTITY_CATEGORY = "http://macedir.org/entity-category"
+REGISTRATION_INFO = "%s&%s" % (RegistrationInfo.c_namespace,
+                               RegistrationInfo.c_tag)
+
+# What MetadataStore.query() can select entities by
+FACETS = ["role", "entity_category", "registration_authority",
+          "affiliation_member"]
+
+ENTITIES_DESCRIPTOR = "{%s}%s" % (md.EntitiesDescriptor.c_namespace,
+                                  md.EntitiesDescriptor.c_tag)
+ENTITY_DESCRIPTOR = "{%s}%s" % (md.EntityDescriptor.c_namespace,
+                                md.EntityDescriptor.c_tag)
+
+# What a metadata snapshot file starts with, the version is bumped whenever
+# what is in the file changes
+SNAPSHOT_MAGIC = "pysaml2 metadata snapshot\n"
+SNAPSHOT_VERSION = 1
+
+# A shared metadata file, see MetadataStore.publish(), starts with this
+# followed by the offset of the index as an unsigned 64 bit little-endian
+# integer
+SHARED_MAGIC = "pysaml2 shared metadata\n"
+SHARED_VERSION = 1
+SHARED_OFFSET = struct.Struct("<Q")
 
 # ---------------------------------------------------
 
@@ -85,6 +123,221 @@ def name(ent, langpref="en"):
     return None
 
 
+def _endpoint_rank(srv):
+    """ Endpoints marked as the default go first and those marked as not
+    being it last, the order is otherwise the one in the metadata. """
+    try:
+        is_default = srv["is_default"]
+    except KeyError:
+        return 1
+    if is_default in ["true", "1"]:
+        return 0
+    elif is_default in ["false", "0"]:
+        return 2
+    return 1
+
+
+def endpoint_table(ent):
+    """ Compile the endpoints of an entity into a table that the services
+    can be looked up in.
+
+    :param ent: An entity description as produced by to_dict
+    :return: A dictionary with the descriptor types (idpsso_descriptor, ...)
+        the entity has as keys. The values are dictionaries where
+        (service, binding) gives a list of the endpoints and (service, None)
+        a dictionary with the endpoints per binding. Endpoints in extension
+        elements are found with the class (namespace&tag) as service.
+    """
+    table = {}
+    for typ, descs in ent.items():
+        if not typ.endswith("_descriptor"):
+            continue
+        table[typ] = per_binding = {}
+        if not isinstance(descs, list):
+            continue
+        for desc in descs:
+            for service, srvs in desc.items():
+                if isinstance(srvs, list):
+                    for srv in srvs:
+                        if isinstance(srv, dict) and "binding" in srv:
+                            per_binding.setdefault(
+                                service, {}).setdefault(
+                                srv["binding"], []).append(srv)
+            try:
+                elems = desc["extensions"]["extension_elements"]
+            except KeyError:
+                continue
+            for elem in elems:
+                if "binding" in elem:
+                    per_binding.setdefault(elem["__class__"], {}).setdefault(
+                        elem["binding"], []).append(elem)
+
+        endpoints = {}
+        for service, bindings in per_binding.items():
+            for binding, srvs in bindings.items():
+                srvs.sort(key=_endpoint_rank)
+                endpoints[(service, binding)] = srvs
+            endpoints[(service, None)] = bindings
+        table[typ] = endpoints
+    return table
+
+
+# The descriptors that certificates are looked for in when the role doesn't
+# matter
+CERT_ROLES = ["spsso", "idpsso", "role", "authn_authority",
+              "attribute_authority", "pdp"]
+
+
+def cert_table(ent):
+    """ Collect the certificates of an entity in a table where they can be
+    looked up by role and use.
+
+    :param ent: An entity description as produced by to_dict
+    :return: A dictionary with (role, use) as keys, role is one of
+        CERT_ROLES or "any" and use is "signing" or "encryption". The values
+        are lists of dictionaries, one per certificate, with the keys
+        "cert" (the base64 part of a PEM file, in 64 character lines),
+        "fingerprint" (SHA-1, hex), "use" (signing, encryption or None if
+        the metadata doesn't say) and "not_before" and "not_after" (seconds
+        since the epoch, None if the certificate can't be parsed).
+        A certificate with no specific use is listed under both uses.
+    """
+    table = {}
+    # (role, use, cert) already listed
+    listed = set()
+    for role in CERT_ROLES:
+        try:
+            descs = ent["%s_descriptor" % role]
+        except KeyError:
+            continue
+
+        for desc in descs:
+            for key in desc.get("key_descriptor", []):
+                use = key.get("use")
+                if use is None:
+                    uses = ["signing", "encryption"]
+                else:
+                    uses = [use]
+                for dat in key.get("key_info", {}).get("x509_data", []):
+                    try:
+                        text = dat["x509_certificate"]["text"]
+                    except KeyError:
+                        continue
+                    cert = "\n".join(split_len("".join(text.split()), 64))
+                    info = None
+                    for _use in uses:
+                        for _role in [role, "any"]:
+                            if (_role, _use, cert) in listed:
+                                continue
+                            listed.add((_role, _use, cert))
+                            if info is None:
+                                info = _cert_info(cert, use)
+                            table.setdefault((_role, _use), []).append(info)
+    return table
+
+
+def _cert_info(cert, use):
+    info = {"cert": cert, "fingerprint": None, "use": use,
+            "not_before": None, "not_after": None}
+    try:
+        info["fingerprint"] = cert_fingerprint(cert)
+        info["not_before"], info["not_after"] = cert_validity(cert)
+    except (TypeError, ValueError), exc:
+        logger.warning("Can't parse certificate: %s", exc)
+    return info
+
+
+def cert_active(info, now=None):
+    """ Whether a certificate, as described in a cert_table() entry, is
+    valid right now. One that can't be parsed is given the benefit of the
+    doubt.
+    """
+    if info["not_after"] is None:
+        return True
+    if now is None:
+        now = utc_now()
+    return info["not_before"] <= now < info["not_after"]
+
+
+def entity_facets(ent):
+    """ What an entity can be selected by in MetadataStore.query()
+
+    :param ent: An entity description as produced by to_dict
+    :return: A dictionary with the FACETS as keys and lists of values.
+        The roles are the descriptors the entity has, idpsso, spsso and
+        so on.
+    """
+    res = dict([(facet, []) for facet in FACETS])
+    for key in ent.keys():
+        if key.endswith("_descriptor"):
+            res["role"].append(key[:-len("_descriptor")])
+
+    try:
+        elems = ent["extensions"]["extension_elements"]
+    except KeyError:
+        elems = []
+    for elem in elems:
+        if elem["__class__"] == ENTITYATTRIBUTES:
+            for attr in elem.get("attribute", []):
+                if attr.get("name") == ENTITY_CATEGORY:
+                    res["entity_category"].extend(
+                        [v["text"] for v in attr.get("attribute_value", [])
+                         if "text" in v])
+        elif elem["__class__"] == REGISTRATION_INFO:
+            try:
+                res["registration_authority"].append(
+                    elem["registration_authority"])
+            except KeyError:
+                pass
+
+    try:
+        members = ent["affiliation_descriptor"]["affiliate_member"]
+    except (KeyError, TypeError):
+        pass
+    else:
+        res["affiliation_member"] = [m["text"] for m in members]
+    return res
+
+
+def file_hash(filename):
+    """ :return: The SHA-1 of the content of a file, as a hex string """
+    digest = sha1()
+    fil = open(filename, "rb")
+    try:
+        while True:
+            data = fil.read(65536)
+            if not data:
+                break
+            digest.update(data)
+    finally:
+        fil.close()
+    return digest.hexdigest()
+
+
+def _atomic_write(filename, chunks, mode=None):
+    """ Write a file by writing a temporary file next to it that then
+    replaces it. Those that have the old file open keep on seeing it.
+
+    :param filename: The name of the file
+    :param chunks: What the file should contain, a list of strings
+    :param mode: The permissions of the file if not only the owner should
+        be able to read it
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    tmp = NamedTemporaryFile(dir=directory, delete=False)
+    try:
+        for chunk in chunks:
+            tmp.write(chunk)
+        tmp.close()
+        if mode is not None:
+            os.chmod(tmp.name, mode)
+        os.rename(tmp.name, filename)
+    except Exception:
+        tmp.close()
+        os.unlink(tmp.name)
+        raise
+
+
 def repack_cert(cert):
     part = cert.split("\n")
     if len(part) == 1:
@@ -94,12 +347,75 @@ def repack_cert(cert):
         return "\n".join([s.strip() for s in part])
 
 
+class EntityMap(dict):
+    """ entity_id -> entity description, that counts the changes made to
+    it so MetadataStore can tell when its indexes are out of date """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.changes = 0
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.changes += 1
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.changes += 1
+
+    def clear(self):
+        dict.clear(self)
+        self.changes += 1
+
+    def pop(self, key, *default):
+        self.changes += 1
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        self.changes += 1
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        self.changes += 1
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self.changes += 1
+
+
 class MetaData(object):
     def __init__(self, onts, attrc, metadata=""):
         self.onts = onts
         self.attrc = attrc
-        self.entity = {}
+        self._entity = EntityMap()
+        # The number of times entity has been replaced
+        self._replaced = 0
         self.metadata = metadata
+        # entity_id -> (entity description, endpoint table, cert table,
+        #               facets)
+        self._compiled = {}
+        # SHA-1 of what the entities were loaded from, if it's known
+        self.source_hash = None
+        # (source hash, entities) from a snapshot, used by load() instead of
+        # parsing if the source hasn't changed
+        self.snapshot = None
+        self.restored = False
+
+    def _get_entity(self):
+        return self._entity
+
+    def _set_entity(self, entity):
+        self._entity = EntityMap(entity)
+        self._replaced += 1
+
+    # entity_id -> entity description
+    entity = property(_get_entity, _set_entity)
+
+    def generation(self):
+        """ Something that changes when entities are added, removed or
+        replaced. MetadataStore rebuilds its indexes when it does. """
+        return self._replaced, self._entity.changes
 
     def items(self):
         return self.entity.items()
@@ -116,23 +432,36 @@ class MetaData(object):
     def __getitem__(self, item):
         return self.entity[item]
 
-    def do_entity_descriptor(self, entity_descr):
-        try:
-            if not valid(entity_descr.valid_until):
-                logger.info("Entity descriptor (entity id:%s) to old" % (
-                    entity_descr.entity_id,))
-                return
-        except AttributeError:
-            pass
+    def do_entity_descriptor(self, entity_descr, tree=None):
+        """
+        :param entity_descr: A md.EntityDescriptor instance, or None if the
+            tree is given
+        :param tree: The ElementTree node the entity descriptor is described
+            by, if available the conversion is done directly from it.
+        """
+        if entity_descr is None:
+            entity_id = tree.get("entityID")
+            valid_until = tree.get("validUntil")
+        else:
+            entity_id = entity_descr.entity_id
+            valid_until = getattr(entity_descr, "valid_until", None)
+
+        if not valid(valid_until):
+            logger.info("Entity descriptor (entity id:%s) to old" % (
+                entity_id,))
+            return
 
         # have I seen this entity_id before ? If so if log: ignore it
-        if entity_descr.entity_id in self.entity:
+        if entity_id in self.entity:
             print >> sys.stderr,\
                 "Duplicated Entity descriptor (entity id: '%s')" %\
-                entity_descr.entity_id
+                entity_id
             return
 
-        _ent = to_dict(entity_descr, self.onts)
+        if tree is None:
+            _ent = to_dict(entity_descr, self.onts)
+        else:
+            _ent = tree_to_dict(tree, md.EntityDescriptor, self.onts)
         flag = 0
         # verify support for SAML2
         for descr in ["spsso", "idpsso", "role", "authn_authority",
@@ -159,93 +488,195 @@ class MetaData(object):
                 flag += 1
 
         if flag:
-            self.entity[entity_descr.entity_id] = _ent
+            self.entity[entity_id] = _ent
+            self._compile(entity_id, _ent)
+
+    def _restore(self, source_hash):
+        """ Take the entities from the snapshot if it was made from the same
+        source as the one that is about to be loaded.
+
+        :param source_hash: SHA-1 of the source
+        :return: True if the entities were restored
+        """
+        self.source_hash = source_hash
+        snapshot, self.snapshot = self.snapshot, None
+        if snapshot is None or snapshot[0] != source_hash:
+            return False
+
+        # Entities that have expired since the snapshot was made are left
+        # out, like they would be if the source was parsed
+        restored = []
+        try:
+            for entity_id, ent, endpoints, certs, facets in snapshot[1]:
+                if not valid(ent.get("valid_until")):
+                    logger.info("Entity descriptor (entity id:%s) to old",
+                                entity_id)
+                    continue
+                restored.append((entity_id, (ent, endpoints, certs, facets)))
+        except (ValueError, TypeError, AttributeError), exc:
+            logger.warning("Can't use the snapshot of a metadata source: %s",
+                           exc)
+            return False
+
+        for entity_id, compiled in restored:
+            self.entity[entity_id] = compiled[0]
+            self._compiled[entity_id] = compiled
+        self.restored = True
+        return True
+
+    def snapshot_entities(self):
+        """ What a snapshot keeps of this source, see _restore() """
+        res = []
+        for entity_id in self.entity.keys():
+            res.append((entity_id,) + self._tables(entity_id))
+        return res
+
+    def changed(self, entity_id, old):
+        """ Whether an entity isn't described here the way it is in old, an
+        earlier version of this source """
+        return entity_id not in self or self[entity_id] != old[entity_id]
+
+    def close(self):
+        """ Let go of what the source holds on to, called by MetadataStore
+        when another source has taken its place """
+        pass
 
     def parse(self, xmlstr):
-        self.entities_descr = md.entities_descriptor_from_string(xmlstr)
+        if isinstance(xmlstr, unicode):
+            xmlstr = xmlstr.encode("utf-8")
+        if self._restore(sha1(xmlstr).hexdigest()):
+            return
+        self.parse_stream(StringIO(xmlstr))
 
-        if not self.entities_descr:
-            self.entity_descr = md.entity_descriptor_from_string(xmlstr)
-            if self.entity_descr:
-                self.do_entity_descriptor(self.entity_descr)
-        else:
+    def parse_stream(self, source):
+        """ Parses metadata one entity descriptor at the time. Each entity
+        descriptor is converted and then dropped from the tree so the
+        whole aggregate is never held in memory.
+
+        If the metadata isn't valid none of the entities in it are used.
+
+        :param source: A file name or a file object
+        """
+        if isinstance(source, basestring) and self._restore(
+                file_hash(source)):
+            return
+
+        before = set(self.entity.keys())
+        try:
+            if not self._parse_stream(source):
+                self._discard(before)
+        except Exception:
+            self._discard(before)
+            raise
+
+    def _discard(self, before):
+        for entity_id in self.entity.keys():
+            if entity_id not in before:
+                del self.entity[entity_id]
+                self._compiled.pop(entity_id, None)
+
+    def _parse_stream(self, source):
+        root = None
+        depth = 0
+        for event, elem in xmlbackend.iterparse(source, ("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+
+            depth -= 1
+            if elem.tag != ENTITY_DESCRIPTOR:
+                continue
+
+            if depth == 0:  # A single entity descriptor
+                self.do_entity_descriptor(None, elem)
+            elif depth == 1 and root.tag == ENTITIES_DESCRIPTOR:
+                root.remove(elem)
+                try:
+                    valid_element(md.EntityDescriptor, elem)
+                except NotValid, exc:
+                    logger.error(exc.args[0])
+                    return False
+                self.do_entity_descriptor(None, elem)
+
+        if root is not None and root.tag == ENTITIES_DESCRIPTOR:
+            # What is left once the entity descriptors are gone
             try:
-                valid_instance(self.entities_descr)
+                valid_element(md.EntitiesDescriptor, root)
             except NotValid, exc:
                 logger.error(exc.args[0])
-                return
-
-            try:
-                valid(self.entities_descr.valid_until)
-            except AttributeError:
-                pass
+                return False
 
-            for entity_descr in self.entities_descr.entity_descriptor:
-                self.do_entity_descriptor(entity_descr)
+        return True
 
     def load(self):
         self.parse(self.metadata)
 
+    def _compile(self, entity_id, ent):
+        compiled = (ent, endpoint_table(ent), cert_table(ent),
+                    entity_facets(ent))
+        self._compiled[entity_id] = compiled
+        return compiled
+
+    def _tables(self, entity_id):
+        """ The endpoint and certificate tables of an entity. They are
+        compiled when the entity is loaded, and again if the entity
+        description has been replaced since.
+
+        :return: 4-tuple, entity description, endpoint table, cert table
+            and facets
+        """
+        ent = self[entity_id]
+        try:
+            compiled = self._compiled[entity_id]
+        except KeyError:
+            return self._compile(entity_id, ent)
+
+        # Sources like MetadataMDB return a new copy of the description
+        # every time
+        if compiled[0] is not ent and compiled[0] != ent:
+            return self._compile(entity_id, ent)
+        return compiled
+
     def _service(self, entity_id, typ, service, binding=None):
         """ Get me all services with a specified
         entity ID and type, that supports the specified version of binding.
+        The endpoints marked as the default come first. What's returned is
+        shared with later calls and must not be changed.
 
         :param entity_id: The EntityId
         :param typ: Type of service (idp, attribute_authority, ...)
         :param service: which service that is sought for
         :param binding: A binding identifier
         :return: list of service descriptions.
-            Or if no binding was specified a list of 2-tuples (binding, srv)
+            Or if no binding was specified a dictionary with the binding
+            as key and a list of service descriptions as value
         """
-
-        logger.debug("_service(%s, %s, %s, %s)" % (entity_id, typ, service,
-                                                   binding))
         try:
-            srvs = []
-            for t in self[entity_id][typ]:
-                try:
-                    srvs.extend(t[service])
-                except KeyError:
-                    pass
+            endpoints = self._tables(entity_id)[1][typ]
         except KeyError:
             return None
 
-        if not srvs:
-            return srvs
-
-        if binding:
-            res = []
-            for srv in srvs:
-                if srv["binding"] == binding:
-                    res.append(srv)
-        else:
-            res = {}
-            for srv in srvs:
-                try:
-                    res[srv["binding"]].append(srv)
-                except KeyError:
-                    res[srv["binding"]] = [srv]
-        logger.debug("_service => %s" % res)
-        return res
+        return endpoints.get((service, binding), [])
 
     def _ext_service(self, entity_id, typ, service, binding):
-        try:
-            srvs = self[entity_id][typ]
-        except KeyError:
-            return None
+        return self._service(entity_id, typ, service, binding)
 
-        if not srvs:
-            return srvs
+    def cert_info(self, entity_id, descriptor="any", use="signing"):
+        """ The certificates an entity has for a use, as described by
+        cert_table(). What's returned must not be changed.
 
-        res = []
-        for srv in srvs:
-            if "extensions" in srv:
-                for elem in srv["extensions"]["extension_elements"]:
-                    if elem["__class__"] == service:
-                        if elem["binding"] == binding:
-                            res.append(elem)
+        :param entity_id: The EntityId
+        :param descriptor: One of CERT_ROLES or "any"
+        :param use: "signing" or "encryption"
+        :return: list of dictionaries
+        """
+        return self._tables(entity_id)[2].get((descriptor, use), [])
 
-        return res
+    def facets(self, entity_id):
+        """ What the entity can be selected by, see entity_facets() """
+        return self._tables(entity_id)[3]
 
     def any(self, typ, service, binding=None):
         """
@@ -345,7 +776,7 @@ class MetaDataFile(MetaData):
         self.filename = filename
 
     def load(self):
-        self.parse(open(self.filename).read())
+        self.parse_stream(self.filename)
 
 
 class MetaDataExtern(MetaData):
@@ -376,6 +807,13 @@ class MetaDataExtern(MetaData):
         """
         response = self.http.send(self.url)
         if response.status_code  == 200:
+            # The signature was checked when the snapshot was made
+            xmlstr = response.text
+            if isinstance(xmlstr, unicode):
+                xmlstr = xmlstr.encode("utf-8")
+            if self._restore(sha1(xmlstr).hexdigest()):
+                return True
+
             node_name="%s:%s" % (md.EntitiesDescriptor.c_namespace,
                                  md.EntitiesDescriptor.c_tag)
             if self.security.verify_signature(response.text,
@@ -399,11 +837,166 @@ class MetaDataMD(MetaData):
         self.filename = filename
 
     def load(self):
+        if self._restore(file_hash(self.filename)):
+            return
         for key, item in json.loads(open(self.filename).read()):
             self.entity[key] = item
+            self._compile(key, item)
+
+
+class MetaDataShared(MetaData):
+    """
+    Entities from a file that MetadataStore.publish() has written. The file
+    is memory mapped and never changed, so all the processes that use it
+    share one copy of it. An entity is decoded when it's asked for and only
+    the ones that have been used lately are kept decoded.
+
+    Like a snapshot the file is trusted, so it's only used if it's owned by
+    the user the process runs as and no one else can write to it.
+
+    What the entities can be selected by, see entity_facets(), is read when
+    the file is loaded since MetadataStore indexes it. Going through all
+    the entities, like items() and with_descriptor() do, means decoding
+    every one of them and is a lot slower than with the other sources.
+    """
+
+    def __init__(self, onts, attrc, filename, cache_size=256):
+        MetaData.__init__(self, onts, attrc)
+        self.filename = filename
+        self.cache_size = cache_size
+        self._map = None
+        # entity_id -> (offset, length, digest, facets)
+        self._offsets = {}
+        # What identifies the file that was loaded
+        self._stat = None
+        # Decoded entities, the most recently used ones are in _recent.
+        # When _recent is full it takes the place of _older, which is
+        # dropped.
+        self._recent = {}
+        self._older = {}
+
+    def load(self):
+        fil = open(self.filename, "rb")
+        try:
+            stat = os.fstat(fil.fileno())
+            # Nothing in the file is checked again, see load_snapshot()
+            if stat.st_uid != os.geteuid() or stat.st_mode & 022:
+                raise ValueError("%s can be written by others" %
+                                 self.filename)
+            if stat.st_size < len(SHARED_MAGIC) + SHARED_OFFSET.size:
+                raise ValueError("%s is not a shared metadata file" %
+                                 self.filename)
+            _map = mmap.mmap(fil.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fil.close()
+
+        try:
+            pos = len(SHARED_MAGIC)
+            if _map[:pos] != SHARED_MAGIC:
+                raise ValueError("not a shared metadata file")
+            offset = SHARED_OFFSET.unpack(
+                _map[pos:pos + SHARED_OFFSET.size])[0]
+            header = marshal.loads(_map[offset:])
+            if header["version"] != SHARED_VERSION or \
+                    header["marshal"] != marshal.version or \
+                    header["onts"] != sorted([o.NAMESPACE for o in self.onts]):
+                raise ValueError("from another version or configuration")
+            entities = header["entities"]
+        except (ValueError, EOFError, TypeError, KeyError,
+                struct.error), exc:
+            _map.close()
+            raise ValueError("Can't use %s: %s" % (self.filename, exc))
+
+        offsets = {}
+        for entity_id, (offset, length, digest, facets, valid_until) in \
+                entities.items():
+            if valid_until is not None and not valid(valid_until):
+                logger.info("Entity descriptor (entity id:%s) to old",
+                            entity_id)
+                continue
+            offsets[entity_id] = (offset, length, digest, facets)
+        self.close()
+        self._offsets = offsets
+        self._map = _map
+        self._stat = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+
+    def close(self):
+        """ Unmap the file. The entities can't be used after this. """
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._offsets = {}
+        self._recent = {}
+        self._older = {}
+
+    def stale(self):
+        """ Whether another file has been published in place of the one that
+        was loaded """
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return False
+        return (stat.st_dev, stat.st_ino, stat.st_size,
+                stat.st_mtime) != self._stat
+
+    def keys(self):
+        return self._offsets.keys()
+
+    def items(self):
+        return [(entity_id, self[entity_id]) for entity_id in self.keys()]
+
+    def values(self):
+        return [self[entity_id] for entity_id in self.keys()]
+
+    def __contains__(self, item):
+        return item in self._offsets
+
+    def __getitem__(self, item):
+        return self._tables(item)[0]
+
+    def _tables(self, entity_id):
+        try:
+            return self._recent[entity_id]
+        except KeyError:
+            pass
+
+        try:
+            compiled = self._older.pop(entity_id)
+        except KeyError:
+            offset, length = self._offsets[entity_id][:2]
+            compiled = marshal.loads(self._map[offset:offset + length])
+
+        if len(self._recent) >= self.cache_size:
+            self._older = self._recent
+            self._recent = {}
+        self._recent[entity_id] = compiled
+        return compiled
+
+    def facets(self, entity_id):
+        return self._offsets[entity_id][3]
+
+    def generation(self):
+        # The entities only change when a file is loaded
+        return self._stat
+
+    def changed(self, entity_id, old):
+        if not isinstance(old, MetaDataShared):
+            return MetaData.changed(self, entity_id, old)
+        try:
+            return self._offsets[entity_id][2] != old._offsets[entity_id][2]
+        except KeyError:
+            return True
 
 
 class MetadataStore(object):
+    """
+    All the metadata sources that are in use. An index that says which
+    source each entity is described in is kept up to date as sources are
+    loaded, so finding an entity doesn't depend on the number of sources.
+    If more than one source describes an entity the one that was loaded
+    first is used. The index is rebuilt if the entities of a source are
+    changed some other way, see generation().
+    """
     def __init__(self, onts, attrc, config, ca_certs=None,
                  disable_ssl_certificate_validation=False):
         """
@@ -420,6 +1013,116 @@ class MetadataStore(object):
         self.security = security_context(config)
         self.ii = 0
         self.metadata = {}
+        # key -> (source hash, entities) from load_snapshot()
+        self._snapshot = {}
+
+    def _get_metadata(self):
+        return self._metadata
+
+    def _set_metadata(self, metadata):
+        self._metadata = metadata
+        # The keys of the sources in the order they were loaded
+        self._order = metadata.keys()
+        self._reindex()
+
+    # key -> source, replacing all of them at once rebuilds the indexes
+    metadata = property(_get_metadata, _set_metadata)
+
+    def _reindex(self):
+        # entity_id -> the source the entity is described in
+        self._entity_index = {}
+        # entity_id -> what it can be selected by, see entity_facets()
+        self._entity_facets = {}
+        # facet -> value -> set of entity_ids
+        self._facet_index = dict([(facet, {}) for facet in FACETS])
+        # key -> (source, its generation) as they were indexed
+        self._indexed = {}
+        for key in self._load_order():
+            self._add(key, self._metadata[key])
+
+    def _load_order(self):
+        order = [key for key in self._order if key in self._metadata]
+        for key in self._metadata.keys():
+            if key not in order:
+                order.append(key)
+        self._order = order
+        return order
+
+    def _indexes(self):
+        """ The indexes, rebuilt first if sources have been added to or
+        removed from metadata, or the entities of a source have changed,
+        since they were made. A source in a database, MetadataMDB, has to
+        be set again for changes made to the database to be seen. """
+        indexed = self._indexed
+        if len(indexed) != len(self._metadata):
+            self._reindex()
+        else:
+            for key, md in self._metadata.iteritems():
+                try:
+                    _md, generation = indexed[key]
+                except KeyError:
+                    self._reindex()
+                    break
+                if _md is not md or generation != md.generation():
+                    self._reindex()
+                    break
+        return self._entity_index, self._entity_facets, self._facet_index
+
+    def _get_index(self):
+        return self._indexes()[0]
+
+    def _get_facets(self):
+        return self._indexes()[1]
+
+    def _get_selection(self):
+        return self._indexes()[2]
+
+    # entity_id -> source, entity_id -> facets and facet -> value ->
+    # entity_ids
+    _index = property(_get_index)
+    _facets = property(_get_facets)
+    _selection = property(_get_selection)
+
+    def _link(self, entity_id, md):
+        facets = md.facets(entity_id)
+        self._entity_index[entity_id] = md
+        self._entity_facets[entity_id] = facets
+        for facet, values in facets.items():
+            for value in values:
+                self._facet_index[facet].setdefault(value, set()).add(
+                    entity_id)
+
+    def _unlink(self, entity_id):
+        del self._entity_index[entity_id]
+        for facet, values in self._entity_facets.pop(entity_id).items():
+            for value in values:
+                selected = self._facet_index[facet][value]
+                selected.discard(entity_id)
+                if not selected:
+                    del self._facet_index[facet][value]
+
+    def _add(self, key, md):
+        for entity_id in md.keys():
+            if entity_id not in self._entity_index:
+                self._link(entity_id, md)
+        self._indexed[key] = (md, md.generation())
+
+    def _replace(self, key, old, new):
+        """ Point the indexes at new instead of old, entities that new
+        doesn't describe are looked for in the other sources. """
+        for entity_id in old.keys():
+            if self._entity_index.get(entity_id) is not old:
+                continue
+            self._unlink(entity_id)
+            if entity_id in new:
+                self._link(entity_id, new)
+                continue
+            for _key in self._order:
+                md = self._metadata[_key]
+                if md is not new and entity_id in md:
+                    self._link(entity_id, md)
+                    break
+        self._add(key, new)
 
     def load(self, typ, *args, **kwargs):
         if typ == "local":
@@ -437,11 +1140,26 @@ class MetadataStore(object):
         elif typ == "mdfile":
             key = args[0]
             md = MetaDataMD(self.onts, self.attrc, args[0])
+        elif typ == "shared":
+            key = args[0]
+            md = MetaDataShared(self.onts, self.attrc, args[0])
         else:
             raise Exception("Unknown metadata type '%s'" % typ)
 
+        md.snapshot = self._snapshot.pop(key, None)
         md.load()
-        self.metadata[key] = md
+        try:
+            old = self._metadata[key]
+        except KeyError:
+            old = None
+        else:
+            # A reload, drop cached certificates for changed entities
+            for entity_id in old.keys():
+                if md.changed(entity_id, old):
+                    CERT_CACHE.invalidate(entity_id)
+        self[key] = md
+        if old is not None and old is not md:
+            old.close()
 
     def imp(self, spec):
         for key, vals in spec.items():
@@ -451,39 +1169,171 @@ class MetadataStore(object):
                 else:
                     self.load(key, val)
 
-    def _service(self, entity_id, typ, service, binding=None):
-        known_principal = False
-        for key, md in self.metadata.items():
-            srvs = md._service(entity_id, typ, service, binding)
-            if srvs:
-                return srvs
-            elif srvs is None:
-                pass
+    def _snapshot_header(self, sources):
+        return {"version": SNAPSHOT_VERSION, "marshal": marshal.version,
+                "onts": sorted([ont.NAMESPACE for ont in self.onts]),
+                "sources": sources}
+
+    def dump_snapshot(self, filename):
+        """ Write the entities of all the sources, and what has been
+        compiled from them, to a snapshot file that load_snapshot() can
+        read. The file is replaced atomically.
+
+        :param filename: The name of the snapshot file
+        """
+        hashes = {}
+        entities = {}
+        for key, md in self._metadata.items():
+            if getattr(md, "source_hash", None) is None:
+                continue
+            hashes[key] = md.source_hash
+            entities[key] = md.snapshot_entities()
+
+        # What's in a snapshot is used without being checked again, see
+        # load_snapshot()
+        _atomic_write(filename, [SNAPSHOT_MAGIC,
+                                 marshal.dumps(self._snapshot_header(hashes)),
+                                 marshal.dumps(entities)], 0600)
+
+    def load_snapshot(self, filename):
+        """ Read a snapshot made by dump_snapshot(). The sources loaded
+        after this take their entities from the snapshot instead of parsing
+        them, unless they have changed since the snapshot was made.
+
+        Nothing in a snapshot is checked again, not even the signature of
+        remote metadata, only when the entities expire. So a snapshot is
+        only used if it's owned by the user the process runs as and no one
+        else can write to it.
+
+        :param filename: The name of the snapshot file
+        :return: True if the snapshot could be used
+        """
+        try:
+            fil = open(filename, "rb")
+        except IOError, exc:
+            logger.info("No metadata snapshot: %s", exc)
+            return False
+
+        try:
+            stat = os.fstat(fil.fileno())
+            if stat.st_uid != os.geteuid() or stat.st_mode & 022:
+                logger.warning("Metadata snapshot %s isn't used, it can be "
+                               "written by others", filename)
+                return False
+
+            try:
+                if fil.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                    raise ValueError("not a metadata snapshot")
+                header = marshal.load(fil)
+                if header != self._snapshot_header(header["sources"]):
+                    logger.info("Metadata snapshot %s is from another version "
+                                "or configuration", filename)
+                    return False
+                entities = marshal.load(fil)
+                snapshot = {}
+                for key, source_hash in header["sources"].items():
+                    snapshot[key] = (source_hash, entities[key])
+            except (ValueError, EOFError, TypeError, KeyError), exc:
+                logger.warning("Can't use metadata snapshot %s: %s", filename,
+                               exc)
+                return False
+        finally:
+            fil.close()
+
+        self._snapshot = snapshot
+        return True
+
+    def publish(self, filename):
+        """ Write all the entities in the store, and what has been compiled
+        from them, to a file that other processes can use as a "shared"
+        source, see MetaDataShared. The file is replaced atomically, the
+        processes that use it switch to the new one when refresh() is
+        called.
+
+        :param filename: The name of the shared metadata file
+        """
+        offset = len(SHARED_MAGIC) + SHARED_OFFSET.size
+        records = []
+        entities = {}
+        for entity_id, md in self._index.items():
+            compiled = md._tables(entity_id)
+            data = marshal.dumps(compiled)
+            entities[entity_id] = (offset, len(data), sha1(data).digest(),
+                                   compiled[3],
+                                   compiled[0].get("valid_until"))
+            records.append(data)
+            offset += len(data)
+
+        header = {"version": SHARED_VERSION, "marshal": marshal.version,
+                  "onts": sorted([ont.NAMESPACE for ont in self.onts]),
+                  "entities": entities}
+        # Metadata is public, anyone may read it. MetaDataShared only uses
+        # it if no one else can write to it.
+        _atomic_write(filename, [SHARED_MAGIC, SHARED_OFFSET.pack(offset)] +
+                      records + [marshal.dumps(header)], 0644)
+
+    def refresh(self):
+        """ Switch to the shared metadata files that have been published
+        since they were loaded. Meant to be called now and then by the
+        processes that use them, it costs a stat() per file when nothing
+        has changed.
+
+        :return: The keys of the sources that were switched
+        """
+        res = []
+        for key, md in self._metadata.items():
+            if not isinstance(md, MetaDataShared) or not md.stale():
+                continue
+            try:
+                self.load("shared", md.filename)
+            except (EnvironmentError, ValueError), exc:
+                logger.error("Can't switch to %s: %s", md.filename, exc)
             else:
-                known_principal = True
+                res.append(key)
+        return res
 
-        if known_principal:
-            logger.error("Unsupported binding: %s (%s)" % (binding, entity_id))
-            raise UnsupportedBinding(binding)
-        else:
+    def snapshot_stale(self):
+        """ Whether a snapshot of the sources as they are now would differ
+        from the one that was loaded; sources have been parsed or the
+        snapshot holds sources that weren't loaded.
+        """
+        if self._snapshot:
+            return True
+        for md in self._metadata.values():
+            if getattr(md, "source_hash", None) is not None and \
+                    not md.restored:
+                return True
+        return False
+
+    def _service(self, entity_id, typ, service, binding=None):
+        try:
+            srvs = self._index[entity_id]._service(entity_id, typ, service,
+                                                   binding)
+        except KeyError:
+            srvs = None
+
+        if srvs:
+            return srvs
+        elif srvs is None:
             logger.error("Unknown principal: %s" % entity_id)
             raise UnknownPrincipal(entity_id)
+        else:
+            logger.error("Unsupported binding: %s (%s)" % (binding, entity_id))
+            raise UnsupportedBinding(binding)
 
     def _ext_service(self, entity_id, typ, service, binding=None):
-        known_principal = False
-        for key, md in self.metadata.items():
-            srvs = md._ext_service(entity_id, typ, service, binding)
-            if srvs:
-                return srvs
-            elif srvs is None:
-                pass
-            else:
-                known_principal = True
+        try:
+            srvs = self._index[entity_id]._ext_service(entity_id, typ,
+                                                       service, binding)
+        except KeyError:
+            srvs = None
 
-        if known_principal:
-            raise UnsupportedBinding(binding)
-        else:
+        if srvs:
+            return srvs
+        elif srvs is None:
             raise UnknownPrincipal(entity_id)
+        else:
+            raise UnsupportedBinding(binding)
 
     def single_sign_on_service(self, entity_id, binding=None, typ="idpsso"):
         # IDP
@@ -578,110 +1428,162 @@ class MetadataStore(object):
                                  binding)
 
     def attribute_requirement(self, entity_id, index=0):
-        for md in self.metadata.values():
-            if entity_id in md:
-                return md.attribute_requirement(entity_id, index)
+        try:
+            md = self._index[entity_id]
+        except KeyError:
+            return None
+        return md.attribute_requirement(entity_id, index)
 
     def keys(self):
-        res = []
-        for md in self.metadata.values():
-            res.extend(md.keys())
-        return res
+        return self._index.keys()
 
-    def __getitem__(self, item):
-        for md in self.metadata.values():
-            try:
-                return md[item]
-            except KeyError:
-                pass
+    def __contains__(self, item):
+        return item in self._index
 
-        raise KeyError(item)
+    def __getitem__(self, item):
+        return self._index[item][item]
 
     def __setitem__(self, key, value):
-        self.metadata[key] = value
+        self._indexes()
+        try:
+            old = self._metadata[key]
+        except KeyError:
+            old = None
+        self._metadata[key] = value
+        if old is None:
+            self._order.append(key)
+            self._add(key, value)
+        else:
+            self._replace(key, old, value)
 
     def entities(self):
-        num = 0
-        for md in self.metadata.values():
-            num += len(md.items())
-
-        return num
+        return len(self._index)
 
     def __len__(self):
         return len(self.metadata)
 
     def with_descriptor(self, descriptor):
         res = {}
-        for md in self.metadata.values():
-            res.update(md.with_descriptor(descriptor))
+        index = self._index
+        for entity_id in self._selection["role"].get(descriptor, ()):
+            res[entity_id] = index[entity_id][entity_id]
+        return res
+
+    def query(self, **criteria):
+        """ The entities that match all the criteria. The criteria are
+        given as facet=value, where the facets are the ones in FACETS.
+        If a list of values is given an entity has to match one of them.
+
+        Example: query(role="idpsso",
+                       registration_authority="http://www.swamid.se/")
+
+        :return: A set of entity IDs, all of them if no criteria is given
+        """
+        selections = []
+        for facet, value in criteria.items():
+            selection = self._selection[facet]
+            if isinstance(value, basestring):
+                selections.append(selection.get(value, set()))
+            else:
+                _selected = set()
+                for val in value:
+                    _selected.update(selection.get(val, ()))
+                selections.append(_selected)
+
+        if not selections:
+            return set(self._index.keys())
+
+        selections.sort(key=len)
+        res = set(selections[0])
+        for selected in selections[1:]:
+            if not res:
+                break
+            res.intersection_update(selected)
+        return res
+
+    def count(self, **criteria):
+        """ The number of entities that match all the criteria, see query()
+        """
+        if len(criteria) == 1:
+            facet, value = criteria.items()[0]
+            if isinstance(value, basestring):
+                return len(self._selection[facet].get(value, ()))
+        return len(self.query(**criteria))
+
+    def counts(self, facet, **criteria):
+        """ The number of entities that match the criteria, see query(), per
+        value of a facet.
+
+        :param facet: One of FACETS
+        :return: A dictionary with the values as keys
+        """
+        if not criteria:
+            return dict([(value, len(selected)) for value, selected
+                         in self._selection[facet].items()])
+
+        selected = self.query(**criteria)
+        facets = self._facets
+        res = {}
+        for entity_id in selected:
+            for value in facets[entity_id][facet]:
+                res[value] = res.get(value, 0) + 1
         return res
 
     def name(self, entity_id, langpref="en"):
-        for md in self.metadata.values():
-            if entity_id in md.items():
-                return name(md[entity_id], langpref)
-        return None
+        try:
+            return name(self[entity_id], langpref)
+        except KeyError:
+            return None
+
+    def cert_info(self, entity_id, descriptor="any", use="signing"):
+        """ The certificates an entity has for a use, see cert_table().
+
+        :raises KeyError: If the entity is unknown
+        """
+        return self._index[entity_id].cert_info(entity_id, descriptor, use)
 
     def certs(self, entity_id, descriptor, use="signing"):
-        ent = self.__getitem__(entity_id)
-        if descriptor == "any":
-            res = []
-            for descr in ["spsso", "idpsso", "role", "authn_authority",
-                          "attribute_authority", "pdp"]:
-                try:
-                    srvs = ent["%s_descriptor" % descr]
-                except KeyError:
-                    continue
+        """ The certificates an entity has for a use. Those that have
+        expired, or aren't valid yet, are put last.
 
-                for srv in srvs:
-                    for key in srv["key_descriptor"]:
-                        if "use" in key and key["use"] == use:
-                            for dat in key["key_info"]["x509_data"]:
-                                cert = repack_cert(
-                                    dat["x509_certificate"]["text"])
-                                if cert not in res:
-                                    res.append(cert)
-                        elif not "use" in key:
-                            for dat in key["key_info"]["x509_data"]:
-                                cert = repack_cert(
-                                    dat["x509_certificate"]["text"])
-                                if cert not in res:
-                                    res.append(cert)
-        else:
-            srvs = ent["%s_descriptor" % descriptor]
-
-            res = []
-            for srv in srvs:
-                for key in srv["key_descriptor"]:
-                    if "use" in key and key["use"] == use:
-                        for dat in key["key_info"]["x509_data"]:
-                            res.append(dat["x509_certificate"]["text"])
-                    elif not "use" in key:
-                        for dat in key["key_info"]["x509_data"]:
-                            res.append(dat["x509_certificate"]["text"])
-        return res
+        :param entity_id: The EntityId
+        :param descriptor: One of CERT_ROLES or "any"
+        :param use: "signing" or "encryption"
+        :return: list of certificates, the base64 part of PEM files
+        """
+        infos = self.cert_info(entity_id, descriptor, use)
+        now = utc_now()
+        res = []
+        inactive = []
+        for info in infos:
+            if cert_active(info, now):
+                res.append(info["cert"])
+            else:
+                inactive.append(info["cert"])
+        return res + inactive
 
     def vo_members(self, entity_id):
-        ad = self.__getitem__(entity_id)["affiliation_descriptor"]
-        return [m["text"] for m in ad["affiliate_member"]]
+        facets = self._facets[entity_id]
+        if "affiliation" not in facets["role"]:
+            raise KeyError("affiliation_descriptor")
+        return facets["affiliation_member"][:]
 
     def entity_categories(self, entity_id):
-        ext = self.__getitem__(entity_id)["extensions"]
-        res = []
-        for elem in ext["extension_elements"]:
-            if elem["__class__"] == ENTITYATTRIBUTES:
-                for attr in elem["attribute"]:
-                    if attr["name"] == "http://macedir.org/entity-category":
-                        res.extend([v["text"] for v in attr["attribute_value"]])
+        return self._facets[entity_id]["entity_category"][:]
 
-        return res
+    def registration_authority(self, entity_id):
+        """ :return: The registration authority of the entity if known """
+        try:
+            return self._facets[entity_id]["registration_authority"][0]
+        except IndexError:
+            return None
 
     def bindings(self, entity_id, typ, service):
-        for md in self.metadata.values():
-            if entity_id in md.items():
-                return md.bindings(entity_id, typ, service)
-
-        return None
+        try:
+            md = self._index[entity_id]
+        except KeyError:
+            return None
+        return md.bindings(entity_id, typ, service)
 
     def __str__(self):
         _str = ["{"]
@@ -697,7 +1599,5 @@ class MetadataStore(object):
         return res
 
     def items(self):
-        res = {}
-        for md in self.metadata.values():
-            res.update(md.items())
-        return res.items()
+        return [(entity_id, md[entity_id])
+                for entity_id, md in self._index.items()]
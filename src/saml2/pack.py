@@ -30,11 +30,10 @@ import urllib
 from saml2.s_utils import deflate_and_base64_encode
 from saml2.s_utils import Unsupported
 import logging
-from saml2.sigver import RSA_SHA1
 from saml2.sigver import REQ_ORDER
 from saml2.sigver import RESP_ORDER
-from saml2.sigver import RSASigner
-from saml2.sigver import sha1_digest
+from saml2.sigver import sign_redirect
+from saml2 import xmlbackend
 
 logger = logging.getLogger(__name__)
 
@@ -103,8 +102,10 @@ def http_redirect_message(message, location, relay_state="", typ="SAMLRequest",
     :param location: Where the message should be posted to
     :param relay_state: for preserving and conveying state information
     :param typ: What type of message it is SAMLRequest/SAMLResponse/SAMLart
-    :param sigalg: The signature algorithm to use.
-    :param key: Key to use for signing
+    :param sigalg: The signature algorithm to use, one of
+        saml2.sigver.SIGNER_ALGS
+    :param key: Key to use for signing, a M2Crypto.RSA.RSA instance or the
+        name of a PEM file
     :return: A tuple containing header information and a HTML message.
     """
     
@@ -127,21 +128,11 @@ def http_redirect_message(message, location, relay_state="", typ="SAMLRequest",
         args["RelayState"] = relay_state
 
     if sigalg:
-        # sigalgs
-        # http://www.w3.org/2000/09/xmldsig#dsa-sha1
-        # http://www.w3.org/2000/09/xmldsig#rsa-sha1
+        if _order is None:
+            raise Unsupported("Signing a %s" % typ)
+        sign_redirect(args, _order, sigalg, key)
 
-        args["SigAlg"] = sigalg
-
-        if sigalg == RSA_SHA1:
-            signer = RSASigner(sha1_digest, "sha1")
-            string = "&".join([urllib.urlencode({k: args[k]}) for k in _order])
-            args["Signature"] = base64.b64encode(signer.sign(string, key))
-            string = urllib.urlencode(args)
-        else:
-            raise Unsupported("Signing algorithm")
-    else:
-        string = urllib.urlencode(args)
+    string = urllib.urlencode(args)
 
     glue_char = "&" if urlparse.urlparse(location).query else "?"
     login_url = glue_char.join([location, string])
@@ -219,7 +210,7 @@ def parse_soap_enveloped_saml(text, body_class, header_class=None):
     :param text: The SOAP object as XML 
     :return: header parts and body as saml.samlbase instances
     """
-    envelope = ElementTree.fromstring(text)
+    envelope = xmlbackend.fromstring(text)
     assert envelope.tag == '{%s}Envelope' % NAMESPACE
 
     #print len(envelope)
@@ -37,9 +37,8 @@ class Request(object):
         self.not_on_or_after = 0
 
     def _loads(self, xmldata, binding=None, origdoc=None):
-        # own copy
-        self.xmlstr = xmldata[:]
-        logger.info("xmlstr: %s" % (self.xmlstr,))
+        self.xmlstr = xmldata
+        logger.info("xmlstr: %s", self.xmlstr)
         try:
             self.message = self.signature_check(xmldata, origdoc=origdoc)
         except TypeError:
@@ -52,7 +51,7 @@ class Request(object):
             logger.info(xmldata)
             raise IncorrectlySigned()
 
-        logger.info("request: %s" % (self.message,))
+        logger.info("request: %s", self.message)
 
         try:
             valid_instance(self.message)
@@ -270,7 +270,7 @@ class StatusResponse(object):
                 logger.info(self.xmlstr)
             raise IncorrectlySigned()
 
-        logger.debug("response: %s" % (self.response,))
+        logger.debug("response: %s", self.response)
 
         try:
             valid_instance(self.response)
@@ -299,9 +299,8 @@ class StatusResponse(object):
         
     def _loads(self, xmldata, decode=True, origxml=None):
 
-        # own copy
-        self.xmlstr = xmldata[:]
-        logger.debug("xmlstr: %s" % (self.xmlstr,))
+        self.xmlstr = xmldata
+        logger.debug("xmlstr: %s", self.xmlstr)
 
         try:
             self.response = self.signature_check(xmldata, origdoc=origxml)
@@ -931,9 +930,8 @@ class AssertionIDResponse(object):
         self.signature_check = self.sec.correctly_signed_assertion_id_response
 
     def loads(self, xmldata, decode=True, origxml=None):
-        # own copy
-        self.xmlstr = xmldata[:]
-        logger.debug("xmlstr: %s" % (self.xmlstr,))
+        self.xmlstr = xmldata
+        logger.debug("xmlstr: %s", self.xmlstr)
 
         try:
             self.response = self.signature_check(xmldata, origdoc=origxml)
@@ -965,6 +963,6 @@ class AssertionIDResponse(object):
                 logger.info(self.xmlstr)
             raise IncorrectlySigned()
 
-        logger.debug("response: %s" % (self.response,))
+        logger.debug("response: %s", self.response)
 
         return self
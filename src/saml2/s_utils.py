@@ -83,6 +83,10 @@ class UnravelError(Exception):
     pass
 
 
+class MessageTooLarge(UnravelError):
+    pass
+
+
 EXCEPTION2STATUS = {
     VersionMismatch: samlp.STATUS_VERSION_MISMATCH,
     UnknownPrincipal: samlp.STATUS_UNKNOWN_PRINCIPAL,
@@ -130,14 +134,54 @@ def valid_email(emailaddress, domains=GENERIC_DOMAINS):
         return False  # Email address has funny characters.
             
 
-def decode_base64_and_inflate(string):
+def inflate(data, max_size=None):
+    """ Inflates according to RFC1951, and gives up as soon as the result
+    gets larger than max_size. No more than max_size + 1 bytes are ever
+    inflated.
+
+    :param data: Deflated data
+    :param max_size: The largest result, in bytes, that is accepted. None
+        if there is no limit.
+    :return: The inflated data
+    """
+    decompressor = zlib.decompressobj(-15)
+    res = []
+    size = 0
+    while True:
+        if max_size is None:
+            limit = 0  # No limit
+        else:
+            # Never ask for more than what would cross the limit
+            limit = max_size - size + 1
+        part = decompressor.decompress(data, limit)
+        size += len(part)
+        if max_size is not None and size > max_size:
+            raise MessageTooLarge("Inflates to more than %d bytes" % max_size)
+        res.append(part)
+        data = decompressor.unconsumed_tail
+        # Output that didn't fit may be left even if all the input is used
+        if not data and (not limit or len(part) < limit):
+            break
+    # Unlike zlib.decompress a decompressor object doesn't complain about
+    # a stream that is cut short. Anything after the end of the stream is
+    # left in unused_data, so that's where a byte added once all the data
+    # has been given to it ends up if the stream is complete.
+    decompressor.decompress("\x00", 1)
+    if not decompressor.unused_data:
+        raise zlib.error("incomplete or truncated stream")
+    return "".join(res)
+
+
+def decode_base64_and_inflate(string, max_size=None):
     """ base64 decodes and then inflates according to RFC1951 
     
     :param string: a deflated and encoded string
+    :param max_size: If given, the largest result in bytes that is accepted,
+        MessageTooLarge is raised as soon as that's exceeded.
     :return: the string after decoding and inflating
     """
 
-    return zlib.decompress(base64.b64decode(string), -15)
+    return inflate(base64.b64decode(string), max_size)
 
 
 def deflate_and_base64_encode(string_val):
@@ -353,7 +397,12 @@ def do_attribute_statement(identity):
 def factory(klass, **kwargs):
     instance = klass()
     for key, val in kwargs.items():
-        setattr(instance, key, val)
+        try:
+            setattr(instance, key, val)
+        except AttributeError:
+            # Not a member of the class and the instance is a compact one
+            # (PYSAML2_COMPACT) that has no room for it
+            instance.set_extra(key, val)
     return instance
 
 
@@ -109,6 +109,8 @@ def _verify_value_type(typ, val):
 
 
 class AttributeValueBase(SamlBase):
+    c_extra_members = ["_extatt"]
+
     def __init__(self,
                  text=None,
                  extension_elements=None,
@@ -1863,13 +1863,12 @@ def factory(tag, **kwargs):
     return ELEMENT_BY_TAG[tag](**kwargs)
 
 
-def any_response_from_string(xmlstr):
+def any_response_from_string(xmlstr, lazy=False):
     resp = None
-    for func in [status_response_type__from_string, response_from_string,
-                 artifact_response_from_string, logout_response_from_string,
-                 name_id_mapping_response_from_string,
-                 manage_name_id_response_from_string]:
-        resp = func(xmlstr)
+    tree = saml2.xml_fromstring(xmlstr)
+    for cls in [StatusResponseType_, Response, ArtifactResponse,
+                LogoutResponse, NameIDMappingResponse, ManageNameIDResponse]:
+        resp = saml2.create_class_from_element_tree(cls, tree, lazy=lazy)
         if resp:
             break
 
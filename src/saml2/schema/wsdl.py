@@ -776,6 +776,8 @@ class TDefinitions_(TExtensibleDocumented_):
     c_attributes['targetNamespace'] = ('target_namespace', 'anyURI', False)
     c_attributes['name'] = ('name', 'NCName', False)
     c_child_order.extend(['import', 'types', 'message', 'port_type', 'binding', 'service'])
+    # The import child is set as import_ by __init__
+    c_extra_members = ['import_']
 
     def __init__(self,
             import_=None,
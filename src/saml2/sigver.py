@@ -20,11 +20,21 @@ Based on the use of xmlsec1 binaries and not the python xmlsec module.
 """
 
 import base64
+import calendar
+import binascii
 from binascii import hexlify
 import hashlib
+import json
 import logging
 import random
 import os
+import re
+import socket
+import struct
+import threading
+import time
+import Queue
+from collections import OrderedDict
 from time import mktime
 import urllib
 import M2Crypto
@@ -32,9 +42,12 @@ from M2Crypto.X509 import load_cert_string
 from saml2.samlp import Response
 
 import xmldsig as ds
+import xmlenc as xenc
 
+from saml2 import xmlbackend
 from saml2 import samlp
 from saml2 import class_name
+from saml2 import create_class_from_xml_string
 from saml2 import saml
 from saml2 import ExtensionElement
 from saml2 import VERSION
@@ -54,6 +67,9 @@ logger = logging.getLogger(__name__)
 SIG = "{%s#}%s" % (ds.NAMESPACE, "Signature")
 
 RSA_SHA1 = "http://www.w3.org/2000/09/xmldsig#rsa-sha1"
+RSA_SHA256 = ds.SIG_RSA_SHA256
+RSA_SHA384 = ds.SIG_RSA_SHA384
+RSA_SHA512 = ds.SIG_RSA_SHA512
 
 
 class CertificateTooOld(Exception):
@@ -76,6 +92,24 @@ def signed(item):
     return False
 
 
+_MESSAGE_CLASS = {}
+
+
+def _message_class(func):
+    """ The class whose instances a *_from_string function in samlp or saml
+    returns """
+    try:
+        return _MESSAGE_CLASS[func]
+    except KeyError:
+        pass
+    for mod in [samlp, saml]:
+        for tag, _func in mod.ELEMENT_FROM_STRING.items():
+            if _func is func:
+                _MESSAGE_CLASS[func] = mod.ELEMENT_BY_TAG[tag]
+                return _MESSAGE_CLASS[func]
+    raise KeyError(func.__name__)
+
+
 def get_xmlsec_binary(paths=None):
     """
     Tries to find the xmlsec1 binary.
@@ -139,6 +173,14 @@ class XmlsecError(Exception):
     pass
 
 
+class PrecheckError(SignatureError):
+    """ A signed message was turned down before any cryptography was done
+    on it """
+    def __init__(self, reason, msg):
+        SignatureError.__init__(self, msg)
+        self.reason = reason
+
+
 class MissingKey(Exception):
     pass
 
@@ -245,10 +287,9 @@ def signed_instance_factory(instance, seccont, elements_to_sign=None):
     :return: A class instance if not signed otherwise a string
     """
     if elements_to_sign:
-        signed_xml = "%s" % instance
-        for (node_name, nodeid) in elements_to_sign:
-            signed_xml = seccont.sign_statement(
-                signed_xml, class_name=node_name, node_id=nodeid)
+        signed_xml = seccont.sign_statements(
+            "%s" % instance, [(node_name, nodeid, "") for (node_name, nodeid)
+                              in elements_to_sign])
 
         #print "xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx"
         #print "%s" % signed_xml
@@ -310,16 +351,79 @@ def to_time(_time):
 
 
 def active_cert(key):
-    cert_str = pem_format(key)
-    certificate = load_cert_string(cert_str)
-    not_before = to_time(str(certificate.get_not_before()))
-    not_after = to_time(str(certificate.get_not_after()))
+    """ Whether a certificate is valid now. The certificates this is used on
+    often come with a message so nothing is cached.
+
+    :param key: The base64 part of a PEM file
+    """
     try:
-        assert not_before < utc_now()
-        assert not_after > utc_now()
-        return True
-    except AssertionError:
+        not_before, not_after = cert_validity(key)
+    except ValueError, exc:
+        logger.info("Can't read certificate: %s", exc)
         return False
+    return not_before < utc_now() < not_after
+
+
+def _der_header(der, pos):
+    """ :return: 3-tuple, the tag of the DER encoded value at pos and where
+        its contents start and how long they are """
+    tag = ord(der[pos])
+    length = ord(der[pos + 1])
+    pos += 2
+    if length & 0x80:
+        num = length & 0x7f
+        length = int(hexlify(der[pos:pos + num]), 16)
+        pos += num
+    return tag, pos, length
+
+
+def _der_time(der, pos, length, tag):
+    """ An UTCTime (tag 0x17) or GeneralizedTime as seconds since the epoch
+    """
+    text = der[pos:pos + length]
+    if not text.endswith("Z"):
+        raise ValueError("Not a UTC time: %s" % text)
+    if tag == 0x17:
+        year = int(text[:2])
+        if year < 50:
+            year += 2000
+        else:
+            year += 1900
+        text = text[2:-1]
+    else:
+        year = int(text[:4])
+        text = text[4:-1]
+    # seconds may be left out
+    return calendar.timegm((year, int(text[0:2]), int(text[2:4]),
+                            int(text[4:6]), int(text[6:8]),
+                            int(text[8:10] or 0), 0, 0, 0))
+
+
+def cert_validity(cert):
+    """ When a certificate becomes valid and when it expires. The dates are
+    read directly from the DER encoding, which is much faster than having
+    M2Crypto parse the certificate.
+
+    :param cert: The base64 part of a PEM file, whitespace is allowed
+    :return: 2-tuple, notBefore and notAfter as seconds since the epoch
+    :raises ValueError: If the dates can't be found
+    """
+    der = base64.b64decode("".join(cert.split()))
+    try:
+        _, pos, _ = _der_header(der, 0)  # Certificate
+        _, pos, _ = _der_header(der, pos)  # TBSCertificate
+        tag, pos, length = _der_header(der, pos)
+        if tag == 0xa0:  # version
+            tag, pos, length = _der_header(der, pos + length)
+        # serialNumber, signature and issuer come before validity
+        for _ in range(3):
+            tag, pos, length = _der_header(der, pos + length)
+        tag, pos, length = _der_header(der, pos)
+        not_before = _der_time(der, pos, length, tag)
+        tag, pos, length = _der_header(der, pos + length)
+        return not_before, _der_time(der, pos, length, tag)
+    except IndexError:
+        raise ValueError("Not a certificate")
 
 
 def cert_from_key_info(key_info, ignore_age=False):
@@ -443,9 +547,43 @@ def key_from_key_value_dict(key_info):
 # =============================================================================
 
 
+# Things read from files, keyed by (function name, filename, args). Reloaded
+# when the file modification time changes. The number of entries is bounded,
+# the least recently used entry is evicted first.
+_FILE_CACHE = OrderedDict()
+_FILE_CACHE_SIZE = 64
+_FILE_CACHE_LOCK = threading.Lock()
+
+
+def _cached_file_load(func, filename, *args):
+    mtime = os.stat(filename).st_mtime
+    key = (func.__name__, filename) + args
+    with _FILE_CACHE_LOCK:
+        try:
+            _mtime, val = _FILE_CACHE.pop(key)
+        except KeyError:
+            pass
+        else:
+            if _mtime == mtime:
+                # most recently used last
+                _FILE_CACHE[key] = (_mtime, val)
+                return val
+
+    val = func(filename, *args)
+    with _FILE_CACHE_LOCK:
+        _FILE_CACHE[key] = (mtime, val)
+        while len(_FILE_CACHE) > _FILE_CACHE_SIZE:
+            _FILE_CACHE.popitem(last=False)
+    return val
+
+
+def _rsa_load(filename):
+    return M2Crypto.RSA.load_key(filename, M2Crypto.util.no_passphrase_callback)
+
+
 def rsa_load(filename):
     """Read a PEM-encoded RSA key pair from a file."""
-    return M2Crypto.RSA.load_key(filename, M2Crypto.util.no_passphrase_callback)
+    return _cached_file_load(_rsa_load, filename)
 
 
 def rsa_loads(key):
@@ -464,6 +602,149 @@ def pem_format(key):
                       key, "-----END CERTIFICATE-----"])
 
 
+def cert_fingerprint(cert):
+    """ The SHA-1 fingerprint of a certificate
+
+    :param cert: The base64 part of a PEM file, whitespace is allowed
+    :return: The fingerprint as a hex string
+    """
+    return hashlib.sha1(base64.b64decode("".join(cert.split()))).hexdigest()
+
+
+class _CertEntry(object):
+    def __init__(self, cert):
+        self.cert = "\n".join(split_len("".join(cert.split()), 64))
+        # The entities the certificate has been used for
+        self.entities = set()
+        self._pem_file = None
+        self._x509 = None
+        self._rsa = None
+
+    def pem_file(self):
+        if self._pem_file is None:
+            self._pem_file = make_temp(pem_format(self.cert), ".pem", False)
+        return self._pem_file
+
+    def x509(self):
+        if self._x509 is None:
+            self._x509 = load_cert_string(pem_format(self.cert))
+        return self._x509
+
+    def rsa(self):
+        if self._rsa is None:
+            self._rsa = self.x509().get_pubkey().get_rsa()
+        return self._rsa
+
+
+class CertificateCache(object):
+    """
+    Keeps what is derived from a certificate, a PEM file for xmlsec1 and
+    the parsed M2Crypto X509 and RSA objects, around between requests.
+    Entries are keyed by certificate fingerprint, the number of entries is
+    bounded and the least recently used entry is evicted first.
+
+    Only certificates that are trusted, the ones from metadata or the
+    configuration, should be put here. Those that come with a message
+    would otherwise push the trusted ones out.
+
+    The entities a certificate has been used for are remembered so that
+    the certificates can be dropped when the metadata for an entity
+    changes.
+
+    A PEM file is removed when its file object is garbage collected, that
+    is when the entry is gone and so are all those that pem_file() has
+    handed it to. Hold on to the file object for as long as the file is
+    used.
+    """
+
+    def __init__(self, size=256):
+        self.size = size
+        self._entries = OrderedDict()
+        self._entity = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, cert):
+        return cert_fingerprint(cert) in self._entries
+
+    def _entry(self, cert, entity_id=None):
+        fingerprint = cert_fingerprint(cert)
+        with self._lock:
+            try:
+                entry = self._entries.pop(fingerprint)
+            except KeyError:
+                entry = _CertEntry(cert)
+            # most recently used last
+            self._entries[fingerprint] = entry
+            if entity_id:
+                entry.entities.add(entity_id)
+                self._entity.setdefault(entity_id, set()).add(fingerprint)
+
+            while len(self._entries) > self.size:
+                self._forget(*self._entries.popitem(last=False))
+            return entry
+
+    def _forget(self, fingerprint, entry):
+        """ Remove an evicted entry from the entity mapping """
+        for entity_id in entry.entities:
+            fingerprints = self._entity.get(entity_id)
+            if fingerprints is None:
+                continue
+            fingerprints.discard(fingerprint)
+            if not fingerprints:
+                del self._entity[entity_id]
+
+    def pem_file(self, cert, entity_id=None):
+        """
+        :param cert: The base64 part of a PEM file
+        :param entity_id: The entity the certificate belongs to if known
+        :return: 2-tuple, the same as make_temp() returns; file object and
+            the name of a PEM file with the certificate. The file is there
+            as long as the file object is.
+        """
+        entry = self._entry(cert, entity_id)
+        with self._lock:
+            return entry.pem_file()
+
+    def x509(self, cert, entity_id=None):
+        """ :return: The certificate as a M2Crypto.X509.X509 instance """
+        entry = self._entry(cert, entity_id)
+        with self._lock:
+            return entry.x509()
+
+    def rsa_pub(self, cert, entity_id=None):
+        """ :return: The public key as a M2Crypto.RSA.RSA_pub instance """
+        entry = self._entry(cert, entity_id)
+        with self._lock:
+            return entry.rsa()
+
+    def invalidate(self, entity_id):
+        """ Drop the certificates used by an entity unless they are also used
+        by some other entity.
+
+        :param entity_id: The entity ID
+        """
+        with self._lock:
+            for fingerprint in self._entity.pop(entity_id, ()):
+                entry = self._entries.get(fingerprint)
+                if entry is None:
+                    continue
+                entry.entities.discard(entity_id)
+                if not entry.entities:
+                    del self._entries[fingerprint]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._entity.clear()
+
+
+# Shared by all security contexts in the process
+CERT_CACHE = CertificateCache()
+
+
 def parse_xmlsec_output(output):
     """ Parse the output from xmlsec to try to find out if the
     command was successfull or not.
@@ -488,6 +769,18 @@ def sha1_digest(msg):
     return hashlib.sha1(msg).digest()
 
 
+def sha256_digest(msg):
+    return hashlib.sha256(msg).digest()
+
+
+def sha384_digest(msg):
+    return hashlib.sha384(msg).digest()
+
+
+def sha512_digest(msg):
+    return hashlib.sha512(msg).digest()
+
+
 class Signer(object):
     """Abstract base class for signing algorithms."""
 
@@ -515,40 +808,134 @@ class RSASigner(Signer):
             raise BadSignature(e)
 
 
+# The signature algorithms that can be used with the HTTP-Redirect binding
+SIGNER_ALGS = {
+    RSA_SHA1: RSASigner(sha1_digest, "sha1"),
+    RSA_SHA256: RSASigner(sha256_digest, "sha256"),
+    RSA_SHA384: RSASigner(sha384_digest, "sha384"),
+    RSA_SHA512: RSASigner(sha512_digest, "sha512"),
+}
+
 REQ_ORDER = ["SAMLRequest", "RelayState", "SigAlg"]
 RESP_ORDER = ["SAMLResponse", "RelayState", "SigAlg"]
 
 
-def verify_redirect_signature(info, cert):
+def _redirect_order(info):
+    if "SAMLRequest" in info:
+        return REQ_ORDER
+    elif "SAMLResponse" in info:
+        return RESP_ORDER
+    else:
+        raise Unsupported(
+            "Verifying signature on something that should not be signed")
+
+
+def _redirect_signer(sigalg):
+    try:
+        return SIGNER_ALGS[sigalg]
+    except KeyError:
+        raise Unsupported("Signature algorithm: %s" % sigalg)
+
+
+def sign_redirect(args, order, sigalg, key):
+    """ Add SigAlg and Signature to the arguments of a HTTP-Redirect
+    binding message
+
+    :param args: A dictionary with the arguments, is updated in place
+    :param order: The order in which the arguments are signed
+    :param sigalg: The signature algorithm
+    :param key: The key to sign with, either a M2Crypto.RSA.RSA instance or
+        the name of a PEM file
+    :return: The updated args
+    """
+    signer = _redirect_signer(sigalg)
+    if isinstance(key, basestring):
+        key = rsa_load(key)
+    args["SigAlg"] = sigalg
+    string = "&".join([urllib.urlencode({k: args[k]}) for k in order
+                       if k in args])
+    args["Signature"] = base64.b64encode(signer.sign(string, key))
+    return args
+
+
+def verify_redirect_signature(info, cert, entity_id=None):
     """
 
     :param info: A dictionary as produced by parse_qs, means all values are
         lists.
     :param cert: A certificate to use when verifying the signature
+    :param entity_id: Who the certificate belongs to, if known
     :return: True, if signature verified
     """
-
-    if info["SigAlg"][0] == RSA_SHA1:
-        if "SAMLRequest" in info:
-            _order = REQ_ORDER
-        elif "SAMLResponse" in info:
-            _order = RESP_ORDER
-        else:
-            raise Unsupported(
-                "Verifying signature on something that should not be signed")
-        signer = RSASigner(sha1_digest, "sha1")
-        args = info.copy()
-        del args["Signature"]  # everything but the signature
-        string = "&".join([urllib.urlencode({k: args[k][0]}) for k in _order])
+    signer = _redirect_signer(info["SigAlg"][0])
+    string = "&".join([urllib.urlencode({k: info[k][0]})
+                       for k in _redirect_order(info) if k in info])
+    return _redirect_verify(signer, string, info["Signature"][0], cert,
+                            entity_id)
+
+
+def _redirect_verify(signer, string, signature, cert, entity_id):
+    # Only certificates that are already in the cache, the ones from metadata
+    # or the configuration, are taken from there. Others are parsed without
+    # being added.
+    if cert in CERT_CACHE:
+        _key = CERT_CACHE.rsa_pub(cert, entity_id)
+    else:
         _key = x509_rsa_loads(pem_format(cert))
-        _sign = base64.b64decode(info["Signature"][0])
+    try:
+        return bool(signer.verify(string, base64.b64decode(signature), _key))
+    except (BadSignature, TypeError):
+        return False
+
+
+def verify_redirect_query(query, cert, entity_id=None):
+    """ Verify the signature of a HTTP-Redirect binding message using the
+    query string as it was received. The signed string is put together
+    from the URL encoded parameters as they are, which is what the
+    binding specifies, rather than from decoded and re-encoded values.
+
+    :param query: The query part of the URL
+    :param cert: A certificate to use when verifying the signature
+    :param entity_id: Who the certificate belongs to, if known
+    :return: True, if signature verified
+    """
+    raw = {}
+    info = {}
+    for part in query.split("&"):
+        key, _, value = part.partition("=")
+        key = urllib.unquote_plus(key)
+        raw[key] = part
+        info[key] = urllib.unquote_plus(value)
+
+    if "Signature" not in info or "SigAlg" not in info:
+        return False
+    signer = _redirect_signer(info["SigAlg"])
+    string = "&".join([raw[k] for k in _redirect_order(info) if k in raw])
+    return _redirect_verify(signer, string, info["Signature"], cert,
+                            entity_id)
+
+
+def verify_redirect_signatures(messages):
+    """ Verify a batch of HTTP-Redirect binding messages. A message that
+    can't be verified, for whatever reason, is reported as failed, it
+    doesn't stop the rest of the batch from being checked.
+
+    :param messages: list of (query, cert, entity_id) tuples, where query
+        is either the query string or a dictionary as produced by parse_qs
+    :return: list of booleans, one per message
+    """
+    res = []
+    for query, cert, entity_id in messages:
         try:
-            signer.verify(string, _sign, _key)
-            return True
-        except BadSignature:
-            return False
-    else:
-        raise Unsupported("Signature algorithm: %s" % info["SigAlg"])
+            if isinstance(query, basestring):
+                res.append(verify_redirect_query(query, cert, entity_id))
+            else:
+                res.append(verify_redirect_signature(query, cert, entity_id))
+        except (Unsupported, KeyError, IndexError, TypeError,
+                binascii.Error, M2Crypto.X509.X509Error), exc:
+            logger.info("Redirect signature check failed: %s" % exc)
+            res.append(False)
+    return res
 
 
 LOG_LINE = 60 * "=" + "\n%s\n" + 60 * "-" + "\n%s" + 60 * "="
@@ -569,6 +956,10 @@ def read_cert_from_file(cert_file, cert_type):
     if not cert_file:
         return ""
 
+    return _cached_file_load(_read_cert_from_file, cert_file, cert_type)
+
+
+def _read_cert_from_file(cert_file, cert_type):
     if cert_type == "pem":
         line = open(cert_file).read().split("\n")
         if line[0] == "-----BEGIN CERTIFICATE-----":
@@ -611,6 +1002,21 @@ class CryptoBackend():
                        id_attr):
         raise NotImplementedError()
 
+    def sign_statements(self, statement, targets, key_file):
+        """ Sign several parts of a statement. Backends that can do this in
+        one go override this, the default is to sign one part at the time.
+
+        :param statement: The statement to be signed as a XML string
+        :param targets: list of (class_name, node_id, id_attr) tuples,
+            innermost first
+        :param key_file: The file where the key can be found
+        :return: The signed statement
+        """
+        for class_name, node_id, id_attr in targets:
+            statement = self.sign_statement(statement, class_name, key_file,
+                                            node_id, id_attr)
+        return statement
+
     def validate_signature(self, enctext, cert_file, cert_type, node_name,
                            node_id, id_attr):
         raise NotImplementedError()
@@ -625,17 +1031,26 @@ class CryptoBackendXmlSec1(CryptoBackend):
     __DEBUG = 0
 
     def __init__(self, xmlsec_binary, **kwargs):
+        """
+        :param xmlsec_binary: Where the xmlsec1 binary is
+        """
         CryptoBackend.__init__(self, **kwargs)
         assert (isinstance(xmlsec_binary, basestring))
         self.xmlsec = xmlsec_binary
+        self._version = None
 
     def version(self):
-        com_list = [self.xmlsec, "--version"]
+        if self._version is None:
+            try:
+                p_out, _ = self._execute([self.xmlsec, "--version"])
+                self._version = p_out.split(" ")[1]
+            except Exception:
+                return ""
+        return self._version
+
+    def _execute(self, com_list):
         pof = Popen(com_list, stderr=PIPE, stdout=PIPE)
-        try:
-            return pof.stdout.read().split(" ")[1]
-        except Exception:
-            return ""
+        return pof.communicate()
 
     def encrypt(self, text, recv_key, template, key_type):
         logger.info("Encryption input len: %d" % len(text))
@@ -759,10 +1174,8 @@ class CryptoBackendXmlSec1(CryptoBackend):
 
         logger.debug("xmlsec command: %s" % " ".join(com_list))
 
-        pof = Popen(com_list, stderr=PIPE, stdout=PIPE)
+        p_out, p_err = self._execute(com_list)
 
-        p_out = pof.stdout.read()
-        p_err = pof.stderr.read()
         try:
             if validate_output:
                 parse_xmlsec_output(p_err)
@@ -841,6 +1254,1101 @@ class CryptoBackendXMLSecurity(CryptoBackend):
             return False
 
 
+# ---------------------------------------------------------------------------
+# In-process XML Signature processing
+# ---------------------------------------------------------------------------
+
+DIGEST_FUNCTIONS = {
+    ds.DIGEST_SHA1: hashlib.sha1,
+    ds.DIGEST_SHA256: hashlib.sha256,
+    ds.DIGEST_SHA384: hashlib.sha384,
+    ds.DIGEST_SHA512: hashlib.sha512,
+}
+
+# signature method -> (digest function, M2Crypto algorithm name)
+SIGNATURE_METHODS = {
+    ds.SIG_RSA_SHA1: (hashlib.sha1, "sha1"),
+    ds.SIG_RSA_SHA256: (hashlib.sha256, "sha256"),
+    ds.SIG_RSA_SHA384: (hashlib.sha384, "sha384"),
+    ds.SIG_RSA_SHA512: (hashlib.sha512, "sha512"),
+}
+
+# canonicalization method -> (exclusive, with comments)
+C14N_METHODS = {
+    ds.C14N: (False, False),
+    ds.C14N_WITH_C: (False, True),
+    ds.ALG_EXC_C14N: (True, False),
+    ds.ALG_EXC_C14N_WITH_C: (True, True),
+}
+
+
+# Algorithms a signature may use to get past SecurityContext.precheck()
+SUPPORTED_ALGORITHMS = set(SIGNATURE_METHODS.keys() + DIGEST_FUNCTIONS.keys() +
+                           C14N_METHODS.keys() +
+                           [ds.SIG_DSA_SHA1, ds.TRANSFORM_ENVELOPED])
+
+# Why messages were turned down by SecurityContext.precheck()
+PRECHECK_REASONS = ["size", "reference_uri", "duplicate_id", "algorithm",
+                    "unknown_issuer"]
+
+
+def _ds(tag):
+    return "{%s}%s" % (ds.NAMESPACE, tag)
+
+
+def _node_tag(node_name):
+    """ 'urn:oasis:names:tc:SAML:2.0:assertion:Assertion' ->
+    '{urn:oasis:names:tc:SAML:2.0:assertion}Assertion' """
+    return "{%s}%s" % tuple(node_name.rsplit(":", 1))
+
+
+def _node_by_id(root, node_name, id_attr, node_id):
+    """ Find the node_name element that has node_id as the value of its
+    id_attr attribute. Duplicated identifiers are treated as an error since
+    that is the shape of a signature wrapping attack.
+    """
+    res = [elem for elem in root.iter(_node_tag(node_name))
+           if elem.get(id_attr) == node_id]
+    if not res:
+        return None
+    if len(res) > 1:
+        raise SignatureError("Duplicated %s='%s'" % (id_attr, node_id))
+    return res[0]
+
+
+def _algorithm(parent, tag):
+    """ The Algorithm of a child element like SignatureMethod """
+    elem = parent.find(_ds(tag))
+    if elem is None:
+        raise SignatureError("Missing %s" % tag)
+    return elem.get("Algorithm")
+
+
+def _b64_value(parent, tag):
+    """ The decoded content of a child element like SignatureValue """
+    elem = parent.find(_ds(tag))
+    if elem is None:
+        raise SignatureError("Missing %s" % tag)
+    try:
+        return base64.b64decode("".join((elem.text or "").split()))
+    except TypeError:
+        raise SignatureError("Broken %s" % tag)
+
+
+def _c14n_method(elem):
+    """ Canonicalization parameters from a CanonicalizationMethod or a
+    Transform element. """
+    if elem is None:
+        raise SignatureError("Missing CanonicalizationMethod")
+    alg = elem.get("Algorithm")
+    try:
+        exclusive, comments = C14N_METHODS[alg]
+    except KeyError:
+        raise Unsupported("Canonicalization method: %s" % alg)
+
+    prefixes = None
+    if exclusive:
+        incl = elem.find("{%s}InclusiveNamespaces" % ds.ALG_EXC_C14N)
+        if incl is not None:
+            prefixes = incl.get("PrefixList", "").split()
+    return exclusive, comments, prefixes
+
+
+def _reference_target(root, uri, node_name, id_attr):
+    if not uri:
+        return root
+    elif uri.startswith("#"):
+        target = _node_by_id(root, node_name, id_attr, uri[1:])
+        if target is None:
+            raise SignatureError("Could not find referenced node: %s" % uri)
+        return target
+    else:
+        raise Unsupported("Reference URI: %s" % uri)
+
+
+def reference_digest(root, signature, reference, node_name, id_attr,
+                     target=None):
+    """ Calculate the digest of the data pointed to by a Reference
+
+    :param root: The root Element of the document
+    :param signature: The Signature Element the Reference belongs to
+    :param reference: The Reference Element
+    :param node_name: The name of the class that is signed
+    :param id_attr: The name of the identifier attribute
+    :param target: The Element the Reference points to, if already known
+    :return: 2-tuple, the calculated digest and the digest value as given
+        in the Reference.
+    """
+    if target is None:
+        target = _reference_target(root, reference.get("URI"), node_name,
+                                   id_attr)
+    # The default, if no canonicalization transform is given
+    exclusive, prefixes = False, None
+    exclude = ()
+    transforms = reference.find(_ds("Transforms"))
+    if transforms is not None:
+        for transform in transforms.findall(_ds("Transform")):
+            if transform.get("Algorithm") == ds.TRANSFORM_ENVELOPED:
+                exclude = (signature,)
+            else:
+                # Comments are always removed when dereferencing a same
+                # document reference
+                exclusive, _, prefixes = _c14n_method(transform)
+
+    method = _algorithm(reference, "DigestMethod")
+    try:
+        digest = DIGEST_FUNCTIONS[method]
+    except KeyError:
+        raise Unsupported("Digest method: %s" % method)
+
+    data = xmlbackend.canonicalize(target, exclusive, False, prefixes,
+                                   exclude)
+    return digest(data).digest(), _b64_value(reference, "DigestValue")
+
+
+def verify_signature_element(root, signature, pub_key, node_name, id_attr,
+                             start, node_id):
+    """ Verify one ds:Signature in a parsed document. The signature must
+    have exactly one Reference and it must point to the node that is
+    supposed to be signed, what else it might cover doesn't count.
+
+    :param root: The root Element of the document
+    :param signature: The Signature Element
+    :param pub_key: M2Crypto.RSA.RSA_pub instance
+    :param node_name: The name of the class that is signed
+    :param id_attr: The name of the identifier attribute
+    :param start: The Element that is supposed to be signed
+    :param node_id: The identifier of start, empty if start is the root
+        of the document
+    :return: True if the signature verifies otherwise a SignatureError
+        is raised
+    """
+    signed_info = signature.find(_ds("SignedInfo"))
+    if signed_info is None:
+        raise SignatureError("Missing SignedInfo")
+
+    references = signed_info.findall(_ds("Reference"))
+    if len(references) != 1:
+        raise SignatureError("Expected one reference, found %d" %
+                             len(references))
+    reference = references[0]
+    uri = reference.get("URI") or ""
+    # Without a node_id the whole document is signed, it may be referred to
+    # by its identifier too
+    if node_id and uri != "#%s" % node_id:
+        raise SignatureError("Reference '%s' where '#%s' was expected" % (
+            uri, node_id))
+    if _reference_target(root, uri, node_name, id_attr) is not start:
+        raise SignatureError("Reference '%s' doesn't point at the signed "
+                             "node" % uri)
+
+    calculated, given = reference_digest(root, signature, reference,
+                                         node_name, id_attr, start)
+    if calculated != given:
+        raise SignatureError("Digest mismatch on reference '%s'" % uri)
+
+    exclusive, comments, prefixes = _c14n_method(
+        signed_info.find(_ds("CanonicalizationMethod")))
+    method = _algorithm(signed_info, "SignatureMethod")
+    try:
+        digest, algo = SIGNATURE_METHODS[method]
+    except KeyError:
+        raise Unsupported("Signature method: %s" % method)
+
+    data = xmlbackend.canonicalize(signed_info, exclusive, comments,
+                                   prefixes)
+    value = _b64_value(signature, "SignatureValue")
+    try:
+        if pub_key.verify(digest(data).digest(), value, algo):
+            return True
+    except M2Crypto.RSA.RSAError, err:
+        raise SignatureError("%s" % err)
+
+    raise SignatureError("Signature verification failed")
+
+
+def sign_signature_element(root, signature, priv_key, node_name, id_attr):
+    """ Fill in the digest values and the signature value of a ds:Signature
+    template in a parsed document.
+
+    :param root: The root Element of the document
+    :param signature: The Signature Element
+    :param priv_key: M2Crypto.RSA.RSA instance
+    :param node_name: The name of the class that is signed
+    :param id_attr: The name of the identifier attribute
+    """
+    signed_info = signature.find(_ds("SignedInfo"))
+    if signed_info is None:
+        raise SignatureError("Missing SignedInfo")
+
+    for reference in signed_info.findall(_ds("Reference")):
+        calculated, _ = reference_digest(root, signature, reference,
+                                         node_name, id_attr)
+        xmlbackend.set_text(reference.find(_ds("DigestValue")),
+                            base64.b64encode(calculated))
+
+    exclusive, comments, prefixes = _c14n_method(
+        signed_info.find(_ds("CanonicalizationMethod")))
+    method = _algorithm(signed_info, "SignatureMethod")
+    try:
+        digest, algo = SIGNATURE_METHODS[method]
+    except KeyError:
+        raise Unsupported("Signature method: %s" % method)
+
+    data = xmlbackend.canonicalize(signed_info, exclusive, comments,
+                                   prefixes)
+    xmlbackend.set_text(signature.find(_ds("SignatureValue")),
+                        base64.b64encode(priv_key.sign(digest(data).digest(),
+                                                       algo)))
+
+
+def _depth(elem):
+    depth = 0
+    elem = xmlbackend.get_parent(elem)
+    while elem is not None:
+        depth += 1
+        elem = xmlbackend.get_parent(elem)
+    return depth
+
+
+def load_pub_key(cert_file, cert_type="pem"):
+    """ Get the RSA public key from a certificate file
+
+    :param cert_file: The name of the file
+    :param cert_type: The certificate type
+    :return: M2Crypto.RSA.RSA_pub instance
+    """
+    if cert_type == "pem":
+        cert = M2Crypto.X509.load_cert(cert_file)
+    elif cert_type in ["der", "cer", "crt"]:
+        cert = M2Crypto.X509.load_cert(cert_file, M2Crypto.X509.FORMAT_DER)
+    else:
+        raise Unsupported("Certificate type: %s" % cert_type)
+    return cert.get_pubkey().get_rsa()
+
+
+def file_pub_key(cert_file, cert_type="pem"):
+    """ Get the RSA public key from a certificate file. If the certificate
+    is one CERT_CACHE holds, which it does for the certificates taken from
+    metadata or the configuration, the key isn't parsed again. Other
+    certificates, like the ones that come with a message, are not added to
+    the cache.
+
+    :param cert_file: The name of the file
+    :param cert_type: The certificate type
+    :return: M2Crypto.RSA.RSA_pub instance
+    """
+    try:
+        # Raises Exception if a PEM file is broken
+        cert = _read_cert_from_file(cert_file, cert_type)
+    except Exception, exc:
+        raise SignatureError("Can't read certificate: %s" % exc)
+    if cert is None:
+        raise Unsupported("Certificate type: %s" % cert_type)
+
+    try:
+        if cert in CERT_CACHE:
+            return CERT_CACHE.rsa_pub(cert)
+        return load_pub_key(cert_file, cert_type)
+    except (TypeError, M2Crypto.X509.X509Error), exc:
+        raise SignatureError("Can't read certificate: %s" % exc)
+
+
+# block encryption algorithm -> (M2Crypto algorithm name, key size,
+# initialization vector size)
+BLOCK_CIPHERS = {
+    xenc.BLOCK_TRIPLEDES_CBC: ("des_ede3_cbc", 24, 8),
+    xenc.BLOCK_AES128_CBC: ("aes_128_cbc", 16, 16),
+    xenc.BLOCK_AES192_CBC: ("aes_192_cbc", 24, 16),
+    xenc.BLOCK_AES256_CBC: ("aes_256_cbc", 32, 16),
+}
+
+# key transport algorithm -> RSA padding
+KEY_TRANSPORT = {
+    xenc.KEY_TRANSPORT_RSA_1_5: M2Crypto.RSA.pkcs1_padding,
+    xenc.KEY_TRANSPORT_RSA_OAEP: M2Crypto.RSA.pkcs1_oaep_padding,
+}
+
+
+def _xenc(tag):
+    return "{%s}%s" % (xenc.NAMESPACE, tag)
+
+
+def _enc_algorithm(elem):
+    method = elem.find(_xenc("EncryptionMethod"))
+    if method is None:
+        raise DecryptError("Missing EncryptionMethod")
+    return method
+
+
+def _cipher_value(elem):
+    try:
+        value = elem.find(_xenc("CipherData")).find(_xenc("CipherValue"))
+        return base64.b64decode("".join(value.text.split()))
+    except (AttributeError, TypeError):
+        raise DecryptError("Missing or broken CipherValue")
+
+
+def _encrypted_key(root, enc_data):
+    """ Find the EncryptedKey that holds the session key used to encrypt
+    a EncryptedData block. """
+    key_info = enc_data.find(_ds("KeyInfo"))
+    if key_info is not None:
+        enc_key = key_info.find(_xenc("EncryptedKey"))
+        if enc_key is not None:
+            return enc_key
+
+        method = key_info.find(_ds("RetrievalMethod"))
+        if method is not None:
+            uri = method.get("URI", "")
+            for enc_key in root.iter(_xenc("EncryptedKey")):
+                if "#%s" % enc_key.get("Id", enc_key.get("ID")) == uri:
+                    return enc_key
+            raise DecryptError("Could not find EncryptedKey '%s'" % uri)
+
+    # In SAML the EncryptedKey may be a sibling of the EncryptedData
+    parent = xmlbackend.get_parent(enc_data)
+    if parent is not None:
+        enc_key = parent.find(_xenc("EncryptedKey"))
+        if enc_key is not None:
+            return enc_key
+
+    raise DecryptError("No EncryptedKey")
+
+
+# xmlsec1 session key type -> block encryption algorithm
+SESSION_KEY_TYPES = {
+    "des-192": xenc.BLOCK_TRIPLEDES_CBC,
+    "aes-128": xenc.BLOCK_AES128_CBC,
+    "aes-192": xenc.BLOCK_AES192_CBC,
+    "aes-256": xenc.BLOCK_AES256_CBC,
+}
+
+# The same layout as xml/template.xml
+ENC_TEMPLATE = """<EncryptedData xmlns="http://www.w3.org/2001/04/xmlenc#" \
+Type="http://www.w3.org/2001/04/xmlenc#Element">\
+<EncryptionMethod Algorithm="%(block_alg)s"/>\
+<KeyInfo xmlns="http://www.w3.org/2000/09/xmldsig#">\
+<EncryptedKey xmlns="http://www.w3.org/2001/04/xmlenc#">\
+<EncryptionMethod Algorithm="%(key_transport)s"/>\
+<KeyInfo xmlns="http://www.w3.org/2000/09/xmldsig#"><KeyName/></KeyInfo>\
+<CipherData><CipherValue>%(key_value)s</CipherValue></CipherData>\
+</EncryptedKey></KeyInfo>\
+<CipherData><CipherValue>%(data_value)s</CipherValue></CipherData>\
+</EncryptedData>"""
+
+_TEMPLATE_FILES = {}
+
+
+def _block_alg(key_type):
+    try:
+        return SESSION_KEY_TYPES[key_type]
+    except KeyError:
+        raise Unsupported("Session key type: %s" % key_type)
+
+
+def encryption_template(key_type):
+    """ The name of a xmlsec1 encryption template file for a session key
+    type, the files are created once per process.
+
+    :param key_type: One of the SESSION_KEY_TYPES
+    :return: A file name
+    """
+    try:
+        return _TEMPLATE_FILES[key_type][1]
+    except KeyError:
+        _TEMPLATE_FILES[key_type] = make_temp(ENC_TEMPLATE % {
+            "block_alg": _block_alg(key_type),
+            "key_transport": xenc.KEY_TRANSPORT_RSA_1_5,
+            "key_value": "", "data_value": ""}, ".xml", False)
+        return _TEMPLATE_FILES[key_type][1]
+
+
+def encrypt_element(plain, pub_key, block_alg,
+                    key_transport=xenc.KEY_TRANSPORT_RSA_1_5):
+    """ Encrypt a XML element with a fresh session key
+
+    :param plain: The element as a string
+    :param pub_key: The receivers public key as a M2Crypto.RSA.RSA_pub
+        instance
+    :param block_alg: The block encryption algorithm
+    :param key_transport: How the session key should be encrypted
+    :return: The EncryptedData as a string
+    """
+    if isinstance(plain, unicode):
+        plain = plain.encode("utf-8")
+    if plain.startswith("<?xml"):
+        plain = plain[plain.index("?>") + 2:].lstrip()
+
+    try:
+        name, key_size, iv_size = BLOCK_CIPHERS[block_alg]
+    except KeyError:
+        raise Unsupported("Block encryption algorithm: %s" % block_alg)
+    session_key = M2Crypto.Rand.rand_bytes(key_size)
+    init_vector = M2Crypto.Rand.rand_bytes(iv_size)
+
+    # XML Encryption padding, the last byte is the length of the padding
+    pad = iv_size - len(plain) % iv_size
+    cipher = M2Crypto.EVP.Cipher(alg=name, key=session_key, iv=init_vector,
+                                 op=1, padding=0)
+    data = cipher.update(plain + chr(pad) * pad) + cipher.final()
+
+    return ENC_TEMPLATE % {
+        "block_alg": block_alg, "key_transport": key_transport,
+        "key_value": base64.b64encode(pub_key.public_encrypt(
+            session_key, KEY_TRANSPORT[key_transport])),
+        "data_value": base64.b64encode(init_vector + data)}
+
+
+def decrypt_session_key(enc_key, priv_key):
+    """ Unwrap the session key in a EncryptedKey
+
+    :param enc_key: The EncryptedKey Element
+    :param priv_key: M2Crypto.RSA.RSA instance
+    :return: The session key
+    """
+    method = _enc_algorithm(enc_key)
+    try:
+        padding = KEY_TRANSPORT[method.get("Algorithm")]
+    except KeyError:
+        raise Unsupported("Key transport algorithm: %s" % method.get(
+            "Algorithm"))
+    if method.find(_xenc("OAEPparams")) is not None:
+        raise Unsupported("OAEPparams")
+
+    try:
+        return priv_key.private_decrypt(_cipher_value(enc_key), padding)
+    except M2Crypto.RSA.RSAError, exc:
+        raise DecryptError("%s" % exc)
+
+
+def decrypt_data(enc_data, session_key):
+    """ Decrypt the cipher text in a EncryptedData
+
+    :param enc_data: The EncryptedData Element
+    :param session_key: The key
+    :return: The plain text
+    """
+    alg = _enc_algorithm(enc_data).get("Algorithm")
+    try:
+        name, key_size, iv_size = BLOCK_CIPHERS[alg]
+    except KeyError:
+        raise Unsupported("Block encryption algorithm: %s" % alg)
+    if len(session_key) != key_size:
+        raise DecryptError("Wrong key size for %s" % alg)
+
+    data = _cipher_value(enc_data)
+    try:
+        cipher = M2Crypto.EVP.Cipher(alg=name, key=session_key,
+                                     iv=data[:iv_size], op=0, padding=0)
+        plain = cipher.update(data[iv_size:]) + cipher.final()
+    except M2Crypto.EVP.EVPError, exc:
+        raise DecryptError("%s" % exc)
+
+    # XML Encryption padding, the last byte is the length of the padding
+    if not plain or not 0 < ord(plain[-1]) <= iv_size:
+        raise DecryptError("Bad padding")
+    return plain[:-ord(plain[-1])]
+
+
+def decrypt_document(xmlstr, priv_key):
+    """ Replace all EncryptedData blocks in a document with what they
+    contain. The document is only parsed once and a session key that is
+    shared by several blocks is only unwrapped once.
+
+    :param xmlstr: The XML document as a string
+    :param priv_key: M2Crypto.RSA.RSA instance
+    :return: The decrypted document
+    """
+    try:
+        root = xmlbackend.parse_document(xmlstr)
+    except xmlbackend.ParseError, exc:
+        raise DecryptError("%s" % exc)
+
+    blocks = [elem for elem in root.iter(_xenc("EncryptedData"))]
+    if not blocks:
+        raise DecryptError("Nothing to decrypt")
+
+    session_keys = {}
+    for enc_data in blocks:
+        enc_key = _encrypted_key(root, enc_data)
+        try:
+            session_key = session_keys[enc_key]
+        except KeyError:
+            session_key = session_keys[enc_key] = decrypt_session_key(
+                enc_key, priv_key)
+
+        plain = decrypt_data(enc_data, session_key)
+        if xmlbackend.get_parent(enc_data) is None:
+            # The EncryptedData was the whole document
+            return plain
+
+        try:
+            xmlbackend.replace(enc_data, plain)
+        except xmlbackend.ParseError, exc:
+            raise DecryptError("%s" % exc)
+
+    return xmlbackend.document_tostring(root)
+
+
+class CryptoBackendM2Crypto(CryptoBackend):
+    """
+    CryptoBackend implementation that signs, verifies and decrypts
+    in-process, parsing and canonicalization are done by saml2.xmlbackend
+    (lxml or saml2.c14n) and the RSA and block cipher operations by
+    M2Crypto. No external processes or
+    temporary files are involved.
+
+    Operations that are not (yet) supported in-process are delegated to
+    the fallback backend if one is given.
+    """
+
+    def __init__(self, fallback=None, **kwargs):
+        CryptoBackend.__init__(self, **kwargs)
+        self.fallback = fallback
+
+    def version(self):
+        return "M2Crypto %s" % M2Crypto.version
+
+    def _fallback(self, operation):
+        if self.fallback is None:
+            raise Unsupported("%s is not supported in-process" % operation)
+        return getattr(self.fallback, operation)
+
+    def encrypt(self, text, recv_key, template, key_type):
+        """ Encrypt a XML element. The EncryptedData is built directly, the
+        template is not used.
+
+        :param text: The element as a string
+        :param recv_key: A file containing the receivers certificate
+        :param template: Ignored
+        :param key_type: The type of session key to use, one of
+            SESSION_KEY_TYPES
+        :return: The EncryptedData as a string
+        """
+        # The PEM files from the certificate cache are temporary, so the key
+        # is looked up by certificate not by file name.
+        pub_key = file_pub_key(recv_key)
+        return encrypt_element("%s" % text, pub_key, _block_alg(key_type))
+
+    def decrypt(self, enctext, key_file):
+        """ Decrypt all EncryptedData blocks in a document.
+
+        :param enctext: The document as a string or a SamlBase instance
+        :param key_file: The file with the private key
+        :return: The decrypted document, or just the plain text if the
+            document was a single EncryptedData
+        """
+        return decrypt_document("%s" % enctext, rsa_load(key_file))
+
+    def sign_statement(self, statement, class_name, key_file, node_id,
+                       id_attr):
+        return self.sign_statements(statement,
+                                    [(class_name, node_id, id_attr)],
+                                    key_file)
+
+    def sign_statements(self, statement, targets, key_file):
+        """
+        Sign several parts of a statement in one pass over the document.
+        Nested parts are signed before the parts that contain them so the
+        outer signatures cover the inner ones, whatever order the targets
+        are given in.
+
+        :param statement: The statement to be signed as a XML string
+        :param targets: list of (class_name, node_id, id_attr) tuples
+        :param key_file: The file where the key can be found
+        :return: The signed statement
+        """
+        try:
+            root = xmlbackend.parse_document(statement)
+        except xmlbackend.ParseError, exc:
+            raise SignatureError("%s" % exc)
+
+        nodes = []
+        for class_name, node_id, id_attr in targets:
+            if node_id:
+                node = _node_by_id(root, class_name, id_attr, node_id)
+                if node is None:
+                    raise SignatureError("Could not find %s with %s='%s'" % (
+                        class_name, id_attr, node_id))
+            else:
+                node = root
+
+            signature = node.find(_ds("Signature"))
+            if signature is None:
+                for signature in node.iter(_ds("Signature")):
+                    break
+                else:
+                    raise SignatureError("No signature template in %s" %
+                                         class_name)
+            nodes.append((-_depth(node), len(nodes), signature, class_name,
+                          id_attr))
+
+        priv_key = rsa_load(key_file)
+        # innermost first
+        nodes.sort()
+        for _, _, signature, class_name, id_attr in nodes:
+            sign_signature_element(root, signature, priv_key, class_name,
+                                   id_attr)
+
+        return xmlbackend.document_tostring(root)
+
+    def validate_signature(self, signedtext, cert_file, cert_type, node_name,
+                           node_id, id_attr):
+        """
+        Validate signature on XML document.
+
+        :param signedtext: The XML document as a string
+        :param cert_file: The public key that was used to sign the document
+        :param cert_type: The file type of the certificate
+        :param node_name: The name of the class that is signed
+        :param node_id: The identifier of the node
+        :param id_attr: Should normally be one of "id", "Id" or "ID"
+        :return: Boolean True if the signature was correct otherwise
+            a SignatureError is raised.
+        """
+        try:
+            root = xmlbackend.parse_document(signedtext)
+        except xmlbackend.ParseError, exc:
+            raise SignatureError("%s" % exc)
+
+        if node_id:
+            start = _node_by_id(root, node_name, id_attr, node_id)
+            if start is None:
+                raise SignatureError("Could not find %s with %s='%s'" % (
+                    node_name, id_attr, node_id))
+        else:
+            start = root
+
+        # Like xmlsec1 use the first signature found below the start node
+        for signature in start.iter(_ds("Signature")):
+            break
+        else:
+            raise SignatureError("No signature")
+
+        return verify_signature_element(root, signature,
+                                        file_pub_key(cert_file, cert_type),
+                                        node_name, id_attr, start, node_id)
+
+
+# ---------------------------------------------------------------------------
+# Signing daemon
+# ---------------------------------------------------------------------------
+
+
+class SigningDaemonError(Exception):
+    pass
+
+# Upper limit on the size of a request or a reply
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+# Exceptions that are passed from the daemon to the client as they are
+_DAEMON_ERRORS = {
+    "SignatureError": SignatureError,
+    "DecryptError": DecryptError,
+    "Unsupported": Unsupported,
+}
+
+
+def _pack_message(msg):
+    """ A message on the wire is a 4 byte length followed by that many bytes
+    of JSON """
+    data = json.dumps(msg)
+    return struct.pack("!I", len(data)) + data
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise SigningDaemonError("Connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return "".join(chunks)
+
+
+def _recv_message(sock):
+    size = struct.unpack("!I", _recv_exactly(sock, 4))[0]
+    if size > MAX_MESSAGE_SIZE:
+        raise SigningDaemonError("Message too large: %d bytes" % size)
+    msg = json.loads(_recv_exactly(sock, size))
+    if not isinstance(msg, dict):
+        raise SigningDaemonError("Malformed message")
+    return msg
+
+
+def _utf8(text):
+    if isinstance(text, unicode):
+        return text.encode("utf-8")
+    return text
+
+
+class _DaemonConnection(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+
+    def send(self, data):
+        with self.lock:
+            try:
+                self.sock.sendall(data)
+            except socket.error, exc:
+                logger.info("signing daemon client went away: %s" % exc)
+
+
+class _DaemonJob(object):
+    def __init__(self, conn, msg):
+        self.conn = conn
+        self.msg = msg
+        self.received = time.time()
+
+
+class SigningDaemon(object):
+    """
+    Holds the private key and does the signing and decryption for all the
+    processes on the host that connect to it over a Unix socket. The work
+    is done by a fixed number of worker threads, which sets the crypto
+    concurrency independent of the number of web server processes.
+
+    A worker takes all requests waiting in the queue, up to batch_size,
+    in one go and sends the replies for each connection in one write.
+    """
+
+    def __init__(self, socket_path, crypto, key_file, workers=2,
+                 batch_size=16, mode=0600):
+        """
+        :param socket_path: Where the Unix socket should be created
+        :param crypto: The CryptoBackend doing the actual work
+        :param key_file: The private key
+        :param workers: The number of worker threads
+        :param batch_size: The maximum number of requests a worker handles
+            in one go
+        :param mode: File permissions for the socket
+        """
+        self.socket_path = socket_path
+        self.crypto = crypto
+        self.key_file = key_file
+        self.workers = workers
+        self.batch_size = batch_size
+        self.mode = mode
+        self.jobs = Queue.Queue()
+        self._sock = None
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def start(self):
+        """ Start listening and processing in background threads """
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only the owner may connect from the moment the socket exists,
+        # the permissions asked for are set before anyone is listened to
+        umask = os.umask(0177)
+        try:
+            self._sock.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        os.chmod(self.socket_path, self.mode)
+        self._sock.listen(128)
+
+        for target in [self._accept] + [self._work] * self.workers:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def serve_forever(self):
+        self.start()
+        while self._sock is not None:
+            time.sleep(1)
+
+    def close(self):
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            sock.close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+    def _accept(self):
+        while self._sock is not None:
+            try:
+                conn, _ = self._sock.accept()
+            except (socket.error, AttributeError):
+                break
+            thread = threading.Thread(target=self._read,
+                                      args=(_DaemonConnection(conn),))
+            thread.daemon = True
+            thread.start()
+
+    def _read(self, conn):
+        try:
+            while True:
+                msg = _recv_message(conn.sock)
+                if msg.get("op") == "stats":
+                    # Answered right away so that it tells how things are
+                    conn.send(_pack_message({"id": msg.get("id"),
+                                             "result": self.stats()}))
+                else:
+                    self.jobs.put(_DaemonJob(conn, msg))
+        except Exception, exc:
+            logger.debug("signing daemon connection closed: %s" % exc)
+        conn.sock.close()
+
+    def _work(self):
+        while True:
+            batch = [self.jobs.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except Queue.Empty:
+                    break
+
+            replies = {}
+            for job in batch:
+                reply = {"id": job.msg.get("id")}
+                try:
+                    reply["result"] = self.execute(job.msg.get("op"),
+                                                   job.msg.get("args", {}))
+                except Exception, exc:
+                    logger.error("signing daemon: %s" % exc)
+                    reply["error"] = [exc.__class__.__name__, "%s" % exc]
+                replies.setdefault(job.conn, []).append(
+                    _pack_message(reply))
+                self._record(time.time() - job.received)
+
+            with self._lock:
+                self.batches += 1
+            for conn, data in replies.items():
+                conn.send("".join(data))
+
+    def _record(self, latency):
+        with self._lock:
+            self.requests += 1
+            self.latency_total += latency
+            if latency > self.latency_max:
+                self.latency_max = latency
+
+    def execute(self, op, args):
+        """ Do one operation
+
+        :param op: "sign" or "decrypt"
+        :param args: The arguments of the operation as a dictionary
+        :return: The signed statement or the decrypted text
+        """
+        if op == "sign":
+            return self.crypto.sign_statements(
+                _utf8(args["statement"]),
+                [tuple(target) for target in args["targets"]], self.key_file)
+        elif op == "decrypt":
+            return self.crypto.decrypt(_utf8(args["enctext"]), self.key_file)
+        else:
+            raise Unsupported("Unknown operation: %s" % op)
+
+    def stats(self):
+        with self._lock:
+            if self.requests:
+                average = self.latency_total / self.requests
+            else:
+                average = 0.0
+            return {"queue_depth": self.jobs.qsize(),
+                    "requests": self.requests, "batches": self.batches,
+                    "latency_avg": average, "latency_max": self.latency_max}
+
+
+class _PendingRequest(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.sent = time.time()
+
+
+class CryptoBackendSigningDaemon(CryptoBackend):
+    """
+    CryptoBackend that has a SigningDaemon do the signing and the
+    decryption, the key_file arguments are ignored since the daemon uses
+    its own key. Requests from all threads in the process share one
+    connection, each thread sends its request without waiting for the
+    replies to earlier requests (pipelining).
+
+    Operations that only need public keys are done by the fallback
+    backend.
+
+    The backend may be created before the web server forks its workers,
+    each process makes a connection of its own when it first needs one.
+    """
+
+    def __init__(self, socket_path, fallback=None, timeout=30, **kwargs):
+        CryptoBackend.__init__(self, **kwargs)
+        self.socket_path = socket_path
+        self.fallback = fallback
+        self.timeout = timeout
+        self._sock = None
+        self._pending = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        # The process the connection and the reader thread belong to
+        self._pid = os.getpid()
+        self.requests = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def _fallback(self, operation):
+        if self.fallback is None:
+            raise Unsupported("%s is not supported by the signing daemon" %
+                              operation)
+        return getattr(self.fallback, operation)
+
+    def _forked(self):
+        """ Forget what was inherited from the parent process; the reader
+        thread isn't running here and the replies on the connection are
+        the parent's. The lock may have been held when the process forked.
+        """
+        self._lock = threading.Lock()
+        if self._sock is not None:
+            # Only closes this process's copy of the connection
+            self._sock.close()
+            self._sock = None
+        self._pending = {}
+        self._pid = os.getpid()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        reader = threading.Thread(target=self._read, args=(sock,))
+        reader.daemon = True
+        reader.start()
+        self._sock = sock
+
+    def _read(self, sock):
+        try:
+            while True:
+                msg = _recv_message(sock)
+                with self._lock:
+                    req = self._pending.pop(msg.get("id"), None)
+                if req is None:
+                    continue
+                req.result = msg.get("result")
+                req.error = msg.get("error")
+                req.done.set()
+        except Exception, exc:
+            error = ["SigningDaemonError", "%s" % exc]
+
+        # The connection is gone, so are the replies to the requests
+        # that are still outstanding
+        with self._lock:
+            if self._sock is sock:
+                self._sock = None
+            pending = [req for req in self._pending.values()]
+            self._pending.clear()
+        sock.close()
+        for req in pending:
+            req.error = error
+            req.done.set()
+
+    def _call(self, op, **args):
+        if self._pid != os.getpid():
+            self._forked()
+        req = _PendingRequest()
+        with self._lock:
+            self._next_id += 1
+            msg_id = self._next_id
+            try:
+                if self._sock is None:
+                    self._connect()
+                self._pending[msg_id] = req
+                self._sock.sendall(_pack_message({"id": msg_id, "op": op,
+                                                  "args": args}))
+            except socket.error, exc:
+                self._pending.pop(msg_id, None)
+                raise SigningDaemonError("%s: %s" % (self.socket_path, exc))
+
+        if not req.done.wait(self.timeout):
+            with self._lock:
+                self._pending.pop(msg_id, None)
+            raise SigningDaemonError("No reply within %s seconds" %
+                                     self.timeout)
+
+        latency = time.time() - req.sent
+        with self._lock:
+            self.requests += 1
+            self.latency_total += latency
+            if latency > self.latency_max:
+                self.latency_max = latency
+
+        if req.error:
+            try:
+                name, text = req.error
+                error = _DAEMON_ERRORS.get(name, SigningDaemonError)
+            except (TypeError, ValueError):
+                error, text = SigningDaemonError, "%s" % (req.error,)
+            raise error(text)
+        return req.result
+
+    def version(self):
+        return "signing daemon at %s" % self.socket_path
+
+    def encrypt(self, text, recv_key, template, key_type):
+        return self._fallback("encrypt")(text, recv_key, template, key_type)
+
+    def decrypt(self, enctext, key_file):
+        return _utf8(self._call("decrypt", enctext=enctext))
+
+    def sign_statement(self, statement, class_name, key_file, node_id,
+                       id_attr):
+        return self.sign_statements(statement,
+                                    [(class_name, node_id, id_attr)],
+                                    key_file)
+
+    def sign_statements(self, statement, targets, key_file):
+        return _utf8(self._call("sign", statement=statement,
+                                targets=targets))
+
+    def validate_signature(self, signedtext, cert_file, cert_type, node_name,
+                           node_id, id_attr):
+        return self._fallback("validate_signature")(
+            signedtext, cert_file, cert_type, node_name, node_id, id_attr)
+
+    def daemon_stats(self):
+        """ :return: Queue depth and latency as seen by the daemon """
+        return self._call("stats")
+
+    def stats(self):
+        """ :return: Requests in flight and latency as seen by this
+            process """
+        with self._lock:
+            if self.requests:
+                average = self.latency_total / self.requests
+            else:
+                average = 0.0
+            return {"in_flight": len(self._pending),
+                    "requests": self.requests, "latency_avg": average,
+                    "latency_max": self.latency_max}
+
+
+def _get_m2crypto_cryptobackend(xmlsec_binary=None, debug=False):
+    """
+    Initialize a CryptoBackendM2Crypto crypto backend, xmlsec1 is used for
+    the operations not supported in-process if it can be found.
+    """
+    if xmlsec_binary is None:
+        try:
+            xmlsec_binary = get_xmlsec_binary()
+        except Exception:
+            pass
+
+    if xmlsec_binary:
+        fallback = CryptoBackendXmlSec1(xmlsec_binary, debug=debug)
+    else:
+        fallback = None
+    return CryptoBackendM2Crypto(fallback=fallback, debug=debug)
+
+
 def security_context(conf, debug=None):
     """ Creates a security context based on the configuration
 
@@ -872,20 +2380,32 @@ def security_context(conf, debug=None):
     elif conf.crypto_backend == 'XMLSecurity':
         # new and somewhat untested pyXMLSecurity crypto backend.
         crypto = CryptoBackendXMLSecurity(debug=debug)
+    elif conf.crypto_backend == 'M2Crypto':
+        crypto = _get_m2crypto_cryptobackend(conf.xmlsec_binary, debug=debug)
+    elif conf.crypto_backend == 'signing_daemon':
+        crypto = CryptoBackendSigningDaemon(
+            fallback=_get_m2crypto_cryptobackend(conf.xmlsec_binary,
+                                                 debug=debug),
+            debug=debug, **conf.signing_daemon)
     else:
         raise Exception('Unknown crypto_backend %s' % (
             repr(conf.crypto_backend)))
 
     return SecurityContext(crypto, conf.key_file,
                            cert_file=conf.cert_file, metadata=metadata,
-                           debug=debug, only_use_keys_in_metadata=_only_md)
+                           debug=debug, only_use_keys_in_metadata=_only_md,
+                           encrypt_key_type=getattr(conf, "encrypt_key_type",
+                                                    "des-192"),
+                           max_message_size=getattr(conf, "max_message_size",
+                                                    None))
 
 
 class SecurityContext(object):
     def __init__(self, crypto, key_file="", key_type="pem",
                  cert_file="", cert_type="pem", metadata=None,
                  debug=False, template="", encrypt_key_type="des-192",
-                 only_use_keys_in_metadata=False):
+                 only_use_keys_in_metadata=False, cert_cache=None,
+                 max_message_size=None):
 
         self.crypto = crypto
         assert (isinstance(self.crypto, CryptoBackend))
@@ -903,6 +2423,28 @@ class SecurityContext(object):
         self.only_use_keys_in_metadata = only_use_keys_in_metadata
         self.debug = debug
 
+        if cert_cache is None:
+            self.cert_cache = CERT_CACHE
+        else:
+            self.cert_cache = cert_cache
+
+        # issuer -> fingerprint of the certificate that last verified a
+        # signature from that issuer
+        self.last_verified = {}
+        # number of verifications needed -> number of signatures checked
+        self.verify_attempts = {}
+        # how often the certificate to try first was picked by matching
+        # the KeyInfo in the signature or by remembering the last one used
+        self.cert_selection = {"key_info": 0, "last_verified": 0}
+        # Guards the dictionaries above and precheck_failures, the context
+        # is shared by the threads handling requests
+        self._lock = threading.Lock()
+
+        # Messages larger than this, in bytes, are not even looked at
+        self.max_message_size = max_message_size
+        # reason -> number of messages turned down by precheck()
+        self.precheck_failures = dict([(r, 0) for r in PRECHECK_REASONS])
+
         if not template:
             this_dir, this_filename = os.path.split(__file__)
             self.template = os.path.join(this_dir, "xml", "template.xml")
@@ -915,7 +2457,8 @@ class SecurityContext(object):
         logger.info("verify correct signature")
         return self.correctly_signed_response(xml, must)
 
-    def encrypt(self, text, recv_key="", template="", key_type=""):
+    def encrypt(self, text, recv_key="", template="", key_type="",
+                entity_id=None):
         """
         xmlsec encrypt --pubkey-pem pub-userkey.pem
             --session-key aes128-cbc --xml-data doc-plain.xml
@@ -925,15 +2468,40 @@ class SecurityContext(object):
         :param recv_key: A file containing the receivers public key
         :param template: A file containing the XML document template
         :param key_type: The type of session key to use
+        :param entity_id: The receiver, if recv_key is not given the
+            receivers encryption certificate is taken from the metadata
         :result: An encrypted XML text
         """
         if not key_type:
             key_type = self.encrypt_key_type
         if not template:
-            template = self.template
+            if key_type == "des-192":
+                template = self.template
+            else:
+                template = encryption_template(key_type)
+        if not recv_key and entity_id:
+            # Held on to until the encryption is done
+            pem = self.encryption_cert(entity_id)
+            recv_key = pem[1]
 
         return self.crypto.encrypt(text, recv_key, template, key_type)
 
+    def encryption_cert(self, entity_id):
+        """ A PEM file with the certificate to use when encrypting for an
+        entity. The file stays around, in the certificate cache, until the
+        entity's metadata changes and the file object is let go of.
+
+        :param entity_id: The entity ID of the receiver
+        :return: 2-tuple, file object and the name of the file
+        """
+        try:
+            certs = self.metadata.certs(entity_id, "any", "encryption")
+        except (AttributeError, KeyError):
+            certs = []
+        if not certs:
+            raise MissingKey("No encryption key for %s" % entity_id)
+        return self.cert_cache.pem_file(certs[0], entity_id)
+
     def decrypt(self, enctext):
         """ Decrypting an encrypted text by the use of a private key.
 
@@ -969,6 +2537,109 @@ class SecurityContext(object):
                                               node_id=node_id, id_attr=id_attr,
         )
 
+    def _order_certs(self, issuer, certs, item):
+        """ Put the certificates in the order they should be tried.
+        A metadata certificate that is also embedded in the signatures
+        KeyInfo goes first, then the one that last verified a signature
+        from this issuer, then the rest in metadata order.
+
+        :param issuer: The entity ID of the issuer
+        :param certs: list of certificates
+        :param item: The signed instance
+        :return: list of certificates
+        """
+        if len(certs) < 2:
+            return certs
+
+        fingerprints = [cert_fingerprint(cert) for cert in certs]
+
+        try:
+            embedded = set([cert_fingerprint(cert) for cert in
+                            cert_from_instance(item)])
+        except (TypeError, ValueError):
+            embedded = set()
+        for index, fingerprint in enumerate(fingerprints):
+            if fingerprint in embedded:
+                with self._lock:
+                    self.cert_selection["key_info"] += 1
+                return [certs[index]] + certs[:index] + certs[index + 1:]
+
+        with self._lock:
+            try:
+                index = fingerprints.index(self.last_verified[issuer])
+            except (KeyError, ValueError):
+                return certs
+            self.cert_selection["last_verified"] += 1
+        return [certs[index]] + certs[:index] + certs[index + 1:]
+
+    def _count_attempts(self, attempts):
+        with self._lock:
+            try:
+                self.verify_attempts[attempts] += 1
+            except KeyError:
+                self.verify_attempts[attempts] = 1
+
+    def _reject(self, reason, msg):
+        with self._lock:
+            self.precheck_failures[reason] += 1
+        logger.info("Precheck failed: %s" % msg)
+        raise PrecheckError(reason, msg)
+
+    def check_size(self, xmlstr):
+        """ Turn down messages that are larger than max_message_size """
+        if self.max_message_size and xmlstr and \
+                len(xmlstr) > self.max_message_size:
+            self._reject("size", "Message larger than %d bytes" %
+                                 self.max_message_size)
+
+    def precheck(self, xmlstr, item, issuer, id_attr=""):
+        """ Cheap checks, done before any cryptography, that turn down
+        signed items that could never verify or have the shape of an
+        attack. Each reason for turning something down has its own counter
+        in precheck_failures.
+
+        :param xmlstr: The whole document as a string
+        :param item: The signed SamlBase instance
+        :param issuer: The issuer of the item
+        :param id_attr: The name of the identifier attribute
+        """
+        self.check_size(xmlstr)
+
+        signed_info = item.signature.signed_info
+        if signed_info is None or len(signed_info.reference) != 1 or \
+                signed_info.reference[0].uri != "#%s" % item.id:
+            self._reject("reference_uri",
+                         "Reference does not point to '%s'" % item.id)
+
+        reference = signed_info.reference[0]
+        algorithms = []
+        for elem in [signed_info.signature_method,
+                     signed_info.canonicalization_method,
+                     reference.digest_method]:
+            if elem is None:
+                algorithms.append(None)
+            else:
+                algorithms.append(elem.algorithm)
+        if reference.transforms is not None:
+            algorithms.extend([t.algorithm for t in
+                               reference.transforms.transform])
+        for alg in algorithms:
+            if alg not in SUPPORTED_ALGORITHMS:
+                self._reject("algorithm", "Unsupported algorithm: %s" % alg)
+
+        if xmlstr and item.id:
+            found = re.findall(r"\s%s\s*=\s*[\"']%s[\"']" % (
+                id_attr or ID_ATTR, re.escape(item.id)), xmlstr)
+            if len(found) > 1:
+                self._reject("duplicate_id",
+                             "Duplicated identifier '%s'" % item.id)
+
+        if self.metadata and self.only_use_keys_in_metadata and issuer:
+            try:
+                self.metadata[issuer]
+            except KeyError:
+                self._reject("unknown_issuer", "Unknown issuer: %s" % issuer)
+
     def _check_signature(self, decoded_xml, item, node_name=NODE_NAME,
                          origdoc=None, id_attr="", must=False):
         #print item
@@ -977,25 +2648,27 @@ class SecurityContext(object):
         except AttributeError:
             issuer = None
 
+        if origdoc is not None:
+            self.precheck(origdoc, item, issuer, id_attr)
+        else:
+            self.precheck(decoded_xml, item, issuer, id_attr)
+
         # More trust in certs from metadata then certs in the XML document
         if self.metadata:
             try:
-                _certs = self.metadata.certs(issuer, "any", "signing")
+                certs = self.metadata.certs(issuer, "any", "signing")
             except KeyError:
-                _certs = []
-            certs = []
-            for cert in _certs:
-                if isinstance(cert, basestring):
-                    certs.append(make_temp(pem_format(cert), ".pem", False))
-                else:
-                    certs.append(cert)
+                certs = []
+            certs = self._order_certs(issuer, certs, item)
+            from_metadata = True
         else:
             certs = []
+            from_metadata = False
 
         if not certs and not self.only_use_keys_in_metadata:
             logger.debug("==== Certs from instance ====")
-            certs = [make_temp(pem_format(cert), ".pem",
-                               False) for cert in cert_from_instance(item)]
+            certs = cert_from_instance(item)
+            from_metadata = False
         else:
             logger.debug("==== Certs from metadata ==== %s: %s ====" % (issuer,
                                                                         certs))
@@ -1005,31 +2678,43 @@ class SecurityContext(object):
 
         #print certs
 
-        verified = False
-        for _, pem_file in certs:
+        if origdoc is not None:
+            signedtext = origdoc
+        else:
+            signedtext = decoded_xml
+
+        attempts = 0
+        for cert in certs:
+            # The file object is kept until the check is done, the file
+            # goes away with it
+            if from_metadata:
+                pem = self.cert_cache.pem_file(cert, issuer)
+            else:
+                # Certificates from the message are never cached
+                pem = make_temp(pem_format(cert), ".pem", False)
+            attempts += 1
             try:
-                if origdoc is not None:
-                    if self.verify_signature(origdoc, pem_file,
-                                             node_name=node_name,
-                                             node_id=item.id, id_attr=id_attr):
-                        verified = True
-                        break
-                else:
-                    if self.verify_signature(decoded_xml, pem_file,
-                                             node_name=node_name,
-                                             node_id=item.id, id_attr=id_attr):
-                        verified = True
-                        break
-            except XmlsecError, exc:
+                if self.verify_signature(signedtext, pem[1],
+                                         node_name=node_name,
+                                         node_id=item.id, id_attr=id_attr):
+                    break
+            except (XmlsecError, SignatureError), exc:
+                # Could be the wrong key, for instance during a key
+                # rollover, try the next one
                 logger.error("check_sig: %s" % exc)
-                pass
             except Exception, exc:
                 logger.error("check_sig: %s" % exc)
                 raise
-
-        if not verified:
+        else:
+            self._count_attempts(attempts)
             raise SignatureError("Failed to verify signature")
 
+        self._count_attempts(attempts)
+        if from_metadata and issuer:
+            fingerprint = cert_fingerprint(cert)
+            with self._lock:
+                self.last_verified[issuer] = fingerprint
+
         return item
 
     def check_signature(self, item, node_name=NODE_NAME, origdoc=None,
@@ -1050,12 +2735,17 @@ class SecurityContext(object):
         :return:
         """
 
+        self.check_size(decoded_xml)
+
         try:
             _func = getattr(samlp, "%s_from_string" % msgtype)
         except AttributeError:
             _func = getattr(saml, "%s_from_string" % msgtype)
 
-        msg = _func(decoded_xml)
+        # Only what the signature check needs is converted now, the rest
+        # when it's used
+        msg = create_class_from_xml_string(_message_class(_func), decoded_xml,
+                                           lazy=True)
         if not msg:
             raise TypeError("Not a %s" % msgtype)
 
@@ -1163,7 +2853,9 @@ class SecurityContext(object):
         :return: None if the signature can not be verified otherwise an instance
         """
 
-        response = samlp.any_response_from_string(decoded_xml)
+        self.check_size(decoded_xml)
+
+        response = samlp.any_response_from_string(decoded_xml, lazy=True)
         if not response:
             raise TypeError("Not a Response")
 
@@ -1223,6 +2915,26 @@ class SecurityContext(object):
         return self.crypto.sign_statement(statement, class_name, key_file,
                                           node_id, id_attr)
 
+    def sign_statements(self, statement, targets, key=None, key_file=None):
+        """Sign several parts of a SAML statement.
+
+        :param statement: The statement to be signed as a XML string
+        :param targets: list of (class_name, node_id, id_attr) tuples,
+            innermost first. An empty id_attr means the default.
+        :param key: The key to be used for the signing, either this or
+        :param key_file: The file where the key can be found
+        :return: The signed statement
+        """
+        if not key_file and key:
+            _, key_file = make_temp("%s" % key, ".pem")
+
+        if not key and not key_file:
+            key_file = self.key_file
+
+        return self.crypto.sign_statements(
+            statement, [(cname, node_id, id_attr or ID_ATTR)
+                        for cname, node_id, id_attr in targets], key_file)
+
     def sign_assertion_using_xmlsec(self, statement, **kwargs):
         """ Deprecated function. See sign_assertion(). """
         return self.sign_statement(statement, class_name(saml.Assertion()),
@@ -1265,6 +2977,7 @@ class SecurityContext(object):
         :param key_file: A file that contains the key to be used
         :return: A possibly multiple signed statement
         """
+        targets = []
         for (item, sid, id_attr) in to_sign:
             if not sid:
                 if not item.id:
@@ -1275,10 +2988,10 @@ class SecurityContext(object):
             if not item.signature:
                 item.signature = pre_signature_part(sid, self.cert_file)
 
-            statement = self.sign_statement(statement, class_name(item),
-                                            key=key, key_file=key_file,
-                                            node_id=sid, id_attr=id_attr)
-        return statement
+            targets.append((class_name(item), sid, id_attr))
+
+        return self.sign_statements(statement, targets, key=key,
+                                    key_file=key_file)
 
 
 # ===========================================================================
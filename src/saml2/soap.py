@@ -21,6 +21,7 @@ Suppport for the client part of the SAML2.0 SOAP binding.
 import logging
 
 from saml2 import create_class_from_element_tree
+from saml2 import xmlbackend
 from saml2.samlp import NAMESPACE as SAMLP_NAMESPACE
 from saml2.schema import soapenv
 
@@ -146,7 +147,7 @@ def parse_soap_enveloped_saml_thingy(text, expected_tags):
     :param expected_tags: What the tag of the SAML thingy is expected to be.
     :return: SAML thingy as a string
     """
-    envelope = ElementTree.fromstring(text)
+    envelope = xmlbackend.fromstring(text)
 
     # Make sure it's a SOAP message
     assert envelope.tag == '{%s}Envelope' % soapenv.NAMESPACE
@@ -164,7 +165,7 @@ def parse_soap_enveloped_saml_thingy(text, expected_tags):
     
     saml_part = body[0]
     if saml_part.tag in expected_tags:
-        return ElementTree.tostring(saml_part, encoding="UTF-8")
+        return xmlbackend.tostring(saml_part)
     else:
         raise WrongMessageType("Was '%s' expected one of %s" % (saml_part.tag,
                                                                 expected_tags))
@@ -196,7 +197,7 @@ def class_instances_from_soap_enveloped_saml_thingies(text, modules):
     :return: The body and headers as class instances
     """
     try:
-        envelope = ElementTree.fromstring(text)
+        envelope = xmlbackend.fromstring(text)
     except Exception, exc:
         raise XmlParseError("%s" % exc)
 
@@ -222,7 +223,7 @@ def open_soap_envelope(text):
     :return: dictionary with two keys "body"/"header"
     """
     try:
-        envelope = ElementTree.fromstring(text)
+        envelope = xmlbackend.fromstring(text)
     except Exception, exc:
         raise XmlParseError("%s" % exc)
 
@@ -233,10 +234,10 @@ def open_soap_envelope(text):
     for part in envelope:
         if part.tag == '{%s}Body' % soapenv.NAMESPACE:
             assert len(part) == 1
-            content["body"] = ElementTree.tostring(part[0], encoding="UTF-8")
+            content["body"] = xmlbackend.tostring(part[0])
         elif part.tag == "{%s}Header" % soapenv.NAMESPACE:
             for item in part:
-                _str = ElementTree.tostring(item, encoding="UTF-8")
+                _str = xmlbackend.tostring(item)
                 content["header"].append(_str)
 
     return content
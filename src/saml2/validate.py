@@ -1,9 +1,11 @@
 import calendar
 import urlparse
 import re
+import sys
 import time_util
 import struct
 import base64
+from datetime import datetime
 
 # Also defined in saml2.saml but can't import from there
 XSI_NAMESPACE = 'http://www.w3.org/2001/XMLSchema-instance'
@@ -43,8 +45,14 @@ def valid_id(oid):
     valid_ncname(oid)
 
 
+# URIs that urlparse can't fail on, ASCII without brackets (IPv6 literals)
+SIMPLE_URI = re.compile(r"[\x00-\x5a\x5c\x5e-\x7f]*\Z")
+
+
 def valid_any_uri(item):
     """very simplistic, ..."""
+    if isinstance(item, basestring) and SIMPLE_URI.match(item):
+        return True
     try:
         part = urlparse.urlparse(item)
     except Exception:
@@ -58,7 +66,24 @@ def valid_any_uri(item):
     return True
 
 
+DATE_TIME = re.compile(
+    r"(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(\.\d+)?Z\Z")
+
+
 def valid_date_time(item):
+    # The common form is checked without strptime, anything else is left to
+    # time_util.str_to_time
+    match = isinstance(item, basestring) and DATE_TIME.match(item)
+    if match:
+        year, month, day, hour, minute, second = [
+            int(part) for part in match.groups()[:6]]
+        try:
+            datetime(year, month, day, hour, minute)
+        except ValueError:
+            pass
+        else:
+            if second <= 61:
+                return True
     try:
         time_util.str_to_time(item)
     except Exception:
@@ -167,11 +192,24 @@ def valid_duration(val):
     return True
 
 
+if sys.maxunicode > 0xFFFF:
+    NOT_CHAR = re.compile(
+        u"[^\t\n\r\x20-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]")
+else:
+    # Characters outside the BMP are surrogate pairs, which are not Chars
+    NOT_CHAR = re.compile(u"[^\t\n\r\x20-\ud7ff\ue000-\ufffd]")
+
+
 def valid_string(val):
     """ Expects unicode 
     Char ::= #x9 | #xA | #xD | [#x20-#xD7FF] | [#xE000-#xFFFD] | 
                     [#x10000-#x10FFFF]
     """
+    if isinstance(val, basestring):
+        if NOT_CHAR.search(val):
+            raise NotValid("string")
+        return True
+
     for char in val:
         try:
             char = ord(char)
@@ -333,98 +371,287 @@ def _valid_instance(instance, val):
 ERROR_TEXT = "Wrong type of value '%s' on attribute '%s' expected it to be %s"
 
 
+def _type_validator(typ):
+    """ The validator valid() would use for the type """
+    try:
+        return VALIDATOR[typ]
+    except KeyError:
+        pass
+    try:
+        (_namespace, name) = typ.split(":")
+    except ValueError:
+        name = typ or "string"
+    # Unknown types fail the way they do in valid()
+    return VALIDATOR.get(name, lambda value: valid(typ, value))
+
+
+def _value_type_validator(spec):
+    """ A function that does what validate_value_type does with the spec """
+    if "maxlen" in spec:
+        maxlen = spec["maxlen"]
+        return lambda value: len(value) <= maxlen
+
+    if spec["base"] == "string":
+        if "enumeration" not in spec:
+            return valid_string
+        enumeration = spec["enumeration"]
+
+        def valid_enumeration(value):
+            if value not in enumeration:
+                raise NotValid("value not in enumeration")
+            return True
+        return valid_enumeration
+    elif spec["base"] == "list":
+        member = _type_validator(spec["member"])
+
+        def valid_list(value):
+            for val in [v.strip() for v in value.split(",")]:
+                member(val)
+            return True
+        return valid_list
+    else:
+        return _type_validator(spec["base"])
+
+
+# What valid_instance checks for each class, worked out from c_value_type,
+# c_attributes, c_children and c_cardinality the first time an instance of
+# the class is validated.
+# {class: (text validator, [(attribute, required, validator)],
+#          [(member, min, max)])}
+CHECKS = {}
+
+
+def _checks(instclass):
+    try:
+        return CHECKS[instclass]
+    except KeyError:
+        pass
+
+    if instclass.c_value_type:
+        text = _value_type_validator(instclass.c_value_type)
+    else:
+        text = None
+
+    attributes = []
+    for (name, typ, required) in instclass.c_attributes.values():
+        if isinstance(typ, type):
+            if typ.c_value_type:
+                spec = typ.c_value_type
+            else:
+                spec = {"base": "string"}  # do I need a default
+            validator = _value_type_validator(spec)
+        else:
+            validator = _type_validator(typ)
+        attributes.append((name, required, validator))
+
+    children = []
+    for (name, _spec) in instclass.c_children.values():
+        _card = instclass.c_cardinality.get(name, {})
+        children.append((name, _card.get("min"), _card.get("max")))
+
+    CHECKS[instclass] = res = (text, attributes, children)
+    return res
+
+
+def _valid_cardinality(cls, vlen, cmin, cmax):
+    if cmin is not None and cmin > vlen:
+        raise NotValid(
+            "Class '%s' instance cardinality error: %s" % (
+                cls.__name__, "less then min (%s<%s)" % (vlen, cmin)))
+    if cmax is not None and vlen > cmax:
+        raise NotValid(
+            "Class '%s' instance cardinality error: %s" % (
+                cls.__name__, "more then max (%s>%s)" % (vlen, cmax)))
+
+
 def valid_instance(instance):
-    instclass = instance.__class__
-    class_name = instclass.__name__
+    """ Check an instance against its schema description. The children of a
+    lazily parsed instance that have not been built yet are only counted,
+    they are checked when they are built.
 
-    # if instance.text:
-    #     _has_val = True
-    # else:
-    #     _has_val = False
+    :param instance: A SamlBase instance
+    :return: True, NotValid is raised if the instance isn't valid
+    """
+    instclass = instance.__class__
+    text, attributes, children = _checks(instclass)
 
-    if instclass.c_value_type and instance.text:
+    if text is not None and instance.text:
         try:
-            validate_value_type(instance.text.strip(),
-                                instclass.c_value_type)
+            text(instance.text.strip())
         except NotValid, exc:
-            raise NotValid("Class '%s' instance: %s" % (class_name,
+            raise NotValid("Class '%s' instance: %s" % (instclass.__name__,
                                                         exc.args[0]))
 
-    for (name, typ, required) in instclass.c_attributes.values():
-        value = getattr(instance, name, '')
-        if required and not value:
-            txt = "Required value on property '%s' missing" % name
-            raise MustValueError("Class '%s' instance: %s" % (class_name, txt))
-        
-        if value:
-            try:
-                if isinstance(typ, type):
-                    if typ.c_value_type:
-                        spec = typ.c_value_type
-                    else:
-                        spec = {"base": "string"}  # do I need a default
-              
-                    validate_value_type(value, spec)
-                else:
-                    valid(typ, value)
-            except (NotValid, ValueError), exc:
-                txt = ERROR_TEXT % (value, name, exc.args[0])
-                raise NotValid("Class '%s' instance: %s" % (class_name, txt))
-        
-    for (name, _spec) in instclass.c_children.values():
+    for (name, required, validator) in attributes:
         value = getattr(instance, name, '')
+        if not value:
+            if required:
+                txt = "Required value on property '%s' missing" % name
+                raise MustValueError("Class '%s' instance: %s" % (
+                    instclass.__name__, txt))
+            continue
 
         try:
-            _card = instclass.c_cardinality[name]
-            try:
-                _cmin = _card["min"]
-            except KeyError:
-                _cmin = None
-            try:
-                _cmax = _card["max"]
-            except KeyError:
-                _cmax = None
-        except KeyError:
-            _cmin = _cmax = _card = None
+            validator(value)
+        except (NotValid, ValueError), exc:
+            txt = ERROR_TEXT % (value, name, exc.args[0])
+            raise NotValid("Class '%s' instance: %s" % (instclass.__name__,
+                                                        txt))
+
+    unbuilt = instance._unbuilt()
+    for (name, _cmin, _cmax) in children:
+        if unbuilt and name in unbuilt:
+            member_class, nodes = unbuilt[name]
+            if isinstance(member_class, list):
+                vlen = len(nodes)
+            else:
+                vlen = 1
+            _valid_cardinality(instclass, vlen, _cmin, _cmax)
+            continue
+
+        value = getattr(instance, name, '')
 
         if value:
-            #_has_val = True
             if isinstance(value, list):
-                _list = True
                 vlen = len(value)
             else:
-                _list = False
                 vlen = 1
+            _valid_cardinality(instclass, vlen, _cmin, _cmax)
 
-            if _card:
-                if _cmin is not None and _cmin > vlen:
-                    raise NotValid(
-                        "Class '%s' instance cardinality error: %s" % (
-                            class_name, "less then min (%s<%s)" % (vlen,
-                                                                   _cmin)))
-                if _cmax is not None and vlen > _cmax:
-                    raise NotValid(
-                        "Class '%s' instance cardinality error: %s" % (
-                            class_name, "more then max (%s>%s)" % (vlen,
-                                                                   _cmax)))
-            
-            if _list:
+            if isinstance(value, list):
                 for val in value:
                     # That it is the right class is handled elsewhere
                     _valid_instance(instance, val)
             else:
                 _valid_instance(instance, value)
+        elif _cmin:
+            raise NotValid(
+                "Class '%s' instance cardinality error: %s" % (
+                    instclass.__name__, "too few values on %s" % name))
+
+    return True
+
+
+# What valid_element needs, on top of what's in CHECKS, to check an
+# ElementTree node the way valid_instance would check the instance built
+# from it.
+# {class: (whether the class has its own way of picking up the XML,
+#          whether it has its own verify(),
+#          [(XML attribute, member, what the constructor sets it to)])}
+TREE_CHECKS = {}
+
+
+def _tree_checks(cls):
+    try:
+        return TREE_CHECKS[cls]
+    except KeyError:
+        pass
+
+    # Imported here since saml2 uses this module
+    from saml2 import ExtensionContainer
+    from saml2 import SamlBase
+
+    own_harvest = cls.harvest_element_tree.im_func not in [
+        SamlBase.harvest_element_tree.im_func,
+        ExtensionContainer.harvest_element_tree.im_func]
+    own_verify = cls.verify.im_func is not SamlBase.verify.im_func
+    inst = cls()
+    attributes = [(attribute, member, getattr(inst, member, None))
+                  for attribute, (member, _, _) in cls.c_attributes.items()]
+
+    TREE_CHECKS[cls] = res = (own_harvest, own_verify, attributes)
+    return res
+
+
+def _valid_child(cls, member_class, tree):
+    """ What _valid_instance does with the instance built from the node """
+    own_harvest, own_verify = _tree_checks(member_class)[:2]
+    try:
+        if own_harvest or own_verify:
+            # Imported here since saml2 uses this module
+            from saml2 import create_class_from_element_tree
+            create_class_from_element_tree(member_class, tree).verify()
+        else:
+            valid_element(member_class, tree)
+    except NotValid, exc:
+        raise NotValid("Class '%s' instance: %s" % (cls.__name__,
+                                                     exc.args[0]))
+    except OutsideCardinality, exc:
+        raise NotValid(
+            "Class '%s' instance cardinality error: %s" % (
+                cls.__name__, exc.args[0]))
+
+
+def valid_element(cls, tree):
+    """ Does what valid_instance does with the instance that would be built
+    from an ElementTree node, without building it. Parts of the tree that
+    are described by classes with their own verify() or way of picking up
+    the XML are checked through an instance.
+
+    :param cls: The class that describes the node
+    :param tree: The ElementTree node
+    """
+    own_harvest, _, tree_attributes = _tree_checks(cls)
+    if own_harvest:
+        # Imported here since saml2 uses this module
+        from saml2 import create_class_from_element_tree
+        return valid_instance(create_class_from_element_tree(cls, tree))
+
+    text, attributes, children = _checks(cls)
+
+    if text is not None and tree.text:
+        try:
+            text(tree.text.strip())
+        except NotValid, exc:
+            raise NotValid("Class '%s' instance: %s" % (cls.__name__,
+                                                        exc.args[0]))
+
+    values = {}
+    for attribute, member, default in tree_attributes:
+        values[member] = tree.get(attribute, default)
+
+    for (name, required, validator) in attributes:
+        value = values[name]
+        if not value:
+            if required:
+                txt = "Required value on property '%s' missing" % name
+                raise MustValueError("Class '%s' instance: %s" % (
+                    cls.__name__, txt))
+            continue
+
+        try:
+            validator(value)
+        except (NotValid, ValueError), exc:
+            txt = ERROR_TEXT % (value, name, exc.args[0])
+            raise NotValid("Class '%s' instance: %s" % (cls.__name__, txt))
+
+    # member -> (class, [nodes]), only the last node is used for members
+    # that aren't lists
+    members = {}
+    for child in tree:
+        try:
+            member, member_class = cls.c_children[child.tag]
+        except KeyError:  # An extension element
+            continue
+        if isinstance(member_class, list):
+            members.setdefault(member, (member_class[0], []))[1].append(
+                child)
         else:
+            members[member] = (member_class, [child])
+
+    for (name, _cmin, _cmax) in children:
+        try:
+            member_class, nodes = members[name]
+        except KeyError:
             if _cmin:
                 raise NotValid(
                     "Class '%s' instance cardinality error: %s" % (
-                        class_name, "too few values on %s" % name))
+                        cls.__name__, "too few values on %s" % name))
+            continue
 
-#    if not _has_val:
-#        if class_name != "RequestedAttribute":
-#            # Not allow unless xsi:nil="true"
-#            assert instance.extension_attributes
-#            assert instance.extension_attributes[XSI_NIL] == "true"
+        _valid_cardinality(cls, len(nodes), _cmin, _cmax)
+        for node in nodes:
+            _valid_child(cls, member_class, node)
 
     return True
 
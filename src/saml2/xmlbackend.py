@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+The XML library that received documents are parsed with and that the
+in-process crypto backend canonicalizes with.
+
+lxml is used if it can be imported, otherwise ElementTree does the parsing
+and saml2.c14n the canonicalization. The PYSAML2_XML_BACKEND environment
+variable, "lxml" or "etree", picks one of them.
+
+Turning SAML class instances into XML is not done here, that's always
+SamlBase.to_string.
+"""
+
+import os
+import threading
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    try:
+        import cElementTree as ElementTree
+    except ImportError:
+        from elementtree import ElementTree
+
+# The expat handlers of its parser can be set, which cElementTree's can't
+from xml.etree import ElementTree as PyElementTree
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+from saml2 import c14n
+
+# What parse_document() and replace() raise
+ParseError = c14n.ParseError
+# What fromstring() and iterparse() raise, the same as ElementTree does
+TreeParseError = getattr(ElementTree, "ParseError", SyntaxError)
+
+_wanted = os.environ.get("PYSAML2_XML_BACKEND", "")
+if _wanted not in ["", "lxml", "etree"]:
+    raise ValueError("Unknown PYSAML2_XML_BACKEND: %s" % _wanted)
+if _wanted == "lxml" and etree is None:
+    raise ImportError("PYSAML2_XML_BACKEND is lxml but lxml can't be imported")
+
+if etree is not None and _wanted != "etree":
+    BACKEND = "lxml"
+else:
+    BACKEND = "etree"
+
+# How lxml parsers are set up. Entities are never resolved, a document
+# with a DTD is refused. huge_tree lifts libxml2's limits on the depth of
+# the tree and the size of text nodes, which big metadata aggregates may
+# need.
+LXML_OPTIONS = {
+    "resolve_entities": False,
+    "no_network": True,
+    "huge_tree": False,
+}
+
+_local = threading.local()
+
+
+def _parser(keep_all):
+    """ A lxml parser for this thread.
+
+    :param keep_all: Whether comments and processing instructions should be
+        kept, they are when the document is going to be canonicalized.
+    """
+    options = dict(LXML_OPTIONS)
+    options["remove_comments"] = options["remove_pis"] = not keep_all
+    key = tuple(sorted(options.items()))
+    try:
+        parsers = _local.parsers
+    except AttributeError:
+        parsers = _local.parsers = {}
+    try:
+        return parsers[key]
+    except KeyError:
+        parsers[key] = etree.XMLParser(**options)
+        return parsers[key]
+
+
+def _no_dtd(root, error):
+    if root.getroottree().docinfo.internalDTD is not None:
+        raise error("Document type declarations are not allowed")
+    return root
+
+
+def _lxml_parse(xmlstr, keep_all, error):
+    if isinstance(xmlstr, unicode):
+        xmlstr = xmlstr.encode("utf-8")
+    try:
+        return _no_dtd(etree.fromstring(xmlstr, _parser(keep_all)), error)
+    except etree.XMLSyntaxError, err:
+        raise error("%s" % err)
+
+# ---------------------------------------------------------------------------
+# Elements with the ElementTree interface, for the SAML classes, metadata
+# and SOAP envelopes.
+
+
+def _lxml_iterparse(source, events):
+    options = dict(LXML_OPTIONS)
+    options["remove_comments"] = options["remove_pis"] = True
+    first = True
+    try:
+        for event, elem in etree.iterparse(source, events, **options):
+            if first:
+                _no_dtd(elem, TreeParseError)
+                first = False
+            yield event, elem
+    except etree.XMLSyntaxError, err:
+        raise TreeParseError("%s" % err)
+
+
+def _refuse_doctype(*_args):
+    raise TreeParseError("Document type declarations are not allowed")
+
+
+def _etree_parser():
+    """ An ElementTree parser that refuses a document with a DTD, as the
+    lxml one does, rather than expanding the entities declared in it. The
+    elements are the ones ElementTree.fromstring() would make. """
+    parser = PyElementTree.XMLParser(target=ElementTree.TreeBuilder())
+    parser.parser.StartDoctypeDeclHandler = _refuse_doctype
+    return parser
+
+
+def _etree_fromstring(xmlstr):
+    parser = _etree_parser()
+    try:
+        parser.feed(xmlstr)
+        return parser.close()
+    except PyElementTree.ParseError, err:
+        raise TreeParseError("%s" % err)
+
+
+def _etree_iterparse(source, events):
+    try:
+        for event, elem in PyElementTree.iterparse(source, events,
+                                                   _etree_parser()):
+            yield event, elem
+    except PyElementTree.ParseError, err:
+        raise TreeParseError("%s" % err)
+
+
+if BACKEND == "lxml":
+    def fromstring(xmlstr):
+        """ Parse a XML document
+
+        :return: The root element
+        """
+        return _lxml_parse(xmlstr, False, TreeParseError)
+
+    def iterparse(source, events=("end",)):
+        """ Like ElementTree.iterparse
+
+        :param source: A file name or a file object
+        :param events: The events to report
+        """
+        return _lxml_iterparse(source, events)
+
+    def tostring(elem):
+        """ What ElementTree.tostring(elem, encoding="UTF-8") does for an
+        element fromstring() returned """
+        return etree.tostring(elem, encoding="UTF-8", xml_declaration=True,
+                              with_tail=False)
+else:
+    fromstring = _etree_fromstring
+
+    def iterparse(source, events=("end",)):
+        return _etree_iterparse(source, events)
+
+    def tostring(elem):
+        return ElementTree.tostring(elem, encoding="UTF-8")
+
+# ---------------------------------------------------------------------------
+# Documents that are going to be signed, verified or decrypted. These trees
+# keep the namespace prefixes, comments and processing instructions. Apart
+# from the functions below only get(), find(), findall(), iter() and text
+# may be used on their elements.
+
+
+def _lxml_set_text(elem, text):
+    """ Make text the only content of the element """
+    for child in list(elem):
+        elem.remove(child)
+    elem.text = text
+
+
+def _append_text(parent, index, text):
+    """ Add text where the child at index is, or would be """
+    if not text:
+        return
+    if index == 0:
+        parent.text = (parent.text or "") + text
+    else:
+        prev = parent[index - 1]
+        prev.tail = (prev.tail or "") + text
+
+
+def _lxml_canonicalize(elem, exclusive=True, with_comments=False,
+                       inclusive_prefixes=None, exclude=None):
+    # libxml2 has no way of leaving out part of the document so the
+    # excluded elements are taken out while the canonical form is made.
+    # Their tails are left behind since they are not part of the elements.
+    # Namespace declarations on them that repeat what the parent already
+    # declares may be lost on the way, the meaning of the tree stays the same.
+    removed = []
+    try:
+        for node in exclude or ():
+            parent = node.getparent()
+            if parent is None:
+                continue
+            index = parent.index(node)
+            if index:
+                holder = parent[index - 1]
+                before = holder.tail
+            else:
+                holder = parent
+                before = parent.text
+            tail = node.tail
+            parent.remove(node)
+            _append_text(parent, index, tail)
+            removed.append((parent, index, node, tail, holder, before))
+        return etree.tostring(elem, method="c14n", exclusive=exclusive,
+                              with_comments=with_comments,
+                              inclusive_ns_prefixes=inclusive_prefixes,
+                              with_tail=False)
+    finally:
+        for parent, index, node, tail, holder, before in reversed(removed):
+            if holder is parent:
+                parent.text = before
+            else:
+                holder.tail = before
+            node.tail = tail
+            parent.insert(index, node)
+
+
+def _lxml_replace(elem, xmlstr):
+    """ Replace an element with the elements and text that a XML fragment
+    consists of. Namespace prefixes in the fragment are resolved as if it
+    were where the element is. """
+    parent = elem.getparent()
+    decl = []
+    for prefix, uri in elem.nsmap.items():
+        if prefix is None:
+            decl.append(u' xmlns="%s"' % c14n._escape_attr(uri))
+        else:
+            decl.append(u' xmlns:%s="%s"' % (prefix, c14n._escape_attr(uri)))
+    if not isinstance(xmlstr, unicode):
+        xmlstr = xmlstr.decode("utf-8")
+    if xmlstr.startswith(u"<?xml"):
+        xmlstr = xmlstr[xmlstr.index(u"?>") + 2:]
+    wrapper = _lxml_parse(u"<fragment%s>%s</fragment>" % (u"".join(decl),
+                                                          xmlstr),
+                          True, ParseError)
+
+    index = parent.index(elem)
+    tail = elem.tail
+    parent.remove(elem)
+    _append_text(parent, index, wrapper.text)
+    for node in list(wrapper):
+        parent.insert(index, node)
+        index += 1
+    _append_text(parent, index, tail)
+
+
+def _c14n_set_text(elem, text):
+    elem.children = [unicode(text)]
+
+
+def _c14n_replace(elem, xmlstr):
+    parent = elem.parent
+    nodes = c14n.parse_fragment(xmlstr, parent.nsmap)
+    for node in nodes:
+        if isinstance(node, c14n.Element):
+            node.parent = parent
+    index = parent.children.index(elem)
+    parent.children[index:index + 1] = nodes
+
+
+if BACKEND == "lxml":
+    def parse_document(xmlstr):
+        """ Parse a document that is going to be signed, verified or
+        decrypted.
+
+        :return: The root element
+        """
+        return _lxml_parse(xmlstr, True, ParseError)
+
+    def document_tostring(root):
+        """ Serialize a tree parse_document() returned, the namespace
+        declarations are written where they were in the parsed document.
+
+        :return: The document as a UTF-8 encoded string
+        """
+        return etree.tostring(root, encoding="UTF-8", xml_declaration=True)
+
+    # Same arguments as saml2.c14n.canonicalize
+    canonicalize = _lxml_canonicalize
+
+    def get_parent(elem):
+        return elem.getparent()
+
+    set_text = _lxml_set_text
+    replace = _lxml_replace
+else:
+    parse_document = c14n.parse
+    document_tostring = c14n.tostring
+    canonicalize = c14n.canonicalize
+
+    def get_parent(elem):
+        return elem.parent
+
+    set_text = _c14n_set_text
+    replace = _c14n_replace
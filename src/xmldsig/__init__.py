@@ -11,9 +11,16 @@ NAMESPACE = 'http://www.w3.org/2000/09/xmldsig#'
 
 ENCODING_BASE64 = 'http://www.w3.org/2000/09/xmldsig#base64'
 DIGEST_SHA1 = 'http://www.w3.org/2000/09/xmldsig#sha1'
+DIGEST_SHA256 = 'http://www.w3.org/2001/04/xmlenc#sha256'
+DIGEST_SHA384 = 'http://www.w3.org/2001/04/xmldsig-more#sha384'
+DIGEST_SHA512 = 'http://www.w3.org/2001/04/xmlenc#sha512'
 ALG_EXC_C14N = 'http://www.w3.org/2001/10/xml-exc-c14n#'
+ALG_EXC_C14N_WITH_C = 'http://www.w3.org/2001/10/xml-exc-c14n#WithComments'
 SIG_DSA_SHA1 = 'http://www.w3.org/2000/09/xmldsig#dsa-sha1'
 SIG_RSA_SHA1 = 'http://www.w3.org/2000/09/xmldsig#rsa-sha1'
+SIG_RSA_SHA256 = 'http://www.w3.org/2001/04/xmldsig-more#rsa-sha256'
+SIG_RSA_SHA384 = 'http://www.w3.org/2001/04/xmldsig-more#rsa-sha384'
+SIG_RSA_SHA512 = 'http://www.w3.org/2001/04/xmldsig-more#rsa-sha512'
 MAC_SHA1 = 'http://www.w3.org/2000/09/xmldsig#hmac-sha1'
 
 C14N = 'http://www.w3.org/TR/2001/REC-xml-c14n-20010315'
@@ -11,6 +11,16 @@ import xmldsig as ds
 
 NAMESPACE = 'http://www.w3.org/2001/04/xmlenc#'
 
+TYPE_ELEMENT = 'http://www.w3.org/2001/04/xmlenc#Element'
+TYPE_CONTENT = 'http://www.w3.org/2001/04/xmlenc#Content'
+TYPE_ENCRYPTED_KEY = 'http://www.w3.org/2001/04/xmlenc#EncryptedKey'
+BLOCK_TRIPLEDES_CBC = 'http://www.w3.org/2001/04/xmlenc#tripledes-cbc'
+BLOCK_AES128_CBC = 'http://www.w3.org/2001/04/xmlenc#aes128-cbc'
+BLOCK_AES192_CBC = 'http://www.w3.org/2001/04/xmlenc#aes192-cbc'
+BLOCK_AES256_CBC = 'http://www.w3.org/2001/04/xmlenc#aes256-cbc'
+KEY_TRANSPORT_RSA_1_5 = 'http://www.w3.org/2001/04/xmlenc#rsa-1_5'
+KEY_TRANSPORT_RSA_OAEP = 'http://www.w3.org/2001/04/xmlenc#rsa-oaep-mgf1p'
+
 class KeySizeType_(SamlBase):
     """The http://www.w3.org/2001/04/xmlenc#:KeySizeType element """
 
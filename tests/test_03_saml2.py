@@ -1,14 +1,22 @@
 #!/usr/bin/env python
+import os
+import subprocess
+import sys
 
 import saml2
 
 from saml2 import create_class_from_xml_string, class_name, make_vals, md
+from saml2 import saml
+from saml2 import samlp
+from saml2 import SamlBase
 from saml2.saml import NameID, Issuer, SubjectLocality, AuthnContextClassRef
 from saml2.saml import SubjectConfirmationData, SubjectConfirmation
 from saml2.saml import Attribute
 
 from py.test import raises
 import saml2_data
+from saml2.validate import valid_instance, MustValueError
+from pathutils import full_path
 
 try:
     from xml.etree import cElementTree as ElementTree
@@ -550,3 +558,236 @@ def test_extensions_loadd():
 
     assert extension.extension_attributes.keys() == ["foo"]
     assert extension.extension_attributes["foo"] == "bar"
+
+
+def test_extension_element_to_element():
+    attr = create_class_from_xml_string(Attribute, saml2_data.TEST_ATTRIBUTE)
+    ee = saml2.element_to_extension_element(attr)
+    # What serializing and parsing the extension element gives
+    reparsed = saml.attribute_from_string(ee.to_string()).to_string()
+
+    inst = saml2.extension_element_to_element(ee, saml.ELEMENT_FROM_STRING,
+                                              saml.NAMESPACE)
+    assert isinstance(inst, Attribute)
+    assert inst.to_string() == reparsed
+    assert _eq([v.text for v in inst.attribute_value],
+               ["value1 of test attribute", "value2 of test attribute"])
+
+    # Translation functions the class can't be found for, the XML is parsed
+    inst = saml2.extension_element_to_element(
+        ee, {"Attribute": lambda x: create_class_from_xml_string(Attribute, x)},
+        saml.NAMESPACE)
+    assert inst.to_string() == reparsed
+
+    assert saml2.extension_element_to_element(ee, md.ELEMENT_FROM_STRING,
+                                              md.NAMESPACE) is None
+
+
+def _generic(cls, xml_string):
+    """ Parse without the generated parsers """
+    inst = cls()
+    tree = ElementTree.fromstring(xml_string)
+    for child in tree:
+        inst._convert_element_tree_to_member(child)
+    for attribute, value in tree.attrib.iteritems():
+        inst._convert_element_attribute_to_member(attribute, value)
+    inst.text = tree.text
+    return inst
+
+
+def test_compiled_parser_serializer():
+    for cls, xml_string in [(saml.Subject, saml2_data.TEST_SUBJECT),
+                            (saml.Conditions, saml2_data.TEST_CONDITIONS),
+                            (Attribute, saml2_data.TEST_ATTRIBUTE)]:
+        assert saml2.compile_parser(cls)
+        assert saml2.compile_serializer(cls)
+        inst = create_class_from_xml_string(cls, xml_string)
+        generic = _generic(cls, xml_string)
+        assert inst == generic
+        assert _eq(inst.keyswv(), generic.keyswv())
+
+        tree = saml2.ElementTree.Element(saml2.qualified_tag(cls))
+        generic._generic_add_members_to_element_tree(tree)
+        assert inst.to_string() == saml2.ElementTree.tostring(
+            tree, encoding="UTF-8")
+
+
+def test_compiled_parser_fallback():
+    class Special(NameID):
+        def _convert_element_attribute_to_member(self, attribute, value):
+            SamlBase._convert_element_attribute_to_member(
+                self, attribute, value.upper())
+
+    assert saml2.compile_parser(Special) is None
+    inst = create_class_from_xml_string(Special, saml2_data.TEST_NAME_ID)
+    assert inst.format == \
+        "URN:OASIS:NAMES:TC:SAML:1.1:NAMEID-FORMAT:EMAILADDRESS"
+
+
+def test_lazy():
+    subject = create_class_from_xml_string(saml.Subject,
+                                           saml2_data.TEST_SUBJECT, lazy=True)
+    assert sorted(saml2._pending(subject).keys()) == [
+        "name_id", "subject_confirmation"]
+    assert subject.name_id.text.strip() == "tmatsuo@example.com"
+    assert saml2._pending(subject).keys() == ["subject_confirmation"]
+    assert len(subject.subject_confirmation) == 1
+    assert subject.subject_confirmation[0].method == saml.SCM_BEARER
+    assert saml2._pending(subject) is None
+
+    eager = create_class_from_xml_string(saml.Subject,
+                                         saml2_data.TEST_SUBJECT)
+    xml_string = eager.to_string()
+    lazy = create_class_from_xml_string(saml.Subject,
+                                        saml2_data.TEST_SUBJECT, lazy=True)
+    assert _eq(lazy.keyswv(), eager.keyswv())
+    lazy = create_class_from_xml_string(saml.Subject,
+                                        saml2_data.TEST_SUBJECT, lazy=True)
+    assert lazy == eager
+    lazy = create_class_from_xml_string(saml.Subject,
+                                        saml2_data.TEST_SUBJECT, lazy=True)
+    assert lazy.to_string() == xml_string
+
+    # A member given a new value before it was used keeps that value
+    lazy = create_class_from_xml_string(saml.Subject,
+                                        saml2_data.TEST_SUBJECT, lazy=True)
+    lazy.name_id = NameID(text="other@example.com")
+    assert lazy.to_string() != xml_string
+    assert lazy.name_id.text == "other@example.com"
+    # Writing doesn't build the other children
+    assert "subject_confirmation" in saml2._pending(lazy)
+
+
+def test_lazy_to_string():
+    # Children that are still XML are written from their nodes, the result
+    # is the same as for an eager parse
+    for name in ["saml_signed.xml", "saml2_response.xml",
+                 "simplesamlphp_authnresponse.xml"]:
+        xml_string = open(full_path(name)).read()
+        eager = samlp.any_response_from_string(xml_string)
+        lazy = samlp.any_response_from_string(xml_string, lazy=True)
+        assert lazy.to_string() == eager.to_string()
+        assert saml2._pending(lazy)
+
+    nameid = create_class_from_xml_string(NameID,
+                                          NAMEID_WITH_ATTRIBUTE_EXTENSION)
+    subject = saml.Subject(name_id=nameid)
+    lazy = create_class_from_xml_string(saml.Subject, subject.to_string(),
+                                        lazy=True)
+    assert lazy.to_string() == subject.to_string()
+
+
+def test_lazy_validation():
+    xml_string = saml2_data.TEST_SUBJECT.replace(
+        'Method="%s"' % saml.SCM_BEARER, "")
+    eager = create_class_from_xml_string(saml.Subject, xml_string)
+    raises(MustValueError, valid_instance, eager)
+
+    # Children that haven't been built are only counted
+    lazy = create_class_from_xml_string(saml.Subject, xml_string, lazy=True)
+    assert valid_instance(lazy)
+    assert sorted(saml2._pending(lazy).keys()) == [
+        "name_id", "subject_confirmation"]
+    # and checked when they are
+    assert lazy.name_id.text.strip() == "tmatsuo@example.com"
+    raises(MustValueError, getattr, lazy, "subject_confirmation")
+    raises(MustValueError, getattr, lazy, "subject_confirmation")
+
+    # Only once valid_instance has been through the instance
+    lazy = create_class_from_xml_string(saml.Subject, xml_string, lazy=True)
+    assert lazy.subject_confirmation[0].method is None
+
+
+def _tostring(inst):
+    return saml2.ElementTree.tostring(inst._to_element_tree(),
+                                      encoding="UTF-8")
+
+
+def test_to_string_direct():
+    for cls, xml_string in [(saml.Subject, saml2_data.TEST_SUBJECT),
+                            (saml.Conditions, saml2_data.TEST_CONDITIONS),
+                            (Attribute, saml2_data.TEST_ATTRIBUTE)]:
+        inst = create_class_from_xml_string(cls, xml_string)
+        assert inst.to_string() == _tostring(inst)
+
+    nameid = create_class_from_xml_string(NameID,
+                                          NAMEID_WITH_ATTRIBUTE_EXTENSION)
+    assert nameid.to_string() == _tostring(nameid)
+
+    # The prefixes are only used for this document
+    xml_string = nameid.to_string({"saml": saml.NAMESPACE})
+    assert "<saml:NameID" in xml_string
+    assert "saml:NameID" not in nameid.to_string()
+
+
+def test_to_string_after_changes():
+    subject = create_class_from_xml_string(saml.Subject,
+                                           saml2_data.TEST_SUBJECT)
+    assert str(subject) == subject.to_string()
+
+    subject.name_id.text = "other@example.com"
+    assert "other@example.com" in subject.to_string()
+    assert subject.to_string() == _tostring(subject)
+
+    subject.subject_confirmation.append(
+        saml.SubjectConfirmation(method=saml.SCM_HOLDER_OF_KEY))
+    assert saml.SCM_HOLDER_OF_KEY in subject.to_string()
+
+    subject.name_id.extension_attributes["foo"] = "bar"
+    assert 'foo="bar"' in subject.to_string()
+    assert subject.to_string() == _tostring(subject)
+
+
+COMPACT_CHECK = """
+import copy
+import pickle
+import saml2
+from saml2 import saml, samlp
+import saml2_data
+
+assert saml2.COMPACT
+nid = saml2.create_class_from_xml_string(saml.NameID, saml2_data.TEST_NAME_ID)
+assert not type(nid).__dictoffset__
+assert nid._extension_elements is None
+assert sorted(nid.keyswv()) == ["format", "sp_provided_id", "text"]
+assert nid == copy.copy(nid)
+assert nid == pickle.loads(pickle.dumps(nid))
+attr = saml.attribute_from_string(saml2_data.TEST_ATTRIBUTE)
+assert attr == pickle.loads(pickle.dumps(attr))
+
+attr = saml.Attribute().loadd({"name": "surName", "extension_attributes":
+                               {"foo": "bar"}})
+assert sorted(attr.keyswv()) == ["extension_attributes", "name"]
+assert attr.to_string() == saml.attribute_from_string(
+    attr.to_string()).to_string()
+
+subject = saml2.create_class_from_xml_string(saml.Subject,
+                                             saml2_data.TEST_SUBJECT, lazy=True)
+assert subject.subject_confirmation[0].method == saml.SCM_BEARER
+assert subject == saml.subject_from_string(saml2_data.TEST_SUBJECT)
+
+# Members added after the class was created and unknown attributes
+from saml2 import s_utils
+assert "assertion" in saml.EvidenceType_.__slots__
+scd = s_utils.factory(saml.SubjectConfirmationData, in_response_to="_1",
+                      not_a_member="x")
+assert scd.in_response_to == "_1"
+assert scd.not_a_member == "x"
+assert pickle.loads(pickle.dumps(scd)).not_a_member == "x"
+
+# __dict__ is a read-only view of the members
+assert scd.__dict__["in_response_to"] == "_1"
+assert scd.__dict__["not_a_member"] == "x"
+scd.__dict__["in_response_to"] = "_2"
+assert scd.in_response_to == "_1"
+"""
+
+
+def test_compact():
+    env = os.environ.copy()
+    env["PYSAML2_COMPACT"] = "1"
+    env["PYTHONPATH"] = os.pathsep.join(sys.path)
+    proc = subprocess.Popen([sys.executable, "-c", COMPACT_CHECK], env=env,
+                            stderr=subprocess.PIPE)
+    _, err = proc.communicate()
+    assert proc.returncode == 0, err
@@ -52,6 +52,32 @@ def test_inflate_then_deflate():
     bis = utils.decode_base64_and_inflate(interm)    
     assert bis == str
     
+def test_inflate_max_size():
+    xmlstr = "<a>%s</a>" % ("x" * 10000)
+    interm = utils.deflate_and_base64_encode(xmlstr)
+    assert utils.decode_base64_and_inflate(interm, 10007) == xmlstr
+    raises(utils.MessageTooLarge, utils.decode_base64_and_inflate, interm,
+           10006)
+
+    # Turned down long before all of it has been inflated
+    bomb = base64.b64encode(zlib.compress("\x00" * 50000000)[2:-4])
+    raises(utils.MessageTooLarge, utils.decode_base64_and_inflate, bomb,
+           100000)
+
+    # Less than a chunk of input that inflates to far more than the limit
+    deflated = zlib.compress("\x00" * 500000)[2:-4]
+    assert len(deflated) < 1024
+    assert utils.inflate(deflated, 500000) == "\x00" * 500000
+    assert utils.inflate(deflated) == "\x00" * 500000
+    raises(utils.MessageTooLarge, utils.inflate, deflated, 499999)
+
+
+def test_inflate_truncated():
+    deflated = zlib.compress("<a>%s</a>" % ("x" * 10000))[2:-4]
+    raises(zlib.error, utils.inflate, deflated[:-3], 100000)
+    raises(zlib.error, utils.inflate, deflated[:-3])
+    raises(zlib.error, zlib.decompress, deflated[:-3], -15)
+
 def test_status_success():
     status = utils.success_status_factory()
     status_text = "%s" % status
@@ -12,9 +12,12 @@ from saml2.validate import valid_unsigned_short
 from saml2.validate import valid_non_negative_integer
 from saml2.validate import valid_string
 from saml2.validate import valid_instance
+from saml2.validate import valid_element
+from saml2.validate import ShouldValueError
 from saml2.validate import valid_any_uri
 from saml2.validate import NotValid
 from saml2.validate import valid_anytype
+from saml2.validate import valid_date_time
 
 from py.test import raises
 
@@ -56,8 +59,22 @@ def test_valid_string():
     
     raises( NotValid, 'valid_string("02656c6c6f".decode("hex"))')
     
+    raises(NotValid, 'valid_string(u"a\\x01b")')
+    assert valid_string(u"\\u00e5\\U0001d11e\\t")
+    assert valid_string("\\xc3\\xa5")
+
 def test_valid_anyuri():
     assert valid_any_uri("urn:oasis:names:tc:SAML:2.0:attrname-format:uri")
+    assert valid_any_uri(u"https://[::1]:8080/sso")
+    raises(NotValid, 'valid_any_uri("http://[::1/sso")')
+
+def test_valid_date_time():
+    assert valid_date_time("2007-09-14T01:05:02Z")
+    assert valid_date_time(u"2007-09-14T01:05:02.123Z")
+    assert valid_date_time("2008-02-29T23:59:60Z")
+    raises(NotValid, 'valid_date_time("2007-02-29T01:05:02Z")')
+    raises(NotValid, 'valid_date_time("2007-09-14T24:05:02Z")')
+    raises(NotValid, 'valid_date_time("2007-09-14 01:05:02")')
     
 def test_valid_instance():
     attr_statem = saml.AttributeStatement()
@@ -95,7 +112,67 @@ def test_valid_instance():
     response.assertion.append(saml.Assertion())
 
     raises( MustValueError, 'valid_instance(response)')
+
+    response.assertion = []
+    assert valid_instance(response)
+    response.status.status_code = samlp.StatusCode(value="urn:some:code")
+    response.issue_instant = "2007-09-14"
+    raises(NotValid, 'valid_instance(response)')
+
+def test_valid_instance_cardinality():
+    idp = md.IDPSSODescriptor(
+        protocol_support_enumeration=samlp.NAMESPACE,
+        single_sign_on_service=[md.SingleSignOnService(
+            binding=saml2.BINDING_HTTP_REDIRECT,
+            location="https://idp.example.com/sso")])
+    assert valid_instance(idp)
+    idp.single_sign_on_service = []
+    raises(NotValid, 'valid_instance(idp)')
     
+def _check_tree(cls, inst):
+    tree = saml2.ElementTree.fromstring(inst.to_string())
+    try:
+        expected = valid_instance(
+            saml2.create_class_from_element_tree(cls, tree))
+    except (NotValid, ValueError), exc:
+        expected = (exc.__class__, exc.args)
+    try:
+        res = valid_element(cls, tree)
+    except (NotValid, ValueError), exc:
+        res = (exc.__class__, exc.args)
+    assert res == expected
+    return res
+
+
+def test_valid_element():
+    idp = md.IDPSSODescriptor(
+        protocol_support_enumeration=samlp.NAMESPACE,
+        single_sign_on_service=[md.SingleSignOnService(
+            binding=saml2.BINDING_HTTP_REDIRECT,
+            location="https://idp.example.com/sso")])
+    assert _check_tree(md.IDPSSODescriptor, idp) is True
+
+    idp.single_sign_on_service[0].binding = None
+    assert _check_tree(md.IDPSSODescriptor, idp)[0] is MustValueError
+    idp.single_sign_on_service = []
+    assert _check_tree(md.IDPSSODescriptor, idp)[0] is NotValid
+    idp.single_sign_on_service = [md.SingleSignOnService(
+        binding=saml2.BINDING_HTTP_REDIRECT,
+        location="https://idp.example.com/sso")]
+    idp.valid_until = "tomorrow"
+    assert _check_tree(md.IDPSSODescriptor, idp)[0] is NotValid
+
+    # A child with its own verify()
+    statement = saml.AuthnStatement(
+        authn_instant="2007-09-14T01:05:02Z",
+        authn_context=saml.AuthnContext(
+            authn_context_class_ref=saml.AuthnContextClassRef(
+                text=saml.AUTHN_PASSWORD)),
+        subject_locality=saml.SubjectLocality(address="not an address"))
+    assert _check_tree(saml.AuthnStatement, statement)[0] is \
+        ShouldValueError
+
+
 def test_valid_anytype():
     assert valid_anytype("130.239.16.3")
     assert valid_anytype("textstring")
@@ -1,7 +1,11 @@
 __author__ = 'rolandh'
 
 from saml2 import md
+from saml2 import ElementTree
+from saml2 import create_class_from_element_tree
 from saml2.mdie import from_dict
+from saml2.mdie import to_dict
+from saml2.mdie import tree_to_dict
 
 from saml2 import saml
 
@@ -10,6 +14,7 @@ from saml2.extension import idpdisc
 from saml2.extension import dri
 from saml2.extension import mdattr
 from saml2.extension import ui
+from saml2.extension import shibmd
 import xmldsig
 import xmlenc
 
@@ -22,9 +27,12 @@ ONTS = {
     idpdisc.NAMESPACE: idpdisc,
     md.NAMESPACE: md,
     xmldsig.NAMESPACE: xmldsig,
-    xmlenc.NAMESPACE: xmlenc
+    xmlenc.NAMESPACE: xmlenc,
+    shibmd.NAMESPACE: shibmd
 }
 
+from pathutils import full_path
+
 
 def _eq(l1, l2):
     return set(l1) == set(l2)
@@ -48,3 +56,24 @@ def test_construct_contact():
     assert c.sur_name.text == "Hedberg"
     assert c.email_address[0].text == "roland@catalogix.se"
     assert _eq(c.keyswv(), ["given_name", "sur_name", "email_address"])
+
+
+def test_tree_to_dict():
+    onts = ONTS.values()
+    for fil in ["swamid-1.0.xml", "InCommon-metadata.xml", "extended.xml",
+                "metadata_example.xml"]:
+        root = ElementTree.parse(full_path(fil)).getroot()
+        for tree in root.iter("{%s}EntityDescriptor" % md.NAMESPACE):
+            inst = create_class_from_element_tree(md.EntityDescriptor, tree)
+            for mdb_safe in [False, True]:
+                assert tree_to_dict(tree, md.EntityDescriptor, onts,
+                                    mdb_safe) == to_dict(inst, onts, mdb_safe)
+
+
+def test_tree_to_dict_defaults():
+    tree = ElementTree.fromstring(
+        '<shibmd:Scope xmlns:shibmd="urn:mace:shibboleth:metadata:1.0">'
+        'example.com</shibmd:Scope>')
+    assert tree_to_dict(tree, shibmd.Scope, ONTS.values()) == {
+        "__class__": _class(shibmd.Scope), "regexp": "false",
+        "text": "example.com"}
@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
+import copy
 import datetime
+import os
 import re
 
 from saml2.mdstore import MetadataStore
+from saml2.mdstore import MetaData
+from saml2.mdstore import MetaDataFile
+from saml2.mdstore import MetaDataShared
+from saml2.mdstore import cert_active
 from saml2.mdstore import destinations
 from saml2.mdstore import name
 
 from saml2 import md, sigver
+from saml2 import time_util
 from saml2 import BINDING_SOAP
 from saml2 import BINDING_HTTP_REDIRECT
 from saml2 import BINDING_HTTP_POST
@@ -20,14 +27,20 @@ from saml2.extension import mdui
 from saml2.extension import idpdisc
 from saml2.extension import dri
 from saml2.extension import mdattr
+from saml2.extension import mdrpi
 from saml2.extension import ui
 from saml2.s_utils import UnknownPrincipal
+from saml2.s_utils import UnsupportedBinding
 import xmldsig
 import xmlenc
 
 from pathutils import full_path
 
+from py.test import raises
+
 sec_config = config.Config()
+SNAPSHOT = full_path("metadata.snapshot")
+SHARED = full_path("metadata.shared")
 #sec_config.xmlsec_binary = sigver.get_xmlsec_binary(["/opt/local/bin"])
 
 ONTS = {
@@ -249,5 +262,372 @@ def test_metadata_file():
     print len(mds.keys())
     assert len(mds.keys()) == 560
 
+
+def test_reload_invalidates_cert_cache():
+    mds = MetadataStore(ONTS.values(), ATTRCONV, sec_config,
+                        disable_ssl_certificate_validation=True)
+    fil = full_path("metadata_cert.xml")
+    eid = "urn:mace:example.com:saml:roland:sp"
+    mds.load("local", fil)
+    cert = mds.certs(eid, "any")[0]
+    sigver.CERT_CACHE.pem_file(cert, eid)
+
+    # Same content, the cached certificate survives
+    mds.load("local", fil)
+    assert cert in sigver.CERT_CACHE
+
+    # Entity description changed since the last load
+    mds.metadata[fil].entity[eid] = {}
+    mds.load("local", fil)
+    assert cert not in sigver.CERT_CACHE
+
+
+def test_entity_index():
+    mds = MetadataStore(ONTS.values(), ATTRCONV, sec_config,
+                        disable_ssl_certificate_validation=True)
+    sp = "urn:mace:example.com:saml:roland:sp"
+    idp = "http://xenosmilus.umdc.umu.se/simplesaml/saml2/idp/metadata.php"
+    first = full_path("metadata_sp_1.xml")
+    second = full_path("metadata_cert.xml")
+    for fil in [first, second, full_path("metadata_example.xml")]:
+        mds.load("local", fil)
+
+    # Described in two sources, the one loaded first is used
+    assert _eq(mds.keys(), [sp, idp])
+    assert mds.entities() == 2
+    assert sp in mds
+    assert "urn:example:unknown" not in mds
+    assert mds[sp] is mds.metadata[first][sp]
+    assert mds.name(idp) == "Catalogix"
+    assert mds.name("urn:example:unknown") is None
+    assert mds.bindings(sp, "spsso_descriptor",
+                        "assertion_consumer_service").keys() == [
+        BINDING_HTTP_POST]
+
+    # The source is refreshed and doesn't describe the SP any longer
+    mds[first] = MetaData(ONTS.values(), ATTRCONV)
+    assert mds[sp] is mds.metadata[second][sp]
+    mds[second] = MetaData(ONTS.values(), ATTRCONV)
+    assert mds.keys() == [idp]
+    raises(UnknownPrincipal, mds.assertion_consumer_service, sp)
+
+    # All the sources replaced at once
+    mds.metadata = {"sp": mds.metadata[first]}
+    assert mds.keys() == []
+
+    # The entities of a source, or the sources, changed directly
+    mds.metadata["sp"].entity[sp] = {}
+    assert mds.keys() == [sp]
+    assert mds[sp] == {}
+    assert mds.query(role="spsso") == set()
+    mds.metadata["sp"].entity[sp] = {"spsso_descriptor": [{}]}
+    assert mds.query(role="spsso") == set([sp])
+    mds.metadata["sp"].entity = {}
+    assert sp not in mds
+    mds.metadata["idp"] = MetaDataFile(ONTS.values(), ATTRCONV,
+                                       full_path("metadata_example.xml"))
+    mds.metadata["idp"].load()
+    assert mds.keys() == [idp]
+    del mds.metadata["idp"]
+    assert mds.keys() == []
+
+
+class CopyingMetaData(MetaData):
+    """ Returns a new copy of an entity every time, like MetadataMDB """
+
+    def __getitem__(self, item):
+        return copy.deepcopy(self.entity[item])
+
+
+def test_entity_index_copies():
+    mds = MetadataStore(ONTS.values(), ATTRCONV, sec_config,
+                        disable_ssl_certificate_validation=True)
+    source = CopyingMetaData(ONTS.values(), ATTRCONV,
+                             open(full_path("metadata_sp_1.xml")).read())
+    source.load()
+    mds.metadata = {"copies": source}
+    sp = "urn:mace:example.com:saml:roland:sp"
+    tables = source._tables(sp)
+    assert mds.assertion_consumer_service(sp)
+    assert source._tables(sp) is tables
+    assert mds.keys() == [sp]
+
+
+def test_endpoint_order():
+    xmlstr = open(full_path("metadata_sp_1.xml")).read()
+    acs = ('<ns0:AssertionConsumerService Binding="%s" '
+           'Location="http://lingon.catalogix.se:8087/%s" index="%d" %s/>')
+    pos = xmlstr.index("<ns0:AssertionConsumerService")
+    xmlstr = xmlstr[:pos] + "".join([
+        acs % (BINDING_HTTP_POST, "no", 2, 'isDefault="false"'),
+        acs % (BINDING_HTTP_REDIRECT, "redirect", 3, ''),
+        acs % (BINDING_HTTP_POST, "default", 4, 'isDefault="true"')]) + \
+        xmlstr[pos:]
+    mds = MetadataStore(ONTS.values(), ATTRCONV, sec_config,
+                        disable_ssl_certificate_validation=True)
+    mds.load("inline", xmlstr)
+    sp = "urn:mace:example.com:saml:roland:sp"
+
+    assert destinations(mds.assertion_consumer_service(sp)) == [
+        "http://lingon.catalogix.se:8087/default",
+        "http://lingon.catalogix.se:8087/",
+        "http://lingon.catalogix.se:8087/no"]
+    bindings = mds.bindings(sp, "spsso_descriptor",
+                            "assertion_consumer_service")
+    assert _eq(bindings.keys(), [BINDING_HTTP_POST, BINDING_HTTP_REDIRECT])
+    assert bindings[BINDING_HTTP_POST] == mds.assertion_consumer_service(sp)
+    raises(UnsupportedBinding, mds.assertion_consumer_service, sp,
+           BINDING_SOAP)
+    raises(UnknownPrincipal, mds.single_sign_on_service, sp)
+
+    # The entity description is replaced, so is the endpoint table
+    md = mds.metadata.values()[0]
+    md.entity[sp] = {"spsso_descriptor": [{"assertion_consumer_service": [
+        {"binding": BINDING_HTTP_POST, "location": "http://example.com/"}]}]}
+    assert destinations(mds.assertion_consumer_service(sp)) == [
+        "http://example.com/"]
+
+
+def test_cert_index():
+    xmlstr = open(full_path("metadata_cert.xml")).read()
+    response = open(full_path("saml2_response.xml")).read()
+    cert = re.search(r"X509Certificate>([^<]*)<", response).group(1)
+    # A certificate without a use after the old signing certificate
+    pos = xmlstr.index("<ns0:ArtifactResolutionService")
+    xmlstr = xmlstr[:pos] + (
+        '<ns0:KeyDescriptor><ns1:KeyInfo><ns1:X509Data><ns1:X509Certificate>'
+        '%s</ns1:X509Certificate></ns1:X509Data></ns1:KeyInfo>'
+        '</ns0:KeyDescriptor>' % cert) + xmlstr[pos:]
+    mds = MetadataStore(ONTS.values(), ATTRCONV, sec_config,
+                        disable_ssl_certificate_validation=True)
+    mds.load("inline", xmlstr)
+    sp = "urn:mace:example.com:saml:roland:sp"
+
+    signing = mds.cert_info(sp, "any", "signing")
+    assert len(signing) == 2
+    assert mds.cert_info(sp, "spsso", "signing") == signing
+    assert [i["use"] for i in signing] == ["signing", None]
+    for info in signing:
+        assert info["fingerprint"] == sigver.cert_fingerprint(info["cert"])
+        assert info["not_before"] < info["not_after"]
+    assert [i["cert"] for i in mds.cert_info(sp, "any", "encryption")] == [
+        signing[1]["cert"]]
+    assert mds.cert_info(sp, "idpsso", "signing") == []
+    raises(KeyError, mds.cert_info, "urn:example:unknown")
+
+    # The old certificate is tried last
+    old = signing[0]
+    assert old["not_after"] < time_util.utc_now()
+    assert not cert_active(old)
+    assert cert_active(old, old["not_before"])
+    assert mds.certs(sp, "any", "signing")[-1] == old["cert"]
+    assert sigver.cert_fingerprint(
+        mds.certs(sp, "any", "encryption")[0]) == sigver.cert_fingerprint(cert)
+
+
+def test_query():
+    idp = "http://xenosmilus.umdc.umu.se/simplesaml/saml2/idp/metadata.php"
+    sp = "urn:mace:example.com:saml:roland:sp"
+    vo = "urn:mace:example.com:it:tek"
+    swamid = "http://www.swamid.se/"
+    hei = "http://www.swamid.se/category/hei-service"
+    sfs = "http://www.swamid.se/category/sfs-1993-1153"
+
+    xmlstr = open(full_path("metadata_example.xml")).read()
+    pos = xmlstr.index("<IDPSSODescriptor")
+    xmlstr = xmlstr[:pos] + (
+        '<Extensions><mdrpi:RegistrationInfo '
+        'xmlns:mdrpi="urn:oasis:names:tc:SAML:metadata:rpi" '
+        'registrationAuthority="%s"/></Extensions>' % swamid) + xmlstr[pos:]
+    onts = ONTS.values() + [mdrpi]
+    mds = MetadataStore(onts, ATTRCONV, sec_config,
+                        disable_ssl_certificate_validation=True)
+    mds.load("inline", xmlstr)
+    mds.load("local", full_path("entity_cat_sfs_hei.xml"))
+    mds.load("inline", _fix_valid_until(
+        open(full_path("vo_metadata.xml")).read()))
+
+    assert mds.query() == set([idp, sp, vo])
+    assert mds.query(role="idpsso") == set([idp])
+    assert mds.with_descriptor("idpsso").keys() == [idp]
+    assert mds.with_descriptor("spsso") == {sp: mds[sp]}
+    assert mds.query(role=["idpsso", "spsso"]) == set([idp, sp])
+    assert mds.query(role="spsso", entity_category=hei) == set([sp])
+    assert mds.query(role="idpsso", entity_category=hei) == set()
+    assert mds.query(registration_authority=swamid) == set([idp])
+    assert mds.query(affiliation_member="urn:mace:example.com:saml:idp") == \
+        set([vo])
+    assert mds.count(role="spsso") == 1
+    assert mds.count(role="spsso", entity_category=[hei, sfs]) == 1
+    assert mds.count(role="pdp") == 0
+    assert mds.counts("role") == {"idpsso": 1, "spsso": 1, "affiliation": 1}
+    assert mds.counts("entity_category", role="spsso") == {hei: 1, sfs: 1}
+
+    assert _eq(mds.entity_categories(sp), [hei, sfs])
+    assert mds.entity_categories(idp) == []
+    assert mds.registration_authority(idp) == swamid
+    assert mds.registration_authority(sp) is None
+    assert mds.vo_members(vo) == ["urn:mace:example.com:saml:aa",
+                                  "urn:mace:example.com:saml:idp"]
+    raises(KeyError, mds.vo_members, idp)
+    raises(KeyError, mds.entity_categories, "urn:example:unknown")
+
+    # A refreshed source no longer has the SP
+    key = full_path("entity_cat_sfs_hei.xml")
+    mds[key] = MetaData(onts, ATTRCONV)
+    assert mds.query(entity_category=hei) == set()
+    assert mds.counts("role") == {"idpsso": 1, "affiliation": 1}
+
+
+def test_parse_stream():
+    fil = full_path("swamid-1.0.xml")
+    mdf = MetaDataFile(ONTS.values(), ATTRCONV, fil)
+    mdf.load()
+
+    # Same result as when converting the whole aggregate at once
+    mda = MetaData(ONTS.values(), ATTRCONV)
+    entities = md.entities_descriptor_from_string(open(fil).read())
+    for ent in entities.entity_descriptor:
+        mda.do_entity_descriptor(ent)
+    assert len(mdf.keys()) == 143
+    assert mdf.entity == mda.entity
+
+    # A single entity descriptor
+    mdi = MetaData(ONTS.values(), ATTRCONV,
+                   open(full_path("metadata_sp_1.xml")).read())
+    mdi.load()
+    assert mdi.keys() == ["urn:mace:example.com:saml:roland:sp"]
+
+
+def test_parse_stream_invalid():
+    xmlstr = open(full_path("swamid-1.0.xml")).read()
+    # Break the last entity descriptor
+    pos = xmlstr.rindex('entityID="')
+    xmlstr = xmlstr[:pos] + 'cacheDuration="forever" ' + xmlstr[pos:]
+
+    mdi = MetaData(ONTS.values(), ATTRCONV, xmlstr)
+    mdi.entity["urn:example:kept"] = {}
+    mdi.load()
+    # Nothing from the invalid aggregate is used
+    assert mdi.keys() == ["urn:example:kept"]
+
+
+def _snapshot_store(inline):
+    mds = MetadataStore(ONTS.values(), ATTRCONV, sec_config)
+    mds.load_snapshot(SNAPSHOT)
+    mds.load("local", full_path("swamid-1.0.xml"))
+    mds.load("inline", inline)
+    return mds
+
+
+def test_snapshot():
+    if os.path.exists(SNAPSHOT):
+        os.unlink(SNAPSHOT)
+    sp = open(full_path("metadata_sp_1.xml")).read()
+    mds = _snapshot_store(sp)
+    assert mds.snapshot_stale()
+    mds.dump_snapshot(SNAPSHOT)
+
+    restored = _snapshot_store(sp)
+    assert not restored.snapshot_stale()
+    for md in restored.metadata.values():
+        assert md.restored
+    assert dict(restored.items()) == dict(mds.items())
+    eid = "https://idp.umu.se/saml2/idp/metadata.php"
+    assert restored.certs(eid, "idpsso", "signing") == mds.certs(
+        eid, "idpsso", "signing")
+    assert restored.counts("role") == mds.counts("role")
+    assert restored.single_sign_on_service(eid, BINDING_HTTP_REDIRECT) == \
+        mds.single_sign_on_service(eid, BINDING_HTTP_REDIRECT)
+
+    # A source that has changed is parsed again
+    changed = _snapshot_store(sp.replace("roland:sp", "roland:sp2"))
+    assert changed.snapshot_stale()
+    assert [md.restored for md in changed.metadata.values()].count(True) == 1
+    assert "urn:mace:example.com:saml:roland:sp2" in changed
+    assert "urn:mace:example.com:saml:roland:sp" not in changed
+
+    # Only the owner can change it, one others can change isn't used
+    assert os.stat(SNAPSHOT).st_mode & 0777 == 0600
+    os.chmod(SNAPSHOT, 0622)
+    assert not MetadataStore(ONTS.values(), ATTRCONV,
+                             sec_config).load_snapshot(SNAPSHOT)
+    os.chmod(SNAPSHOT, 0600)
+
+    # Entities that have expired since the snapshot was made are left out
+    expired = MetaData(ONTS.values(), ATTRCONV, sp)
+    entity_id, ent, endpoints, certs, facets = \
+        mds.metadata[1].snapshot_entities()[0]
+    ent = dict(ent, valid_until="2000-01-01T00:00:00Z")
+    expired.snapshot = (mds.metadata[1].source_hash,
+                        [(entity_id, ent, endpoints, certs, facets)])
+    expired.load()
+    assert expired.restored
+    assert expired.keys() == []
+    # and one that is broken isn't used
+    broken = MetaData(ONTS.values(), ATTRCONV, sp)
+    broken.snapshot = (mds.metadata[1].source_hash, [("x", {})])
+    broken.load()
+    assert not broken.restored
+    assert broken.keys() == ["urn:mace:example.com:saml:roland:sp"]
+
+    # Files that aren't snapshots are ignored
+    for junk in ["", "pysaml2 metadata snapshot\nnot marshal",
+                 open(SNAPSHOT, "rb").read()[:1000]]:
+        open(SNAPSHOT, "wb").write(junk)
+        mds = MetadataStore(ONTS.values(), ATTRCONV, sec_config)
+        assert not mds.load_snapshot(SNAPSHOT)
+    os.unlink(SNAPSHOT)
+    assert not mds.load_snapshot(SNAPSHOT)
+
+
+def test_shared():
+    mds = MetadataStore(ONTS.values(), ATTRCONV, sec_config)
+    mds.load("local", full_path("swamid-1.0.xml"))
+    mds.load("local", full_path("metadata_sp_1.xml"))
+    mds.publish(SHARED)
+
+    worker = MetadataStore(ONTS.values(), ATTRCONV, sec_config)
+    worker.load("shared", SHARED)
+    shared = worker.metadata[SHARED]
+    assert isinstance(shared, MetaDataShared)
+    assert dict(worker.items()) == dict(mds.items())
+    assert worker.counts("role") == mds.counts("role")
+    eid = "https://idp.umu.se/saml2/idp/metadata.php"
+    assert worker.certs(eid, "idpsso") == mds.certs(eid, "idpsso")
+    assert worker.single_sign_on_service(eid, BINDING_HTTP_REDIRECT) == \
+        mds.single_sign_on_service(eid, BINDING_HTTP_REDIRECT)
+    assert shared._tables(eid) is shared._tables(eid)
+
+    # Only the recently used entities are kept decoded
+    small = MetaDataShared(ONTS.values(), ATTRCONV, SHARED, cache_size=10)
+    small.load()
+    for entity_id in small.keys():
+        assert small[entity_id] == mds[entity_id]
+    assert len(small._recent) + len(small._older) <= 20
+
+    assert worker.refresh() == []
+    sp = "urn:mace:example.com:saml:roland:sp"
+    mds.metadata = {"sp": mds.metadata[full_path("metadata_sp_1.xml")]}
+    mds.publish(SHARED)
+    assert worker.refresh() == [SHARED]
+    assert worker.keys() == [sp]
+    assert worker.refresh() == []
+    # The file that was replaced is no longer mapped
+    assert shared._map is None
+    assert shared.keys() == []
+
+    # One that others can write to isn't used
+    os.chmod(SHARED, 0664)
+    raises(ValueError, MetaDataShared(ONTS.values(), ATTRCONV, SHARED).load)
+    os.chmod(SHARED, 0644)
+
+    open(SHARED, "wb").write("pysaml2 shared metadata\n")
+    raises(ValueError, MetaDataShared(ONTS.values(), ATTRCONV, SHARED).load)
+    # The one that was loaded is kept
+    assert worker.refresh() == []
+    assert worker.keys() == [sp]
+    os.unlink(SHARED)
+
 if __name__ == "__main__":
     test_metadata_file()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from StringIO import StringIO
+
+from saml2 import c14n
+from saml2 import xmlbackend
+
+from py.test import raises
+
+# The backend in use (PYSAML2_XML_BACKEND) must give the same result as
+# saml2.c14n does
+
+DOC = """<n0:local xmlns:n0="foo:bar" xmlns:n3="ftp://example.org">
+  <n1:elem2 xmlns:n1="http://example.net" xml:lang="en">
+    <n3:stuff xmlns:n3="ftp://example.org"/>
+    <!-- comment -->tail
+  </n1:elem2>
+</n0:local>"""
+
+ELEM2 = "{http://example.net}elem2"
+STUFF = "{ftp://example.org}stuff"
+
+
+class _C14N(object):
+    """ What the etree backend uses """
+    parse_document = staticmethod(c14n.parse)
+    canonicalize = staticmethod(c14n.canonicalize)
+    set_text = staticmethod(xmlbackend._c14n_set_text)
+    replace = staticmethod(xmlbackend._c14n_replace)
+
+
+def _both(func):
+    """ func(backend, root) done with saml2.c14n and the backend in use """
+    return (func(_C14N, _C14N.parse_document(DOC)),
+            func(xmlbackend, xmlbackend.parse_document(DOC)))
+
+
+def test_canonicalize():
+    for kwargs in [{"exclusive": True}, {"exclusive": False},
+                   {"exclusive": True, "inclusive_prefixes": ["n0"]},
+                   {"exclusive": False, "with_comments": True}]:
+        expected, res = _both(
+            lambda backend, root: backend.canonicalize(root.find(ELEM2),
+                                                       **kwargs))
+        assert res == expected
+
+
+def test_canonicalize_exclude():
+    def exclude(backend, root):
+        elem2 = root.find(ELEM2)
+        return backend.canonicalize(elem2, exclude=(elem2.find(STUFF),))
+
+    expected, res = _both(exclude)
+    assert res == expected
+    assert "stuff" not in res
+
+    # Nothing is missing from the tree afterwards
+    root = xmlbackend.parse_document(DOC)
+    before = xmlbackend.canonicalize(root, with_comments=True)
+    exclude(xmlbackend, root)
+    assert xmlbackend.canonicalize(root, with_comments=True) == before
+
+
+def test_set_text():
+    def set_text(backend, root):
+        backend.set_text(root.find(ELEM2), "abc")
+        return backend.canonicalize(root)
+
+    expected, res = _both(set_text)
+    assert res == expected
+    assert '<n1:elem2 xmlns:n1="http://example.net" xml:lang="en">abc<' in res
+
+
+def test_replace():
+    def replace(backend, root):
+        elem2 = root.find(ELEM2)
+        backend.replace(elem2.find(STUFF),
+                        'before<n3:new a="1"><n0:inner/></n3:new>after')
+        return backend.canonicalize(root, exclusive=False)
+
+    expected, res = _both(replace)
+    assert res == expected
+    assert 'before<n3:new a="1"><n0:inner></n0:inner></n3:new>after\n' in res
+
+    root = xmlbackend.parse_document(DOC)
+    stuff = root.find(ELEM2).find(STUFF)
+    raises(xmlbackend.ParseError, xmlbackend.replace, stuff, "<a>")
+
+
+def test_get_parent():
+    root = xmlbackend.parse_document(DOC)
+    elem2 = root.find(ELEM2)
+    assert xmlbackend.get_parent(elem2) is root
+    assert xmlbackend.get_parent(root) is None
+
+
+def test_fromstring():
+    root = xmlbackend.fromstring(DOC)
+    assert [e.tag for e in root.iter() if isinstance(e.tag, basestring)] == [
+        "{foo:bar}local", ELEM2, STUFF]
+    elem2 = root.find(ELEM2)
+    assert elem2.get("{http://www.w3.org/XML/1998/namespace}lang") == "en"
+    assert xmlbackend.fromstring(
+        xmlbackend.tostring(elem2)).find(STUFF) is not None
+    raises(xmlbackend.TreeParseError, xmlbackend.fromstring, "<a>")
+
+
+def test_iterparse():
+    tags = [(event, elem.tag) for event, elem in
+            xmlbackend.iterparse(StringIO(DOC), ("start", "end"))]
+    assert tags == [("start", "{foo:bar}local"), ("start", ELEM2),
+                    ("start", STUFF), ("end", STUFF), ("end", ELEM2),
+                    ("end", "{foo:bar}local")]
+
+
+def test_no_doctype():
+    doc = '<!DOCTYPE a [<!ENTITY e "x">]><a>&e;</a>'
+    raises(xmlbackend.ParseError, xmlbackend.parse_document, doc)
+    raises(xmlbackend.TreeParseError, xmlbackend.fromstring, doc)
+    raises(xmlbackend.TreeParseError, list,
+           xmlbackend.iterparse(StringIO(doc)))
+
+    # what the etree backend does, whichever backend is in use
+    raises(xmlbackend.TreeParseError, xmlbackend._etree_fromstring, doc)
+    raises(xmlbackend.TreeParseError, list,
+           xmlbackend._etree_iterparse(StringIO(doc), ("end",)))
+    raises(xmlbackend.TreeParseError, xmlbackend._etree_fromstring, "<a>")
+    root = xmlbackend._etree_fromstring(DOC)
+    assert root.find(ELEM2).find(STUFF) is not None
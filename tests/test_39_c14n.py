@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from saml2 import c14n
+
+from py.test import raises
+
+# Example from section 2.2 of the Exclusive XML Canonicalization spec
+DOC = """<n0:local xmlns:n0="foo:bar" xmlns:n3="ftp://example.org">
+  <n1:elem2 xmlns:n1="http://example.net" xml:lang="en">
+    <n3:stuff xmlns:n3="ftp://example.org"/>
+  </n1:elem2>
+</n0:local>"""
+
+
+def _elem2():
+    root = c14n.parse(DOC)
+    return root.find("{http://example.net}elem2")
+
+
+def test_parse():
+    root = c14n.parse(DOC)
+    assert root.qname == "n0:local"
+    assert root.tag == "{foo:bar}local"
+    assert root.nsdecl == {"n0": "foo:bar", "n3": "ftp://example.org"}
+    elem2 = root.find("{http://example.net}elem2")
+    assert elem2.get("{http://www.w3.org/XML/1998/namespace}lang") == "en"
+    assert elem2.parent is root
+    assert [e.tag for e in root.iter()] == [
+        "{foo:bar}local", "{http://example.net}elem2",
+        "{ftp://example.org}stuff"]
+
+
+def test_exclusive():
+    assert c14n.canonicalize(_elem2(), exclusive=True) == (
+        '<n1:elem2 xmlns:n1="http://example.net" xml:lang="en">\n'
+        '    <n3:stuff xmlns:n3="ftp://example.org"></n3:stuff>\n'
+        '  </n1:elem2>')
+
+
+def test_inclusive():
+    assert c14n.canonicalize(_elem2(), exclusive=False) == (
+        '<n1:elem2 xmlns:n0="foo:bar" xmlns:n1="http://example.net" '
+        'xmlns:n3="ftp://example.org" xml:lang="en">\n'
+        '    <n3:stuff></n3:stuff>\n'
+        '  </n1:elem2>')
+
+
+def test_inclusive_prefixes():
+    assert c14n.canonicalize(_elem2(), exclusive=True,
+                             inclusive_prefixes=["n0"]) == (
+        '<n1:elem2 xmlns:n0="foo:bar" xmlns:n1="http://example.net" '
+        'xml:lang="en">\n'
+        '    <n3:stuff xmlns:n3="ftp://example.org"></n3:stuff>\n'
+        '  </n1:elem2>')
+
+
+def test_exclude():
+    elem2 = _elem2()
+    stuff = elem2.find("{ftp://example.org}stuff")
+    assert c14n.canonicalize(elem2, exclude=(stuff,)) == (
+        '<n1:elem2 xmlns:n1="http://example.net" xml:lang="en">\n'
+        '    \n'
+        '  </n1:elem2>')
+
+
+def test_attributes_and_escaping():
+    doc = ('<e xmlns="http://example.com/default" xmlns:b="urn:b" '
+           'xmlns:a="urn:a" b:x="1" a:x="2" z="&quot;&amp;&lt;&#xD;" '
+           'a="&#x9;">&lt;&gt;&amp;<!-- comment --><?pi data?></e>')
+    root = c14n.parse(doc)
+    assert c14n.canonicalize(root, exclusive=False) == (
+        '<e xmlns="http://example.com/default" xmlns:a="urn:a" '
+        'xmlns:b="urn:b" a="&#x9;" z="&quot;&amp;&lt;&#xD;" a:x="2" '
+        'b:x="1">&lt;&gt;&amp;<?pi data?></e>')
+    assert c14n.canonicalize(root, exclusive=False, with_comments=True) == (
+        '<e xmlns="http://example.com/default" xmlns:a="urn:a" '
+        'xmlns:b="urn:b" a="&#x9;" z="&quot;&amp;&lt;&#xD;" a:x="2" '
+        'b:x="1">&lt;&gt;&amp;<!-- comment --><?pi data?></e>')
+
+
+def test_default_namespace_undeclared():
+    root = c14n.parse('<a xmlns="urn:a"><b xmlns=""><c/></b></a>')
+    assert c14n.canonicalize(root) == (
+        '<a xmlns="urn:a"><b xmlns=""><c></c></b></a>')
+    assert c14n.canonicalize(root.children[0]) == '<b><c></c></b>'
+
+
+def test_no_doctype():
+    raises(c14n.ParseError, c14n.parse,
+           '<!DOCTYPE a [<!ENTITY e "x">]><a>&e;</a>')
+
+
+def test_tostring():
+    root = c14n.parse(DOC)
+    assert c14n.tostring(root, xml_declaration=False) == (
+        '<n0:local xmlns:n0="foo:bar" xmlns:n3="ftp://example.org">\n'
+        '  <n1:elem2 xmlns:n1="http://example.net" xml:lang="en">\n'
+        '    <n3:stuff xmlns:n3="ftp://example.org"/>\n'
+        '  </n1:elem2>\n'
+        '</n0:local>')
+    assert c14n.tostring(root).startswith("<?xml version='1.0'")
+
+
+def test_parse_fragment():
+    nodes = c14n.parse_fragment('<n1:a xmlns:n1="urn:a"><n0:b/></n1:a>text',
+                                {"n0": "foo:bar"})
+    assert len(nodes) == 2
+    assert nodes[0].tag == "{urn:a}a"
+    assert nodes[0].parent is None
+    assert nodes[0].children[0].tag == "{foo:bar}b"
+    assert nodes[1] == u"text"
@@ -1,6 +1,14 @@
 #!/usr/bin/env python
 
 import base64
+import calendar
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
 from saml2.mdstore import MetadataStore
 from saml2.saml import assertion_from_string
 from saml2.samlp import response_from_string
@@ -11,6 +19,9 @@ from saml2 import time_util
 from saml2 import saml, samlp
 from saml2 import config
 from saml2.s_utils import factory, do_attribute_statement
+from saml2 import extension_element_to_element
+import xmlenc as xenc
+import M2Crypto
 
 from py.test import raises
 
@@ -95,6 +106,20 @@ class FakeConfig():
     key_file = PRIV_KEY
     debug = False
 
+class FakeMetadata():
+    def __init__(self, certs, entities=None):
+        self._certs = certs
+        self._entities = entities
+
+    def certs(self, entity_id, descriptor, use="signing"):
+        return self._certs
+
+    def __getitem__(self, entity_id):
+        if self._entities is not None and entity_id not in self._entities:
+            raise KeyError(entity_id)
+        return {}
+
+
 class TestSecurity():
 
     def setup_class(self):
@@ -378,6 +403,419 @@ class TestSecurity():
                 s_response, response2, class_name(response2))
 
 
+class TestSecurityM2Crypto(TestSecurity):
+    """ The same tests as for xmlsec1 but signing and verifying in-process """
+
+    def setup_class(self):
+        TestSecurity.setup_class.im_func(self)
+        conf = FakeConfig()
+        conf.crypto_backend = 'M2Crypto'
+        self.sec = sigver.security_context(conf)
+
+    def test_backend(self):
+        assert isinstance(self.sec.crypto, sigver.CryptoBackendM2Crypto)
+
+    def test_sign_statements_any_order(self):
+        response = factory(samlp.Response,
+                           assertion=self._assertion,
+                           id="22222",
+                           signature=sigver.pre_signature_part(
+                               "22222", self.sec.my_cert))
+
+        # outermost first, the inner signature is still made first
+        s_response = self.sec.sign_statements(
+            "%s" % response,
+            [(class_name(response), response.id, ""),
+             (class_name(self._assertion), self._assertion.id, "")])
+
+        response = response_from_string(s_response)
+        assert self.sec.check_signature(response, class_name(response),
+                                        s_response, must=True)
+        assertion = response.assertion[0]
+        assert self.sec.check_signature(assertion, class_name(assertion),
+                                        s_response, must=True)
+
+    def test_verify_signature(self):
+        xml_response = open(SIGNED).read()
+        response = samlp.response_from_string(xml_response)
+        assertion = response.assertion[0]
+        _, pem_file = sigver.make_temp(
+            sigver.pem_format(sigver.cert_from_instance(assertion)[0]),
+            ".pem", False)
+        assert self.sec.verify_signature(xml_response, pem_file,
+                                         node_name=class_name(assertion),
+                                         node_id=assertion.id)
+        raises(sigver.SignatureError, self.sec.verify_signature,
+               xml_response.replace("xenosmilus.umdc", "xenosmilus.umu"),
+               pem_file,
+               node_name=class_name(assertion), node_id=assertion.id)
+        raises(sigver.SignatureError, self.sec.verify_signature,
+               xml_response, pem_file, node_name=class_name(assertion),
+               node_id="unknown")
+
+    def test_message_certs_not_cached(self):
+        xml_response = open(SIGNED).read()
+        assert self.sec.correctly_signed_response(xml_response)
+        response = samlp.response_from_string(xml_response)
+        cert = sigver.cert_from_instance(response.assertion[0])[0]
+        assert cert not in sigver.CERT_CACHE
+        assert not sigver.active_cert(base64.b64encode("\x30\x03abc"))
+
+    def test_reference_must_cover_node(self):
+        xml_response = open(SIGNED).read()
+        response = samlp.response_from_string(xml_response)
+        assertion = response.assertion[0]
+        _, pem_file = sigver.make_temp(
+            sigver.pem_format(sigver.cert_from_instance(assertion)[0]),
+            ".pem", False)
+        validate = self.sec.crypto.validate_signature
+        assert validate(xml_response, pem_file, "pem", class_name(assertion),
+                        assertion.id, "ID")
+        # The assertion's signature doesn't cover the response it's in
+        raises(sigver.SignatureError, validate, xml_response, pem_file, "pem",
+               class_name(response), response.id, "ID")
+        raises(sigver.SignatureError, validate, xml_response, pem_file, "pem",
+               class_name(response), "", "ID")
+
+        # Broken signatures are turned down, not crashed on
+        start = xml_response.index("<ns2:SignatureMethod")
+        end = xml_response.index("/>", start) + 2
+        for broken in [xml_response[:start] + xml_response[end:],
+                       xml_response.replace("<ns2:SignatureValue>",
+                                            "<ns2:SignatureValue>A"),
+                       xml_response.replace("<ns2:DigestValue>",
+                                            "<ns2:DigestValue>A")]:
+            raises(sigver.SignatureError, validate, broken, pem_file, "pem",
+                   class_name(assertion), assertion.id, "ID")
+        raises(sigver.SignatureError, validate, xml_response, SIGNED, "pem",
+               class_name(assertion), assertion.id, "ID")
+
+
+def _encrypted_data(plain, block_alg, key_transport, key_info=True):
+    """ Encrypt the way an IdP would, returns the EncryptedData and the
+    EncryptedKey as strings """
+    name, key_size, iv_size = sigver.BLOCK_CIPHERS[block_alg]
+    session_key = M2Crypto.Rand.rand_bytes(key_size)
+    iv = M2Crypto.Rand.rand_bytes(iv_size)
+    pad = iv_size - len(plain) % iv_size
+    cipher = M2Crypto.EVP.Cipher(alg=name, key=session_key, iv=iv, op=1,
+                                 padding=0)
+    data = cipher.update(plain + chr(pad) * pad) + cipher.final()
+    pub_key = M2Crypto.X509.load_cert(PUB_KEY).get_pubkey().get_rsa()
+    wrapped = pub_key.public_encrypt(session_key,
+                                     sigver.KEY_TRANSPORT[key_transport])
+
+    enc_key = ('<xenc:EncryptedKey xmlns:xenc="%s" Id="_key">'
+               '<xenc:EncryptionMethod Algorithm="%s"/>'
+               '<xenc:CipherData><xenc:CipherValue>%s</xenc:CipherValue>'
+               '</xenc:CipherData></xenc:EncryptedKey>' % (
+                   xenc.NAMESPACE, key_transport,
+                   base64.b64encode(wrapped)))
+    if key_info:
+        _key_info = enc_key
+    else:
+        _key_info = ('<ds:RetrievalMethod URI="#_key" Type="%s"/>' %
+                     xenc.TYPE_ENCRYPTED_KEY)
+    enc_data = ('<xenc:EncryptedData xmlns:xenc="%s" '
+                'xmlns:ds="http://www.w3.org/2000/09/xmldsig#" Type="%s">'
+                '<xenc:EncryptionMethod Algorithm="%s"/>'
+                '<ds:KeyInfo>%s</ds:KeyInfo>'
+                '<xenc:CipherData><xenc:CipherValue>%s</xenc:CipherValue>'
+                '</xenc:CipherData></xenc:EncryptedData>' % (
+                    xenc.NAMESPACE, xenc.TYPE_ELEMENT, block_alg, _key_info,
+                    base64.b64encode(iv + data)))
+    return enc_data, enc_key
+
+
+class TestDecryptM2Crypto():
+    def setup_class(self):
+        conf = FakeConfig()
+        conf.crypto_backend = 'M2Crypto'
+        self.sec = sigver.security_context(conf)
+        self.assertion = factory(
+            saml.Assertion, version="2.0", id="11111",
+            issue_instant="2009-10-30T13:20:28Z",
+            attribute_statement=do_attribute_statement({
+                ("", "", "surName"): ("Foo", ""),
+                ("", "", "givenName"): ("Bar", ""),
+            }))
+
+    def test_encrypted_data(self):
+        enc_data, _ = _encrypted_data(
+            "%s" % self.assertion, xenc.BLOCK_TRIPLEDES_CBC,
+            xenc.KEY_TRANSPORT_RSA_1_5)
+        ass = saml.assertion_from_string(self.sec.decrypt(enc_data))
+        assert ass.id == "11111"
+        assert len(ass.attribute_statement[0].attribute) == 2
+
+    def test_encrypted_assertion(self):
+        # EncryptedKey next to the EncryptedData, as in SAML
+        enc_data, enc_key = _encrypted_data(
+            self.assertion.to_string(), xenc.BLOCK_AES128_CBC,
+            xenc.KEY_TRANSPORT_RSA_OAEP, key_info=False)
+        xml_response = (
+            '<samlp:Response xmlns:samlp="%s" xmlns:saml="%s" ID="22222" '
+            'Version="2.0" IssueInstant="2009-10-30T13:20:28Z">'
+            '<saml:EncryptedAssertion>%s%s</saml:EncryptedAssertion>'
+            '</samlp:Response>' % (samlp.NAMESPACE, saml.NAMESPACE,
+                                   enc_data, enc_key))
+
+        response = samlp.response_from_string(
+            self.sec.decrypt(xml_response))
+        enc = response.encrypted_assertion[0].extension_elements[0]
+        ass = extension_element_to_element(enc, saml.ELEMENT_FROM_STRING,
+                                           namespace=saml.NAMESPACE)
+        assert ass.id == "11111"
+
+    def test_algorithms(self):
+        for block_alg in sigver.BLOCK_CIPHERS.keys():
+            for key_transport in sigver.KEY_TRANSPORT.keys():
+                enc_data, _ = _encrypted_data("<a/>", block_alg,
+                                              key_transport)
+                assert self.sec.decrypt(enc_data) == "<a/>"
+
+    def test_wrong_key(self):
+        enc_data, _ = _encrypted_data("<a/>", xenc.BLOCK_AES256_CBC,
+                                      xenc.KEY_TRANSPORT_RSA_1_5)
+        raises(sigver.DecryptError, self.sec.crypto.decrypt, enc_data,
+               full_path("private_key.pem"))
+
+
+class TestEncryptM2Crypto():
+    def setup_class(self):
+        conf = FakeConfig()
+        conf.crypto_backend = 'M2Crypto'
+        self.sec = sigver.security_context(conf)
+        self.sec.metadata = FakeMetadata([self.sec.my_cert])
+        self.attribute = do_attribute_statement({
+            ("", "", "surName"): ("Foo", "")}).attribute[0]
+
+    def test_encrypt(self):
+        for key_type in sigver.SESSION_KEY_TYPES.keys():
+            enc = self.sec.encrypt("%s" % self.attribute, key_type=key_type,
+                                   entity_id="urn:mace:example.com:sp")
+            encd = xenc.encrypted_data_from_string(enc)
+            assert encd.encryption_method.algorithm == \
+                sigver.SESSION_KEY_TYPES[key_type]
+            attr = saml.attribute_from_string(self.sec.decrypt(enc))
+            assert attr.friendly_name == "surName"
+
+    def test_fresh_session_key(self):
+        enc1 = self.sec.encrypt("%s" % self.attribute, recv_key=PUB_KEY)
+        enc2 = self.sec.encrypt("%s" % self.attribute, recv_key=PUB_KEY)
+        assert enc1 != enc2
+
+    def test_key_by_certificate(self):
+        sigver._FILE_CACHE.clear()
+        for _ in range(3):
+            self.sec.encrypt("%s" % self.attribute,
+                             entity_id="urn:mace:example.com:sp")
+        # the temporary PEM files don't end up in the file cache
+        assert len(sigver._FILE_CACHE) == 0
+
+    def test_no_key(self):
+        self.sec.metadata = FakeMetadata([])
+        raises(sigver.MissingKey, self.sec.encrypt, "%s" % self.attribute,
+               entity_id="urn:mace:example.com:sp")
+        self.sec.metadata = FakeMetadata([self.sec.my_cert])
+
+    def test_template(self):
+        template = open(sigver.encryption_template("aes-128")).read()
+        encd = xenc.encrypted_data_from_string(template)
+        assert encd.encryption_method.algorithm == xenc.BLOCK_AES128_CBC
+
+
+class TestPrecheck():
+    def setup_class(self):
+        conf = FakeConfig()
+        conf.crypto_backend = 'M2Crypto'
+        self.sec = sigver.security_context(conf)
+        self.xml_response = open(SIGNED).read()
+
+    def _rejected(self, reason, xml_response):
+        before = self.sec.precheck_failures[reason]
+        try:
+            self.sec.correctly_signed_response(xml_response)
+        except sigver.PrecheckError, exc:
+            assert exc.reason == reason
+        else:
+            assert False, "Not rejected"
+        assert self.sec.precheck_failures[reason] == before + 1
+
+    def test_size(self):
+        self.sec.max_message_size = 1000
+        try:
+            self._rejected("size", self.xml_response)
+        finally:
+            self.sec.max_message_size = None
+
+    def test_reference_uri(self):
+        self._rejected("reference_uri", self.xml_response.replace(
+            'URI="#pfx9e022535', 'URI="#other'))
+
+    def test_duplicate_id(self):
+        self._rejected("duplicate_id", self.xml_response.replace(
+            "<ns0:Status>",
+            '<ns0:Status ID="pfx9e022535-4b38-cc7f-41ec-9a01bcd2936d">'))
+
+    def test_algorithm(self):
+        self._rejected("algorithm", self.xml_response.replace(
+            "http://www.w3.org/2000/09/xmldsig#rsa-sha1",
+            "http://www.w3.org/2000/09/xmldsig#rsa-md5"))
+
+    def test_unknown_issuer(self):
+        self.sec.metadata = FakeMetadata([CERT1], ["urn:mace:example.com"])
+        self.sec.only_use_keys_in_metadata = True
+        try:
+            self._rejected("unknown_issuer", self.xml_response)
+        finally:
+            self.sec.metadata = None
+            self.sec.only_use_keys_in_metadata = False
+
+    def test_accepted(self):
+        assert self.sec.correctly_signed_response(self.xml_response)
+
+
+class TestSigningDaemon():
+    def setup_class(self):
+        self.tmpdir = tempfile.mkdtemp()
+        socket_path = os.path.join(self.tmpdir, "sigd.sock")
+        self.daemon = sigver.SigningDaemon(
+            socket_path, sigver.CryptoBackendM2Crypto(), PRIV_KEY,
+            workers=2, batch_size=4)
+        self.daemon.start()
+
+        conf = FakeConfig()
+        conf.crypto_backend = "signing_daemon"
+        conf.signing_daemon = {"socket_path": socket_path, "timeout": 10}
+        self.sec = sigver.security_context(conf)
+
+    def teardown_class(self):
+        self.daemon.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _assertion(self, ident):
+        return factory(
+            saml.Assertion, version="2.0", id=ident,
+            issue_instant="2009-10-30T13:20:28Z",
+            signature=sigver.pre_signature_part(ident, self.sec.my_cert, 1))
+
+    def test_sign(self):
+        assert isinstance(self.sec.crypto, sigver.CryptoBackendSigningDaemon)
+        ass = self._assertion("11111")
+        signed = self.sec.sign_assertion("%s" % ass, node_id=ass.id)
+        sass = saml.assertion_from_string(signed)
+        assert self.sec.check_signature(sass, class_name(sass), signed)
+
+    def test_error(self):
+        ass = self._assertion("11111")
+        raises(sigver.SignatureError, self.sec.sign_assertion, "%s" % ass,
+               node_id="unknown")
+
+    def test_pipelining(self):
+        results = {}
+
+        def _sign(ident):
+            ass = self._assertion(ident)
+            results[ident] = self.sec.sign_assertion("%s" % ass,
+                                                     node_id=ident)
+
+        threads = [threading.Thread(target=_sign, args=("id%d" % i,))
+                   for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(results) == 20
+        for ident, signed in results.items():
+            sass = saml.assertion_from_string(signed)
+            assert sass.id == ident
+            assert self.sec.check_signature(sass, class_name(sass), signed)
+
+        stats = self.sec.crypto.stats()
+        assert stats["in_flight"] == 0
+        assert stats["requests"] >= 20
+        daemon_stats = self.sec.crypto.daemon_stats()
+        assert daemon_stats["queue_depth"] == 0
+        assert daemon_stats["requests"] >= 20
+        assert daemon_stats["batches"] <= daemon_stats["requests"]
+
+    def test_socket_mode(self):
+        mode = os.stat(self.daemon.socket_path).st_mode
+        assert mode & 0777 == 0600
+
+    def test_forked(self):
+        crypto = self.sec.crypto
+        ass = self._assertion("11111")
+        self.sec.sign_assertion("%s" % ass, node_id=ass.id)
+        inherited = crypto._sock
+        # As if the backend had been inherited from a parent process
+        crypto._pid = -1
+        signed = self.sec.sign_assertion("%s" % ass, node_id=ass.id)
+        assert crypto._pid == os.getpid()
+        assert crypto._sock is not inherited
+        sass = saml.assertion_from_string(signed)
+        assert self.sec.check_signature(sass, class_name(sass), signed)
+
+
+def test_signing_daemon_bad_reply():
+    tmpdir = tempfile.mkdtemp()
+    socket_path = os.path.join(tmpdir, "bad.sock")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(1)
+
+    def _serve():
+        conn, _ = server.accept()
+        sigver._recv_message(conn)
+        # Well formed JSON, but not a reply
+        conn.sendall(struct.pack("!I", 3) + "[1]")
+        time.sleep(5)
+        conn.close()
+
+    thread = threading.Thread(target=_serve)
+    thread.daemon = True
+    thread.start()
+    try:
+        crypto = sigver.CryptoBackendSigningDaemon(socket_path, timeout=3)
+        start = time.time()
+        raises(sigver.SigningDaemonError, crypto.decrypt, "<a/>", None)
+        # The reader went away with the connection, nothing waited for the
+        # timeout
+        assert time.time() - start < 2
+        assert crypto._sock is None
+    finally:
+        server.close()
+        shutil.rmtree(tmpdir)
+
+
+def test_key_rollover():
+    conf = FakeConfig()
+    conf.crypto_backend = 'M2Crypto'
+    conf.metadata = FakeMetadata([CERT_SSP, CERT1])
+    sec = sigver.security_context(conf)
+
+    # The certificate in the KeyInfo picks the right metadata certificate
+    xml_response = open(SIGNED).read()
+    assert sec.correctly_signed_response(xml_response)
+    assert sec.verify_attempts == {1: 1}
+    assert sec.cert_selection == {"key_info": 1, "last_verified": 0}
+
+    # Without KeyInfo the certificate that worked last time goes first
+    start = xml_response.index("<ns2:KeyInfo>")
+    end = xml_response.index("</ns2:KeyInfo>") + len("</ns2:KeyInfo>")
+    xml_response = xml_response[:start] + xml_response[end:]
+    assert sec.correctly_signed_response(xml_response)
+    assert sec.verify_attempts == {1: 2}
+    assert sec.cert_selection == {"key_info": 1, "last_verified": 1}
+
+    # Nothing to go on, try them in metadata order
+    sec.last_verified = {}
+    assert sec.correctly_signed_response(xml_response)
+    assert sec.verify_attempts == {1: 2, 2: 1}
+
+
 class TestSecurityMetadata():
     def setup_class(self):
         conf = config.SPConfig()
@@ -418,3 +856,64 @@ class TestSecurityMetadata():
         item = self.sec.check_signature(sass, class_name(sass), sign_ass)
 
         assert isinstance(item, saml.Assertion)
+
+
+def test_cert_cache():
+    cache = sigver.CertificateCache(size=1)
+    fil_1, pem_1 = cache.pem_file(CERT1, "urn:one")
+    assert os.path.exists(pem_1)
+    # same certificate, different formatting
+    assert cache.pem_file("".join(CERT1.split()))[1] == pem_1
+    assert cache.rsa_pub(CERT1) is cache.rsa_pub(CERT1)
+    assert CERT1 in cache
+
+    # the least recently used entry is evicted, but its file is kept as
+    # long as it's in use
+    fil_2, pem_2 = cache.pem_file(CERT_SSP, "urn:two")
+    assert len(cache) == 1
+    assert CERT1 not in cache
+    assert cache._entity.keys() == ["urn:two"]
+    assert os.path.exists(pem_1)
+    del fil_1
+    assert not os.path.exists(pem_1)
+
+    cache.invalidate("urn:two")
+    assert len(cache) == 0
+    assert cache._entity == {}
+    del fil_2
+    assert not os.path.exists(pem_2)
+
+
+def test_file_cache_bounded():
+    size = sigver._FILE_CACHE_SIZE
+    sigver._FILE_CACHE.clear()
+    sigver._FILE_CACHE_SIZE = 2
+    try:
+        first = sigver.rsa_load(PRIV_KEY)
+        sigver.read_cert_from_file(PUB_KEY, "pem")
+        assert sigver.rsa_load(PRIV_KEY) is first
+        # the least recently used entry, the certificate, is evicted
+        sigver.read_cert_from_file(PUB_KEY, "der")
+        assert len(sigver._FILE_CACHE) == 2
+        assert ("_read_cert_from_file", PUB_KEY, "pem") not in \
+            sigver._FILE_CACHE
+        assert sigver.rsa_load(PRIV_KEY) is first
+    finally:
+        sigver._FILE_CACHE_SIZE = size
+        sigver._FILE_CACHE.clear()
+
+
+def test_cert_fingerprint():
+    assert sigver.cert_fingerprint(CERT1) == sigver.cert_fingerprint(
+        "".join(CERT1.split()))
+    assert sigver.cert_fingerprint(CERT1) != sigver.cert_fingerprint(CERT_SSP)
+
+
+def test_cert_validity():
+    for cert in [CERT1, CERT_SSP]:
+        x509 = M2Crypto.X509.load_cert_der_string(
+            base64.b64decode("".join(cert.split())))
+        assert sigver.cert_validity(cert) == (
+            calendar.timegm(x509.get_not_before().get_datetime().timetuple()),
+            calendar.timegm(x509.get_not_after().get_datetime().timetuple()))
+    raises(ValueError, sigver.cert_validity, base64.b64encode("\x30\x03abc"))
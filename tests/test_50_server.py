@@ -183,6 +183,44 @@ class TestServer1():
         assert name_id_policy.format == saml.NAMEID_FORMAT_TRANSIENT
         assert resp_args["sp_entity_id"] == "urn:mace:example.com:saml:roland:sp"
 
+    def test_parse_request_size_limits(self):
+        authn_request = self.client.create_authn_request(
+            message_id="id1", destination="http://localhost:8088/sso")
+
+        binding = BINDING_HTTP_REDIRECT
+        htargs = self.client.apply_binding(binding, "%s" % authn_request,
+                                           "http://www.example.com", "abcd")
+        txt = parse_qs(htargs["headers"][0][1].split('?')[1])["SAMLRequest"][0]
+
+        decoded = self.server.decoded["messages"]
+        rejections = self.server.decode_rejections.copy()
+        max_message_size = self.server.config.max_message_size
+        max_compressed_size = self.server.config.max_compressed_size
+        assert max_message_size and max_compressed_size
+        try:
+            self.server.config.max_message_size = 100
+            raises(s_utils.MessageTooLarge, self.server.parse_authn_request,
+                   txt, binding)
+            self.server.config.max_message_size = None
+            self.server.config.max_compressed_size = 100
+            raises(s_utils.MessageTooLarge, self.server.parse_authn_request,
+                   txt, binding)
+            self.server.config.max_compressed_size = None
+            raises(s_utils.UnravelError, self.server.parse_authn_request,
+                   txt[:-8], binding)
+        finally:
+            self.server.config.max_message_size = max_message_size
+            self.server.config.max_compressed_size = max_compressed_size
+
+        assert self.server.decoded["messages"] == decoded
+        for reason in ["compressed_size", "decompressed_size", "malformed"]:
+            assert self.server.decode_rejections[reason] == \
+                rejections[reason] + 1
+
+        self.server.parse_authn_request(txt, binding)
+        assert self.server.decoded["messages"] == decoded + 1
+        assert self.server.decoded["largest"] > 100
+
     def test_sso_response_with_identity(self):
         name_id = self.server.ident.transient_nameid(
             "urn:mace:example.com:saml:roland:sp", "id12")
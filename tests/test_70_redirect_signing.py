@@ -1,12 +1,19 @@
 from saml2.pack import http_redirect_message
 from saml2.sigver import verify_redirect_signature
 from saml2.sigver import RSA_SHA1
+from saml2.sigver import RSA_SHA256
+from saml2.sigver import SIGNER_ALGS
+from saml2.sigver import verify_redirect_query
+from saml2.sigver import verify_redirect_signatures
+from saml2.sigver import CERT_CACHE
+from xmldsig import SIG_DSA_SHA1 as DSA_SHA1
 from saml2.server import Server
 from saml2 import BINDING_HTTP_REDIRECT
 from saml2.client import Saml2Client
 from saml2.config import SPConfig
 from saml2.sigver import rsa_load
 from urlparse import parse_qs
+import urllib
 
 from pathutils import dotname
 
@@ -45,3 +52,74 @@ def test():
                     verified_ok = True
 
     assert verified_ok
+
+
+def _location(info):
+    for param, val in info["headers"]:
+        if param == "Location":
+            return val
+
+
+def test_algorithms():
+    srvs = sp.metadata.single_sign_on_service(idp.config.entityid,
+                                              BINDING_HTTP_REDIRECT)
+    destination = srvs[0]["location"]
+    req = sp.create_authn_request(destination, id="id1")
+    cert = idp.metadata.certs(sp.config.entityid, "any", "signing")[0]
+
+    for sigalg in SIGNER_ALGS.keys():
+        info = http_redirect_message(req, destination, typ="SAMLRequest",
+                                     sigalg=sigalg, key=sp.sec.key_file)
+        query = _location(info).split("?")[1]
+        assert verify_redirect_signature(parse_qs(query), cert)
+        assert verify_redirect_query(query, cert, sp.config.entityid)
+
+
+def test_batch():
+    srvs = sp.metadata.single_sign_on_service(idp.config.entityid,
+                                              BINDING_HTTP_REDIRECT)
+    destination = srvs[0]["location"]
+    req = sp.create_authn_request(destination, id="id1")
+    cert = idp.metadata.certs(sp.config.entityid, "any", "signing")[0]
+
+    info = http_redirect_message(req, destination, relay_state="RS",
+                                 typ="SAMLRequest", sigalg=RSA_SHA256,
+                                 key=sp.sec.key_file)
+    query = _location(info).split("?")[1]
+    tampered = query.replace("RelayState=RS", "RelayState=SR")
+    unsupported = query.replace(urllib.quote_plus(RSA_SHA256),
+                                urllib.quote_plus(DSA_SHA1))
+
+    assert verify_redirect_signatures([
+        (query, cert, sp.config.entityid),
+        (parse_qs(query), cert, sp.config.entityid),
+        (tampered, cert, sp.config.entityid),
+        (unsupported, cert, sp.config.entityid)]) == [True, True, False,
+                                                      False]
+
+    # a certificate that isn't even base64 only fails its own message
+    assert verify_redirect_signatures([
+        (query, cert[:-1], sp.config.entityid),
+        (query, "not a certificate", None),
+        (query, cert, sp.config.entityid)]) == [False, False, True]
+
+
+def test_message_cert_not_cached():
+    srvs = sp.metadata.single_sign_on_service(idp.config.entityid,
+                                              BINDING_HTTP_REDIRECT)
+    destination = srvs[0]["location"]
+    req = sp.create_authn_request(destination, id="id1")
+    cert = idp.metadata.certs(sp.config.entityid, "any", "signing")[0]
+
+    info = http_redirect_message(req, destination, typ="SAMLRequest",
+                                 sigalg=RSA_SHA256, key=sp.sec.key_file)
+    query = _location(info).split("?")[1]
+
+    CERT_CACHE.clear()
+    assert verify_redirect_query(query, cert)
+    assert cert not in CERT_CACHE
+
+    # one that is already trusted is taken from the cache
+    key = CERT_CACHE.rsa_pub(cert, sp.config.entityid)
+    assert verify_redirect_query(query, cert, sp.config.entityid)
+    assert CERT_CACHE.rsa_pub(cert) is key
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+import argparse
+import time
+
+import xmldsig
+import xmlenc
+from saml2 import ElementTree
+from saml2 import extension_elements_to_elements
+from saml2 import md
+from saml2 import saml
+from saml2 import _extension_element_from_element_tree
+from saml2.extension import dri
+from saml2.extension import idpdisc
+from saml2.extension import mdattr
+from saml2.extension import mdui
+from saml2.extension import shibmd
+from saml2.extension import ui
+
+"""
+A script that measures how fast extension elements are converted into
+schema class instances, directly from the tree and the way it used to be
+done: serializing the extension element and parsing the result.
+
+Example: extbench.py -n 20 ../tests/InCommon-metadata.xml
+"""
+
+ONTS = [dri, idpdisc, md, mdattr, mdui, saml, shibmd, ui, xmldsig, xmlenc]
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', dest='rounds', type=int, default=10)
+parser.add_argument(dest="xml")
+args = parser.parse_args()
+
+# Everything found in md:Extensions, as extension elements
+extensions = []
+for elem in ElementTree.parse(args.xml).getroot().iter(
+        "{%s}Extensions" % md.NAMESPACE):
+    extensions.extend([_extension_element_from_element_tree(e)
+                       for e in elem])
+
+
+def reparse(extension_elements, schemas):
+    res = []
+    for extension_element in extension_elements:
+        for schema in schemas:
+            if extension_element.namespace != schema.NAMESPACE:
+                continue
+            try:
+                ets = schema.ELEMENT_FROM_STRING[extension_element.tag]
+            except KeyError:
+                continue
+            inst = ets(extension_element.to_string())
+            if inst:
+                res.append(inst)
+                break
+    return res
+
+
+for name, func in [("serialize and parse", reparse),
+                   ("from tree", extension_elements_to_elements)]:
+    start = time.time()
+    for i in range(args.rounds):
+        res = func(extensions, ONTS)
+    spent = time.time() - start
+    print "%s: %d extension elements converted in %.3fs, %.1f/s" % (
+        name, len(res) * args.rounds, spent, len(res) * args.rounds / spent)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+import argparse
+import copy
+import time
+
+from saml2 import config
+from saml2 import md
+from saml2 import saml
+from saml2 import BINDING_HTTP_REDIRECT
+from saml2.extension import mdattr
+from saml2.extension import mdrpi
+from saml2.extension import mdui
+from saml2.extension import idpdisc
+from saml2.mdstore import MetaData
+from saml2.mdstore import MetadataStore
+import xmldsig
+
+"""
+A script that measures how long it takes to look up entities in a
+MetadataStore with many entities spread over a number of sources. The
+entities are copies of the first IdP in the metadata file. With -p they
+are published to a shared metadata file which is what they are then looked
+up in.
+
+Example: mdbench.py -e 20000 -s 4 ../tests/swamid-1.0.xml
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-e', dest='entities', type=int, default=20000)
+parser.add_argument('-s', dest='sources', type=int, default=4)
+parser.add_argument('-n', dest='rounds', type=int, default=100000)
+parser.add_argument('-p', dest='shared')
+parser.add_argument(dest="metadata")
+args = parser.parse_args()
+
+ONTS = [saml, mdui, mdattr, mdrpi, idpdisc, md, xmldsig]
+
+template = MetaData(ONTS, None, open(args.metadata).read())
+template.load()
+idp = template.with_descriptor("idpsso").values()[0]
+
+start = time.time()
+mds = MetadataStore(ONTS, None, config.Config())
+per_source = args.entities / args.sources
+for i in range(args.sources):
+    source = MetaData(ONTS, None)
+    for j in range(per_source):
+        source.entity["https://idp%d.example.org/%d" % (j, i)] = \
+            copy.deepcopy(idp)
+    mds["source%d" % i] = source
+print "%d entities in %d sources, built in %.1fs" % (
+    mds.entities(), len(mds), time.time() - start)
+
+if args.shared:
+    mds.publish(args.shared)
+    mds = MetadataStore(ONTS, None, config.Config())
+    start = time.time()
+    mds.load("shared", args.shared)
+    print "shared metadata file loaded in %.1fms" % (
+        (time.time() - start) * 1000)
+
+# An entity in the source that's looked in last if the sources are tried
+# one after the other
+last = mds.metadata.values()[-1].keys()[0]
+
+
+def timed(func, rounds):
+    start = time.time()
+    for i in range(rounds):
+        func()
+    return (time.time() - start) * 1000000 / rounds
+
+
+for what, func, rounds in [
+        ("__getitem__", lambda: mds[last], args.rounds),
+        ("name", lambda: mds.name(last), args.rounds),
+        ("bindings", lambda: mds.bindings(last, "idpsso_descriptor",
+                                          "single_sign_on_service"),
+         args.rounds),
+        ("single_sign_on_service",
+         lambda: mds.single_sign_on_service(last, BINDING_HTTP_REDIRECT),
+         args.rounds),
+        ("certs", lambda: mds.certs(last, "any", "signing"), args.rounds),
+        ("entity_categories", lambda: mds.entity_categories(last),
+         args.rounds),
+        ("count", lambda: mds.count(role="idpsso"), args.rounds),
+        ("with_descriptor", lambda: mds.with_descriptor("idpsso"),
+         args.rounds / 1000),
+        ("keys", mds.keys, args.rounds / 1000),
+        ("items", mds.items, args.rounds / 1000)]:
+    print "%s: %.2fus" % (what, timed(func, max(rounds, 1)))
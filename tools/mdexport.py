@@ -18,13 +18,20 @@ import xmlenc
 
 import argparse
 
-from saml2.mdstore import MetaDataFile, MetaDataExtern
+from saml2 import config
+from saml2.mdstore import MetaDataFile, MetaDataExtern, MetadataStore
 
 __author__ = 'rolandh'
 
 """
 A script that imports and verifies metadata and then dumps it in a basic
 dictionary format.
+
+With -s a snapshot that a configuration with metadata_snapshot can use is
+written instead, and with -p a file that can be used as "shared" metadata.
+The metadata file, or URL, has to be given the same way as in the
+configuration. Snapshots and shared files are only used by the user that
+made them, so run this as the user the service runs as.
 """
 
 
@@ -49,13 +56,26 @@ parser.add_argument('-u', dest='url')
 parser.add_argument('-c', dest='cert')
 parser.add_argument('-a', dest='attrsmap')
 parser.add_argument('-o', dest='output')
+parser.add_argument('-s', dest='snapshot')
+parser.add_argument('-p', dest='shared')
 parser.add_argument(dest="item")
 args = parser.parse_args()
 
 
 metad = None
 
-if args.type == "local":
+if args.snapshot or args.shared:
+    # The namespaces have to be the ones a configuration uses
+    mds = MetadataStore(config.ONTS.values(), None, config.Config())
+    if args.type == "local":
+        mds.load("local", args.item)
+    elif args.type == "external":
+        mds.load("remote", url=args.url, cert=args.cert)
+    if args.snapshot:
+        mds.dump_snapshot(args.snapshot)
+    if args.shared:
+        mds.publish(args.shared)
+elif args.type == "local":
     metad = MetaDataFile(ONTS.values(), args.item, args.item)
 elif args.type == "external":
     ATTRCONV = ac_factory(args.attrsmap)
@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import resource
 import sys
 import time
 from saml2.attribute_converter import ac_factory
@@ -45,3 +46,8 @@ for i in range(1, 10):
     _ = mdf.keys()
 
 print time.time() - start
+
+# MetaDataFile streams the aggregate so this is bounded by the largest
+# entity descriptor, not the size of the file
+print "Peak memory usage: %d kB" % resource.getrusage(
+    resource.RUSAGE_SELF).ru_maxrss
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+import argparse
+import gc
+import os
+import subprocess
+import sys
+
+"""
+A script that measures how much memory parsed assertions and entity
+descriptors use, with the SAML classes in their normal and in their
+compact (PYSAML2_COMPACT) form.
+
+Example: membench.py ../tests/saml_signed.xml ../tests/InCommon-metadata.xml
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-m', dest='measure', action='store_true',
+                    help="Measure in this process")
+parser.add_argument(dest="response")
+parser.add_argument(dest="metadata")
+args = parser.parse_args()
+
+
+def deep_size(obj):
+    """ The number of bytes used by the object and everything it refers to,
+    apart from classes """
+    seen = set()
+    todo = [obj]
+    size = 0
+    while todo:
+        item = todo.pop()
+        if id(item) in seen or isinstance(item, type):
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        todo.extend(gc.get_referents(item))
+    return size
+
+
+def measure():
+    from saml2 import md
+    from saml2 import samlp
+
+    assertions = samlp.response_from_string(
+        open(args.response).read()).assertion
+    entities = md.entities_descriptor_from_string(
+        open(args.metadata).read()).entity_descriptor
+
+    print "%d bytes/Assertion, %d bytes/EntityDescriptor" % (
+        deep_size(assertions) / len(assertions),
+        deep_size(entities) / len(entities))
+
+
+if args.measure:
+    measure()
+else:
+    for name, compact in [("normal", "0"), ("compact", "1")]:
+        env = os.environ.copy()
+        env["PYSAML2_COMPACT"] = compact
+        sys.stdout.write("%s: " % name)
+        sys.stdout.flush()
+        subprocess.call([sys.executable, sys.argv[0], "-m", args.response,
+                         args.metadata], env=env)
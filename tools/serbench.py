@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+import argparse
+import time
+
+from saml2 import ElementTree
+from saml2 import samlp
+
+"""
+A script that measures how fast a response is turned into XML: by building
+an ElementTree and serializing it, and by writing it directly.
+
+Example: serbench.py -n 1000 ../tests/saml_signed.xml
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', dest='rounds', type=int, default=500)
+parser.add_argument(dest="response")
+args = parser.parse_args()
+
+response = samlp.response_from_string(open(args.response).read())
+
+
+def tree():
+    return ElementTree.tostring(response._to_element_tree(), encoding="UTF-8")
+
+
+def direct():
+    return response.to_string()
+
+
+assert tree() == direct()
+
+for name, func in [("ElementTree", tree), ("direct", direct)]:
+    start = time.time()
+    for i in range(args.rounds):
+        func()
+    spent = time.time() - start
+    print "%s: %.3fms/response" % (name, spent * 1000 / args.rounds)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+import argparse
+import time
+
+from saml2 import class_name
+from saml2 import samlp
+from saml2.sigver import CryptoBackendM2Crypto
+from saml2.sigver import cert_from_instance
+from saml2.sigver import get_xmlsec_binary
+from saml2.sigver import make_temp
+from saml2.sigver import pem_format
+from saml2.sigver import _get_xmlsec_cryptobackend
+
+"""
+A script that measures how many assertion signature verifications per
+second the xmlsec1 and the in-process M2Crypto crypto backends manage.
+
+Example: sigbench.py -n 500 ../tests/saml_signed.xml
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', dest='rounds', type=int, default=200)
+parser.add_argument('-x', dest='xmlsec')
+parser.add_argument(dest="response")
+args = parser.parse_args()
+
+xml_response = open(args.response).read()
+assertion = samlp.response_from_string(xml_response).assertion[0]
+_, pem_file = make_temp(pem_format(cert_from_instance(assertion)[0]), ".pem",
+                        False)
+
+backends = [("M2Crypto", CryptoBackendM2Crypto())]
+try:
+    backends.append(("xmlsec1", _get_xmlsec_cryptobackend(
+        args.xmlsec or get_xmlsec_binary())))
+except Exception:
+    print "xmlsec1 not found, only measuring the in-process backend"
+
+for name, crypto in backends:
+    start = time.time()
+    for i in range(args.rounds):
+        assert crypto.validate_signature(xml_response, pem_file, "pem",
+                                         class_name(assertion), assertion.id,
+                                         "ID")
+    spent = time.time() - start
+    print "%s: %d verifications in %.3fs, %.1f verifications/s" % (
+        name, args.rounds, spent, args.rounds / spent)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+import argparse
+import logging
+import time
+
+from saml2.sigver import SigningDaemon
+from saml2.sigver import _get_m2crypto_cryptobackend
+
+"""
+Runs a signing daemon that does the signing and decryption for all
+the SAML services on this host that are configured with
+"crypto_backend": "signing_daemon".
+
+Example: sigd.py -k /etc/pysaml2/idp.key -s /var/run/pysaml2/sigd.sock
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-s', dest='socket_path', required=True,
+                    help="Where to create the Unix socket")
+parser.add_argument('-k', dest='key_file', required=True,
+                    help="The private key")
+parser.add_argument('-w', dest='workers', type=int, default=2,
+                    help="Number of worker threads")
+parser.add_argument('-b', dest='batch_size', type=int, default=16)
+parser.add_argument('-x', dest='xmlsec', help="xmlsec1 binary")
+parser.add_argument('-i', dest='interval', type=int, default=0,
+                    help="Log statistics this often (seconds)")
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("sigd")
+
+daemon = SigningDaemon(args.socket_path,
+                       _get_m2crypto_cryptobackend(args.xmlsec),
+                       args.key_file, workers=args.workers,
+                       batch_size=args.batch_size)
+
+if args.interval:
+    daemon.start()
+    try:
+        while True:
+            time.sleep(args.interval)
+            logger.info("%s" % daemon.stats())
+    finally:
+        daemon.close()
+else:
+    try:
+        daemon.serve_forever()
+    finally:
+        daemon.close()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+import argparse
+import time
+
+from saml2 import md
+from saml2 import samlp
+from saml2.validate import valid_instance
+
+"""
+A script that measures how long valid_instance takes on a response and on
+each of the entity descriptors in a metadata file.
+
+Example: validbench.py ../tests/saml_signed.xml ../tests/InCommon-metadata.xml
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', dest='rounds', type=int, default=500)
+parser.add_argument(dest="response")
+parser.add_argument(dest="metadata")
+args = parser.parse_args()
+
+response = samlp.response_from_string(open(args.response).read())
+entities = md.entities_descriptor_from_string(
+    open(args.metadata).read()).entity_descriptor
+
+
+def timed(func, rounds):
+    start = time.time()
+    for i in range(rounds):
+        func()
+    return (time.time() - start) * 1000 / rounds
+
+
+def metadata():
+    for entity in entities:
+        valid_instance(entity)
+
+
+print "response: %.3fms, metadata: %.1fms (%d entities)" % (
+    timed(lambda: valid_instance(response), args.rounds),
+    timed(metadata, max(args.rounds / 100, 1)), len(entities))
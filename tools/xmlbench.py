@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+"""
+A script that measures how fast the two XML backends (PYSAML2_XML_BACKEND)
+parse a response and a metadata file, and how fast they parse and
+canonicalize the response the way it's done when a signature is verified.
+
+Example: xmlbench.py ../tests/saml_signed.xml ../tests/InCommon-metadata.xml
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-m', dest='measure', action='store_true',
+                    help="Measure in this process")
+parser.add_argument('-n', dest='rounds', type=int, default=200)
+parser.add_argument(dest="response")
+parser.add_argument(dest="metadata")
+args = parser.parse_args()
+
+
+def timed(func, rounds):
+    start = time.time()
+    for i in range(rounds):
+        func()
+    return (time.time() - start) * 1000 / rounds
+
+
+def measure():
+    from saml2 import xmlbackend
+
+    response = open(args.response).read()
+    metadata = open(args.metadata).read()
+
+    def canonicalize():
+        root = xmlbackend.parse_document(response)
+        xmlbackend.canonicalize(root, exclusive=True)
+
+    print "%s: response %.3fms, metadata %.1fms, c14n %.3fms" % (
+        xmlbackend.BACKEND,
+        timed(lambda: xmlbackend.fromstring(response), args.rounds),
+        timed(lambda: xmlbackend.fromstring(metadata), 5),
+        timed(canonicalize, args.rounds))
+
+
+if args.measure:
+    measure()
+else:
+    for backend in ["etree", "lxml"]:
+        env = os.environ.copy()
+        env["PYSAML2_XML_BACKEND"] = backend
+        sys.stdout.flush()
+        subprocess.call([sys.executable, sys.argv[0], "-m", "-n",
+                         str(args.rounds), args.response, args.metadata],
+                        env=env)